@@ -0,0 +1,130 @@
+import os
+import re
+
+from audiobackends import AudioBackend, AudioEvent, AudioStream
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+# Units that hold far more than one app, grouping by these would lump the whole desktop together
+_shared_unit_pattern = re.compile(r'^(session-\w+\.scope|init\.scope|user@\d+\.service|.*\.slice)$')
+# The instance part systemd/flatpak/snap tack onto the end of an app's unit name
+_instance_suffix_pattern = re.compile(r'(-[0-9a-f-]{6,}|-\d+|@[0-9a-f]+)$')
+# What's left of an app's own unit once that's gone, systemd's app[-<launcher>]-<app id> or snap.<snap>.<app>,
+# a launcher on its own (app-gnome) doesn't count
+_app_unit_pattern = re.compile(
+    r'^(app-((gnome|kde|flatpak|xfce|dbus)-)?(?!(gnome|kde|flatpak|xfce|dbus)$)[^-@]+.*|snap\.[^.]+\.[^.]+)$')
+
+
+def read_cgroup_path(pid: int) -> [str | None]:
+    try:
+        with open(f'/proc/{pid}/cgroup') as cgroup_file:
+            for line in cgroup_file:
+                # cgroup v2 is the single '0::' line, otherwise systemd's own hierarchy has the unit
+                hierarchy, _controllers, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0' or _controllers == 'name=systemd':
+                    return path
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+# e.g. .../app.slice/app-flatpak-org.mozilla.firefox-1234.scope -> app-flatpak-org.mozilla.firefox
+# Anything that isn't an app's own unit (vte-spawn-<uuid>.scope, run-u12.service) is a one off launch
+# and keeps its full name, or every app started the same way would end up together
+def group_key_from_cgroup(cgroup_path: str) -> [str | None]:
+    for unit in reversed(cgroup_path.split('/')):
+        if not unit.endswith(('.scope', '.service')):
+            continue
+        if _shared_unit_pattern.match(unit):
+            return None
+        app_name = _instance_suffix_pattern.sub('', unit.rsplit('.', 1)[0])
+        return app_name if _app_unit_pattern.match(app_name) else unit
+    return None
+
+
+def _read_start_time(pid: int) -> [int | None]:
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # The name can have spaces and brackets in, so count fields from after its closing bracket
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+            return int(fields[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Works out which app (cgroup / systemd scope) each audio stream really belongs to, so sandboxed apps,
+# apps that play audio from a helper process and apps started through wrappers can still be found.
+class StreamAttributionIndex:
+
+    def __init__(self, backend: AudioBackend):
+        self.backend = backend
+        # pid -> (start time, group key), the start time catches pids being reused
+        self._pid_keys: dict[int, tuple[int | None, str | None]] = {}
+        self._stream_keys: dict[int, str] = {}
+        self._key_streams: dict[str, set[int]] = {}
+
+    def key_for_pid(self, pid: int) -> [str | None]:
+        start_time = _read_start_time(pid)
+        cached = self._pid_keys.get(pid)
+        if cached is not None and cached[0] == start_time:
+            return cached[1]
+        cgroup_path = read_cgroup_path(pid)
+        key = None if cgroup_path is None else group_key_from_cgroup(cgroup_path)
+        self._pid_keys[pid] = (start_time, key)
+        return key
+
+    def key_for_stream(self, stream: AudioStream) -> [str | None]:
+        # Sandboxed streams report a pid from inside their own pid namespace, but the portal tells us the app
+        flatpak_id = stream.proplist.get('pipewire.access.portal.app_id') or stream.proplist.get('application.flatpak.id')
+        if flatpak_id:
+            return f'app-flatpak-{flatpak_id}'
+        if stream.pid is None:
+            return None
+        return self.key_for_pid(stream.pid)
+
+    def rebuild(self):
+        self._stream_keys.clear()
+        self._key_streams.clear()
+        for stream in self.backend.list_streams():
+            self._add_stream(stream)
+        logger.info(f'Attributed {len(self._stream_keys)} streams to {len(self._key_streams)} apps')
+
+    def _add_stream(self, stream: AudioStream):
+        key = self.key_for_stream(stream)
+        if key is None:
+            return
+        self._stream_keys[stream.index] = key
+        self._key_streams.setdefault(key, set()).add(stream.index)
+
+    def _remove_stream(self, index: int):
+        key = self._stream_keys.pop(index, None)
+        if key is None:
+            return
+        streams = self._key_streams[key]
+        streams.discard(index)
+        if len(streams) == 0:
+            del self._key_streams[key]
+
+    def on_audio_event(self, event: AudioEvent):
+        if event.facility != AudioEvent.STREAM:
+            return
+        if event.event_type == AudioEvent.REMOVE:
+            self._remove_stream(event.index)
+            self.forget_dead_pids()
+        elif event.event_type == AudioEvent.NEW:
+            stream = self.backend.get_stream(event.index)
+            if stream is not None:
+                self._add_stream(stream)
+        # Changes don't move a stream to another process, only new and remove matter
+
+    def stream_indexes_for_pids(self, pids: set[int]) -> set[int]:
+        indexes = set()
+        for key in set(self.key_for_pid(pid) for pid in pids):
+            if key is not None:
+                indexes |= self._key_streams.get(key, set())
+        return indexes
+
+    def forget_dead_pids(self):
+        for pid in [pid for pid in self._pid_keys if not os.path.exists(f'/proc/{pid}')]:
+            del self._pid_keys[pid]
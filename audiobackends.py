@@ -0,0 +1,443 @@
+import itertools
+import threading
+import time
+from typing import Callable
+
+import generalutils
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+PULSE_BACKEND = 'pulse'
+MEMORY_BACKEND = 'memory'
+# How long one of our own volume writes gets to come back as a change event
+OWN_WRITE_WINDOW = .5
+
+
+# A single application's audio stream (a PulseAudio Sink Input)
+class AudioStream:
+
+    def __init__(self, index: int, proplist: dict[str, str], channel_volumes: list[float], corked: bool = False):
+        self.index = index
+        self.proplist = proplist
+        self.channel_volumes = channel_volumes
+        self.corked = corked
+
+    @property
+    def pid(self) -> [int | None]:
+        pid = self.proplist.get('application.process.id')
+        return None if pid is None else int(pid)
+
+    @property
+    def binary(self) -> [str | None]:
+        return self.proplist.get('application.process.binary')
+
+    @property
+    def name(self) -> str:
+        return self.proplist.get('application.name', self.binary or f'stream-{self.index}')
+
+    # Same as pulsectl's volume_get_all_chans, the average over all channels
+    @property
+    def volume(self) -> float:
+        if len(self.channel_volumes) == 0:
+            return 0
+        return sum(self.channel_volumes) / len(self.channel_volumes)
+
+    def __str__(self):
+        return f'[{self.index}:{self.binary}, Volume: {self.channel_volumes}]'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# An output device (a PulseAudio Sink)
+class AudioOutput:
+
+    def __init__(self, index: int, name: str, description: str, channel_volumes: list[float]):
+        self.index = index
+        self.name = name
+        self.description = description
+        self.channel_volumes = channel_volumes
+
+    @property
+    def volume(self) -> float:
+        if len(self.channel_volumes) == 0:
+            return 0
+        return sum(self.channel_volumes) / len(self.channel_volumes)
+
+    def __str__(self):
+        return f'[{self.index}:{self.name}, Volume: {self.channel_volumes}]'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# Something changed on the sound server, mirrors the PulseAudio subscription events
+class AudioEvent:
+    STREAM = 'sink_input'
+    OUTPUT = 'sink'
+
+    NEW = 'new'
+    CHANGE = 'change'
+    REMOVE = 'remove'
+
+    def __init__(self, facility: str, event_type: str, index: int):
+        self.facility = facility
+        self.event_type = event_type
+        self.index = index
+
+    def __str__(self):
+        return f'[{self.facility} {self.event_type}: {self.index}]'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class AudioBackend:
+
+    def __init__(self):
+        self.changed: generalutils.Signal = generalutils.Signal[AudioEvent]('audio_changed')
+        # stream index -> (change events still to come back from our own writes, until when)
+        self._own_writes: dict[int, tuple[int, float]] = {}
+        self._own_writes_lock = threading.Lock()
+
+    def _note_own_writes(self, indexes):
+        deadline = time.monotonic() + OWN_WRITE_WINDOW
+        with self._own_writes_lock:
+            for index in indexes:
+                pending, _ = self._own_writes.get(index, (0, 0))
+                self._own_writes[index] = (pending + 1, deadline)
+
+    # Whether this is one of our own stream volume writes coming back, each write only accounts for one event
+    def is_own_change(self, event: AudioEvent) -> bool:
+        if event.facility != AudioEvent.STREAM:
+            return False
+        with self._own_writes_lock:
+            if event.event_type != AudioEvent.CHANGE:
+                if event.event_type == AudioEvent.REMOVE:
+                    self._own_writes.pop(event.index, None)
+                return False
+            pending, deadline = self._own_writes.pop(event.index, (0, 0))
+            if pending == 0 or time.monotonic() > deadline:
+                return False
+            if pending > 1:
+                self._own_writes[event.index] = (pending - 1, deadline)
+            return True
+
+    def list_streams(self) -> list[AudioStream]:
+        raise NotImplementedError
+
+    def get_stream(self, index: int) -> [AudioStream | None]:
+        for stream in self.list_streams():
+            if stream.index == index:
+                return stream
+        return None
+
+    def streams_for_pids(self, pids: set[int]) -> list[AudioStream]:
+        return [stream for stream in self.list_streams() if stream.pid in pids]
+
+    # Volumes are per channel, keyed by stream index
+    def get_stream_volumes(self, indexes: list[int]) -> dict[int, list[float]]:
+        wanted = set(indexes)
+        return {stream.index: stream.channel_volumes for stream in self.list_streams() if stream.index in wanted}
+
+    def set_stream_volumes(self, volumes: dict[int, list[float]]):
+        raise NotImplementedError
+
+    def list_outputs(self) -> list[AudioOutput]:
+        raise NotImplementedError
+
+    def default_output(self) -> AudioOutput:
+        raise NotImplementedError
+
+    def set_output_volumes(self, volumes: dict[int, list[float]]):
+        raise NotImplementedError
+
+    # Begin emitting on the changed signal
+    def start_events(self):
+        raise NotImplementedError
+
+    def stop_events(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.stop_events()
+
+
+def _stream_from_sink_input(sink_input) -> AudioStream:
+    return AudioStream(
+        sink_input.index,
+        dict(sink_input.proplist),
+        list(sink_input.volume.values),
+        bool(sink_input.corked)
+    )
+
+
+def _output_from_sink(sink) -> AudioOutput:
+    return AudioOutput(sink.index, sink.name, sink.description, list(sink.volume.values))
+
+
+class PulseBackend(AudioBackend):
+
+    def __init__(self, client_name: str = 'volume-control'):
+        super().__init__()
+        self.client_name = client_name
+        self._pulse = None
+        # pulsectl connections aren't thread safe, every call shares this one
+        self._pulse_lock = threading.RLock()
+        self._event_pulse = None
+        self._event_thread: [threading.Thread | None] = None
+
+    def _connection(self):
+        if self._pulse is None or not self._pulse.connected:
+            from pulsectl import pulsectl
+            self._pulse = pulsectl.Pulse(self.client_name)
+        return self._pulse
+
+    def list_streams(self) -> list[AudioStream]:
+        with self._pulse_lock:
+            return [_stream_from_sink_input(sink_input) for sink_input in self._connection().sink_input_list()]
+
+    def get_stream(self, index: int) -> [AudioStream | None]:
+        from pulsectl import pulsectl
+        with self._pulse_lock:
+            try:
+                return _stream_from_sink_input(self._connection().sink_input_info(index))
+            except pulsectl.PulseIndexError:
+                return None
+
+    # Every request goes out before waiting on any of the replies, one round trip for the lot instead of one each.
+    # This leans on pulsectl's internals (what its own *_volume_set methods do for a single call),
+    # so fall back to those when they aren't there.
+    # Anything that's gone away in the meantime is skipped, the same as the memory backend does.
+    def _set_volumes_pipelined(self, set_volume_op_name: str, set_volume_method_name: str,
+                               volumes: dict[int, list[float]]):
+        from pulsectl import pulsectl
+        with self._pulse_lock:
+            pulse = self._connection()
+            set_volume_op = getattr(pulsectl.c.pa, set_volume_op_name, None)
+            if set_volume_op is None or not hasattr(pulse, '_pulse_op_cb'):
+                set_volume = getattr(pulse, set_volume_method_name)
+                for index, channel_volumes in volumes.items():
+                    try:
+                        set_volume(index, pulsectl.PulseVolumeInfo(channel_volumes))
+                    except pulsectl.PulseOperationFailed:
+                        logger.info('Skipped setting the volume of %s, it has gone away', index)
+                    except Exception as e:
+                        logger.warning('Skipped setting the volume of %s: %s', index, e)
+                return
+            # Each reply is waited on by itself, so one failing doesn't stop us waiting on the rest
+            pending_replies = []
+            try:
+                for index, channel_volumes in volumes.items():
+                    try:
+                        volume_struct = pulsectl.PulseVolumeInfo(channel_volumes).to_struct()
+                    except Exception as e:
+                        logger.warning('Skipped setting the volume of %s: %s', index, e)
+                        continue
+                    pending_reply = pulse._pulse_op_cb()
+                    callback = pending_reply.__enter__()
+                    try:
+                        set_volume_op(pulse._ctx, index, volume_struct, callback, None)
+                    except Exception as e:
+                        # Never sent, so there's no reply to wait for, just let go of the callback
+                        pending_reply.__exit__(type(e), e, e.__traceback__)
+                        logger.warning('Skipped setting the volume of %s: %s', index, e)
+                        continue
+                    # Only ever waited on once the request has actually gone out
+                    pending_replies.append((index, pending_reply))
+            finally:
+                for index, pending_reply in pending_replies:
+                    try:
+                        pending_reply.__exit__(None, None, None)
+                    except pulsectl.PulseOperationFailed:
+                        logger.info('Skipped setting the volume of %s, it has gone away', index)
+
+    def set_stream_volumes(self, volumes: dict[int, list[float]]):
+        self._note_own_writes(volumes.keys())
+        self._set_volumes_pipelined('context_set_sink_input_volume', 'sink_input_volume_set', volumes)
+
+    def list_outputs(self) -> list[AudioOutput]:
+        with self._pulse_lock:
+            return [_output_from_sink(sink) for sink in self._connection().sink_list()]
+
+    def default_output(self) -> AudioOutput:
+        with self._pulse_lock:
+            return _output_from_sink(self._connection().sink_default_get())
+
+    def set_output_volumes(self, volumes: dict[int, list[float]]):
+        self._set_volumes_pipelined('context_set_sink_volume_by_index', 'sink_volume_set', volumes)
+
+    def start_events(self):
+        if self._event_thread is not None:
+            return
+        self._event_thread = threading.Thread(target=self._event_loop, name='pulse-events', daemon=True)
+        self._event_thread.start()
+
+    def stop_events(self):
+        if self._event_pulse is not None:
+            self._event_pulse.event_listen_stop()
+        self._event_thread = None
+
+    # Subscriptions block the connection they're on, so they get one of their own
+    def _event_loop(self):
+        from pulsectl import pulsectl
+        with pulsectl.Pulse(f'{self.client_name}-events') as pulse:
+            self._event_pulse = pulse
+            pulse.event_mask_set('sink_input', 'sink')
+            pulse.event_callback_set(self._pulse_event)
+            while self._event_thread is not None:
+                pulse.event_listen()
+        self._event_pulse = None
+
+    def _pulse_event(self, event):
+        # Callbacks run inside pulsectl's loop, no calls back into the connection from here.
+        # pulsectl's EnumValues only have a repr, the plain string is what's in _value
+        self.changed.emit(AudioEvent(event.facility._value, event.t._value, event.index))
+
+    def close(self):
+        super().close()
+        with self._pulse_lock:
+            if self._pulse is not None:
+                self._pulse.close()
+                self._pulse = None
+
+
+# Fake sound server, lets the volume path run (and be profiled) with no PulseAudio around
+class MemoryBackend(AudioBackend):
+
+    def __init__(self, latency: float = 0, default_output_name: str = 'memory-output'):
+        super().__init__()
+        self.latency = latency
+        self._lock = threading.RLock()
+        self._indexes = itertools.count()
+        self._streams: dict[int, AudioStream] = {}
+        self._outputs: dict[int, AudioOutput] = {}
+        self._events_enabled = False
+        default_output = self.add_output(default_output_name)
+        self._default_output_index = default_output.index
+
+    # Pretend to make a round trip to the server
+    def _call(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _emit(self, facility: str, event_type: str, index: int):
+        if self._events_enabled:
+            self.changed.emit(AudioEvent(facility, event_type, index))
+
+    def add_stream(self, pid: int, binary: str, channel_volumes: [list[float] | None] = None,
+                   corked: bool = False, **properties) -> AudioStream:
+        with self._lock:
+            index = next(self._indexes)
+            proplist = {
+                'application.process.id': str(pid),
+                'application.process.binary': binary,
+                'application.name': binary,
+                **properties
+            }
+            stream = AudioStream(index, proplist, channel_volumes or [1.0, 1.0], corked)
+            self._streams[index] = stream
+        self._emit(AudioEvent.STREAM, AudioEvent.NEW, index)
+        return stream
+
+    def remove_stream(self, index: int):
+        with self._lock:
+            self._streams.pop(index, None)
+        self._emit(AudioEvent.STREAM, AudioEvent.REMOVE, index)
+
+    def set_corked(self, index: int, corked: bool):
+        with self._lock:
+            self._streams[index].corked = corked
+        self._emit(AudioEvent.STREAM, AudioEvent.CHANGE, index)
+
+    def add_output(self, name: str, channel_volumes: [list[float] | None] = None) -> AudioOutput:
+        with self._lock:
+            index = next(self._indexes)
+            output = AudioOutput(index, name, name.replace('-', ' ').capitalize(), channel_volumes or [1.0, 1.0])
+            self._outputs[index] = output
+        self._emit(AudioEvent.OUTPUT, AudioEvent.NEW, index)
+        return output
+
+    # Fill the server with a bunch of streams, spread over a few processes each
+    def populate(self, num_of_streams: int, streams_per_process: int = 4, first_pid: int = 10000):
+        for i in range(num_of_streams):
+            pid = first_pid + i // streams_per_process
+            self.add_stream(pid, f'app-{pid}', [0.5, 0.5])
+
+    def list_streams(self) -> list[AudioStream]:
+        self._call()
+        with self._lock:
+            return [self._copy_stream(stream) for stream in self._streams.values()]
+
+    def get_stream(self, index: int) -> [AudioStream | None]:
+        self._call()
+        with self._lock:
+            stream = self._streams.get(index)
+            return None if stream is None else self._copy_stream(stream)
+
+    def set_stream_volumes(self, volumes: dict[int, list[float]]):
+        self._call()
+        with self._lock:
+            changed = [index for index in volumes if index in self._streams]
+            for index in changed:
+                self._streams[index].channel_volumes = [max(0.0, volume) for volume in volumes[index]]
+        self._note_own_writes(changed)
+        for index in volumes.keys() - set(changed):
+            logger.info('Skipped setting the volume of %s, it has gone away', index)
+        for index in changed:
+            self._emit(AudioEvent.STREAM, AudioEvent.CHANGE, index)
+
+    def list_outputs(self) -> list[AudioOutput]:
+        self._call()
+        with self._lock:
+            return [self._copy_output(output) for output in self._outputs.values()]
+
+    def default_output(self) -> AudioOutput:
+        self._call()
+        with self._lock:
+            return self._copy_output(self._outputs[self._default_output_index])
+
+    def set_output_volumes(self, volumes: dict[int, list[float]]):
+        self._call()
+        with self._lock:
+            changed = [index for index in volumes if index in self._outputs]
+            for index in changed:
+                self._outputs[index].channel_volumes = [max(0.0, volume) for volume in volumes[index]]
+        for index in volumes.keys() - set(changed):
+            logger.info('Skipped setting the volume of %s, it has gone away', index)
+        for index in changed:
+            self._emit(AudioEvent.OUTPUT, AudioEvent.CHANGE, index)
+
+    def start_events(self):
+        self._events_enabled = True
+
+    def stop_events(self):
+        self._events_enabled = False
+
+    # Callers get copies, same as they would from a real server
+    @staticmethod
+    def _copy_stream(stream: AudioStream) -> AudioStream:
+        return AudioStream(stream.index, dict(stream.proplist), list(stream.channel_volumes), stream.corked)
+
+    @staticmethod
+    def _copy_output(output: AudioOutput) -> AudioOutput:
+        return AudioOutput(output.index, output.name, output.description, list(output.channel_volumes))
+
+
+_backend_factories: dict[str, Callable[..., AudioBackend]] = {
+    PULSE_BACKEND: PulseBackend,
+    MEMORY_BACKEND: MemoryBackend,
+}
+
+_backends: dict[str, AudioBackend] = {}
+
+
+# Backends hold connections, so there's only ever one of each
+def get_backend(name: str = PULSE_BACKEND, **options) -> AudioBackend:
+    if name not in _backend_factories:
+        raise ValueError(f'Unknown Audio Backend: {name}')
+    if name not in _backends:
+        logger.info(f'Using audio backend: [{name}]')
+        _backends[name] = _backend_factories[name](**options)
+    return _backends[name]
@@ -0,0 +1,124 @@
+import copy
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any
+
+import yaml
+
+import eventcore
+import fileutils
+import generalutils
+import timer
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+
+# Holds the config in memory. Changes are batched up into one atomic write a little while after the last one,
+# and the file is only read again when something other than us edits it.
+class ConfigStore:
+
+    def __init__(self, filename: str, write_delay: float = .5):
+        self.filename = filename
+        self.changed: generalutils.Signal = generalutils.Signal[None]('config_changed')
+        self._lock = threading.RLock()
+        self._config: dict = {}
+        self._transaction_depth = 0
+        self._dirty = False
+        # Stat of the file as we last wrote/read it, so our own writes aren't mistaken for external edits
+        self._known_file_state = None
+        self._delayed_write = timer.DelayedAction(write_delay, self.flush)
+        self._watch: [fileutils.InotifyWatch | None] = None
+        self.load()
+
+    def _file_state(self):
+        try:
+            stat = os.stat(fileutils.get_full_resource_path(self.filename))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        with self._lock:
+            with fileutils.open_resource(self.filename) as config_file:
+                config = yaml.safe_load(config_file)
+            if type(config) is not dict:
+                raise ValueError(f'[{self.filename}] does not hold a config')
+            self._config = config
+            self._known_file_state = self._file_state()
+            self._dirty = False
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._config.get(section, {}).get(key, default)
+
+    def section(self, section: str) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._config.get(section, {}))
+
+    def update(self, section: str, key: str, value: Any):
+        with self._lock:
+            if self.get(section, key) == value:
+                return
+            self._config.setdefault(section, {})[key] = value
+            self._dirty = True
+            logger.debug(f'Update {section}.{key} to: {value}')
+            if self._transaction_depth == 0:
+                self._delayed_write.run()
+
+    # Several updates that should land in the file together
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._transaction_depth += 1
+            try:
+                yield self
+            finally:
+                self._transaction_depth -= 1
+                if self._transaction_depth == 0 and self._dirty:
+                    self._delayed_write.run()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            fileutils.write_resource_atomically(self.filename, yaml.safe_dump(self._config))
+            self._known_file_state = self._file_state()
+            self._dirty = False
+
+    # The watch is just another reader on the event core's loop, no thread of its own
+    def start_watching(self):
+        if self._watch is not None:
+            return
+        directory = os.path.dirname(fileutils.get_full_resource_path(self.filename))
+        self._watch = fileutils.InotifyWatch(directory)
+        eventcore.get_core().add_reader(self._watch, self._read_file_events)
+
+    def stop_watching(self):
+        if self._watch is None:
+            return
+        watch = self._watch
+        self._watch = None
+        core = eventcore.get_core()
+        core.remove_reader(watch)
+        core.post(watch.close)
+
+    def _read_file_events(self):
+        if self._watch is not None:
+            self.on_file_events(self._watch.read_changed_names())
+
+    def on_file_events(self, changed_names: set[str]):
+        if os.path.basename(self.filename) not in changed_names:
+            return
+        with self._lock:
+            if self._file_state() == self._known_file_state:
+                return
+            logger.info(f'[{self.filename}] was edited, reloading')
+            try:
+                self.load()
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                # Probably caught mid-edit, the next write will get us here again
+                logger.warning(f'Unable to reload [{self.filename}]: {e}')
+                return
+        self.changed.emit()
@@ -0,0 +1,234 @@
+import argparse
+import concurrent.futures
+import errno
+import json
+import os
+import socket
+import threading
+from typing import Callable
+
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+# Commands are sent as a single line of JSON holding a list (a batch) of commands,
+# the reply is a single line of JSON holding a list of results in the same order.
+#   {"action": "change", "delta": 0.05, "target": {"pid": 1234}}
+#   {"action": "set", "volume": 0.5, "target": {"binary": "firefox"}}
+#   {"action": "state"}
+#   {"action": "warm_up"}
+#   {"action": "stats"}
+# A target is either a control target name ('system', 'current_application'),
+# a {"pid": ...} or {"binary": ...} object, or missing for the configured target.
+CHANGE_ACTION = 'change'
+SET_ACTION = 'set'
+STATE_ACTION = 'state'
+WARM_UP_ACTION = 'warm_up'
+STATS_ACTION = 'stats'
+DUCK_ACTION = 'duck'
+UNDUCK_ACTION = 'unduck'
+
+_max_message_size = 64 * 1024
+
+
+def get_socket_path() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or _private_runtime_dir()
+    return os.path.join(runtime_dir, f'volume-control-{os.getuid()}.sock')
+
+
+# Without XDG_RUNTIME_DIR, somewhere only we can get into rather than the shared temp directory
+def _private_runtime_dir() -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    runtime_dir = os.path.join(cache_dir, 'volume-control')
+    os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+    # makedirs' mode goes through the umask, and is ignored if it was already there
+    os.chmod(runtime_dir, 0o700)
+    return runtime_dir
+
+
+# The socket is created owner only from the start, not chmod'ed after anyone could have connected
+def _bind_private(server_socket: socket.socket, socket_path: str):
+    previous_umask = os.umask(0o177)
+    try:
+        server_socket.bind(socket_path)
+    finally:
+        os.umask(previous_umask)
+
+
+def _read_line(connection: socket.socket) -> bytes:
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > _max_message_size:
+            raise ValueError('Message too large')
+    return data
+
+
+class ControlServer:
+
+    def __init__(self, command_handler: Callable[[dict], dict], socket_path: [str | None] = None):
+        self.command_handler = command_handler
+        self.socket_path = socket_path or get_socket_path()
+        self._server_socket: [socket.socket | None] = None
+        self._server_thread: [threading.Thread | None] = None
+
+    def start(self):
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            _bind_private(server_socket, self.socket_path)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or is_instance_running(self.socket_path):
+                server_socket.close()
+                raise
+            # Left over from an instance that didn't shut down cleanly
+            logger.info(f'Removing stale control socket: [{self.socket_path}]')
+            os.unlink(self.socket_path)
+            _bind_private(server_socket, self.socket_path)
+        server_socket.listen()
+        self._server_socket = server_socket
+        self._server_thread = threading.Thread(target=self._serve, name='control-server', daemon=True)
+        self._server_thread.start()
+        logger.info(f'Listening for commands on: [{self.socket_path}]')
+
+    def stop(self):
+        if self._server_socket is None:
+            return
+        server_socket = self._server_socket
+        self._server_socket = None
+        server_socket.shutdown(socket.SHUT_RDWR)
+        server_socket.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    # Connections are handled one at a time so commands apply in the order they arrive
+    def _serve(self):
+        while self._server_socket is not None:
+            try:
+                connection, _address = self._server_socket.accept()
+            except OSError:
+                return
+            with connection:
+                try:
+                    self._handle_connection(connection)
+                except (OSError, ValueError) as e:
+                    logger.warning(f'Bad control connection: {e}')
+                except Exception:
+                    # Whatever went wrong, the next connection still gets served
+                    logger.exception('Control connection failed')
+
+    def _handle_connection(self, connection: socket.socket):
+        connection.settimeout(2)
+        commands = json.loads(_read_line(connection))
+        if type(commands) is dict:
+            commands = [commands]
+        if type(commands) is not list:
+            raise ValueError(f'Expected a list of commands, got: {type(commands).__name__}')
+        results = [self.run_command(command) for command in commands]
+        connection.sendall(json.dumps(results).encode() + b'\n')
+
+    def run_command(self, command) -> dict:
+        if type(command) is not dict:
+            return {'ok': False, 'error': 'Commands must be objects'}
+        try:
+            return {'ok': True, **self.command_handler(command)}
+        except (ValueError, KeyError, TypeError, concurrent.futures.TimeoutError) as e:
+            logger.warning(f'Failed control command: {command}, {e}')
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:
+            # e.g. the audio server or the focused process going away mid command
+            logger.exception(f'Failed control command: {command}')
+            return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+
+def is_instance_running(socket_path: [str | None] = None) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        try:
+            client_socket.connect(socket_path or get_socket_path())
+            return True
+        except OSError:
+            return False
+
+
+# Returns None when there's no running instance to send to. If the instance is there but doesn't answer
+# properly, every command comes back failed rather than us starting up a second instance.
+def send_commands(commands: list[dict], socket_path: [str | None] = None, timeout: float = 2) -> [list[dict] | None]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        client_socket.settimeout(timeout)
+        try:
+            client_socket.connect(socket_path or get_socket_path())
+        except OSError:
+            return None
+        try:
+            client_socket.sendall(json.dumps(commands).encode() + b'\n')
+            results = json.loads(_read_line(client_socket))
+        except (OSError, ValueError) as e:
+            # socket.timeout is an OSError, JSONDecodeError a ValueError
+            error = f'No answer from the running instance: {type(e).__name__}: {e}'
+            return [{'ok': False, 'error': error} for _ in commands]
+        if type(results) is not list:
+            return [{'ok': False, 'error': f'Unexpected answer from the running instance: {results}'} for _ in commands]
+        return results
+
+
+# Bad JSON is reported by argparse like any other bad argument
+def _json_commands(text: str) -> list:
+    try:
+        commands = json.loads(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'not valid JSON: {e}')
+    return commands if type(commands) is list else [commands]
+
+
+def parse_arguments(argv: list[str]) -> [argparse.Namespace, list[str]]:
+    parser = argparse.ArgumentParser(description='Volume Control')
+    parser.add_argument('--up', action='store_true', help='Raise the volume by the configured tick')
+    parser.add_argument('--down', action='store_true', help='Lower the volume by the configured tick')
+    parser.add_argument('--change', type=float, help='Change the volume by this amount (-1 to 1)')
+    parser.add_argument('--set', type=float, help='Set the volume to this value (0 to 1)')
+    parser.add_argument('--pid', type=int, help='Target the audio of this process')
+    parser.add_argument('--binary', help='Target the audio of processes with this binary name')
+    parser.add_argument('--target', help='Target a control target, e.g. system or current_application')
+    parser.add_argument('--duck', action='store_true', help='Lower everything except the focused application')
+    parser.add_argument('--unduck', action='store_true', help='Put back whatever --duck lowered')
+    parser.add_argument('--query', action='store_true', help='Print the state of the running instance')
+    parser.add_argument('--stats', action='store_true', help='Print diagnostics from the running instance')
+    parser.add_argument('--warm-up', action='store_true', help='Reconnect the volume path, e.g. after resume')
+    parser.add_argument('--commands', type=_json_commands, help='A JSON list of commands to send as one batch')
+    parser.add_argument('--headless', action='store_true', help='Run without any UI, only the hotkeys')
+    parser.add_argument('--startup-timing', action='store_true', help='Log how long each part of startup took')
+    # Anything we don't know about is left for Qt
+    return parser.parse_known_args(argv)
+
+
+def commands_from_arguments(arguments: argparse.Namespace) -> list[dict]:
+    if arguments.commands is not None:
+        return arguments.commands
+    if arguments.pid is not None:
+        target = {'pid': arguments.pid}
+    elif arguments.binary is not None:
+        target = {'binary': arguments.binary}
+    else:
+        target = arguments.target
+    commands = []
+    if arguments.up:
+        commands.append({'action': CHANGE_ACTION, 'direction': 1, 'target': target})
+    if arguments.down:
+        commands.append({'action': CHANGE_ACTION, 'direction': -1, 'target': target})
+    if arguments.change is not None:
+        commands.append({'action': CHANGE_ACTION, 'delta': arguments.change, 'target': target})
+    if arguments.set is not None:
+        commands.append({'action': SET_ACTION, 'volume': arguments.set, 'target': target})
+    if arguments.duck:
+        commands.append({'action': DUCK_ACTION})
+    if arguments.unduck:
+        commands.append({'action': UNDUCK_ACTION})
+    if arguments.warm_up:
+        commands.append({'action': WARM_UP_ACTION})
+    if arguments.query:
+        commands.append({'action': STATE_ACTION})
+    if arguments.stats:
+        commands.append({'action': STATS_ACTION})
+    return commands
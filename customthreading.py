@@ -1,20 +1,113 @@
-from threading import Thread
-from typing import Generic, T
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable
 
+from loggingutils import get_logger
 
-# With thanks to:
-# https://medium.com/@birenmer/threading-the-needle-returning-values-from-python-threads-with-ease-ace21193c148
-class ReturningThread(Thread):
+logger = get_logger(__file__)
 
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs={}):
-        super().__init__(group, target, name, args, kwargs)
-        self._target = target
-        self._return = None
+DEFAULT_WORKERS = 4
 
-    def run(self):
-        if self._target is not None:
-            self._return = self._target(*self._args, **self._kwargs)
 
-    def join(self, **kwargs) -> Generic[T]:
-        super().join()
-        return self._return
+# How long tasks with the same name spent waiting for a worker and then running
+class TaskStats:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def record(self, wait: float, run: float, failed: bool):
+        self.completed += 1
+        if failed:
+            self.failed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += run
+        self.max_run = max(self.max_run, run)
+
+    def as_dict(self) -> dict:
+        completed = max(self.completed, 1)
+        return {
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'avg_wait_ms': round(self.total_wait / completed * 1000, 3),
+            'max_wait_ms': round(self.max_wait * 1000, 3),
+            'avg_run_ms': round(self.total_run / completed * 1000, 3),
+            'max_run_ms': round(self.max_run * 1000, 3),
+        }
+
+
+# The one place blocking work (PulseAudio, X, psutil, file I/O) gets done, on a fixed number of threads
+class AppExecutor:
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, name: str = 'worker'):
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._stats: dict[str, TaskStats] = {}
+        self._stats_lock = threading.Lock()
+
+    def _task_stats(self, task_name: str) -> TaskStats:
+        with self._stats_lock:
+            if task_name not in self._stats:
+                self._stats[task_name] = TaskStats(task_name)
+            return self._stats[task_name]
+
+    def submit(self, func: Callable, *args, task_name: [str | None] = None, **kwargs) -> Future:
+        task_name = task_name or getattr(func, '__name__', 'task')
+        submitted = time.perf_counter()
+
+        def timed_task():
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._task_stats(task_name).record(started - submitted, time.perf_counter() - started, failed)
+
+        future = self._pool.submit(timed_task)
+        future.add_done_callback(lambda f: self._task_done(task_name, f))
+        return future
+
+    def _task_done(self, task_name: str, future: Future):
+        if future.cancelled():
+            self._task_stats(task_name).cancelled += 1
+        elif future.exception() is not None:
+            logger.error(f'Task [{task_name}] failed', exc_info=future.exception())
+
+    # Run on the pool and wait for the answer, cancelling it if it takes too long
+    def run(self, func: Callable, *args, timeout: [float | None] = None, task_name: [str | None] = None, **kwargs) -> Any:
+        future = self.submit(func, *args, task_name=task_name, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def stats(self) -> dict[str, dict]:
+        with self._stats_lock:
+            return {name: task_stats.as_dict() for name, task_stats in self._stats.items()}
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+_executor: [AppExecutor | None] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> AppExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = AppExecutor()
+        return _executor
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+
+import customthreading
+import generalutils
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+
+# A timer that can be cancelled from any thread
+class CoreTimer:
+
+    def __init__(self, core: 'EventCore'):
+        self._core = core
+        self._handle: [asyncio.TimerHandle | None] = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self._handle is not None:
+            self._core.post(self._handle.cancel)
+
+
+# The one asyncio loop everything event driven goes through: audio server events, focus changes,
+# file watches and timers. Other threads (input hooks, Qt, the control socket) only ever post into it.
+# Anything that changes volume runs through run_serialized, one request after another, so nothing
+# in there has to lock against anything else.
+# Qt keeps its own loop on the main thread, results go back to it through Qt signals (see ui.VolumeBar).
+class EventCore:
+
+    def __init__(self, executor: [customthreading.AppExecutor | None] = None):
+        self.executor = executor or customthreading.get_executor()
+        self.loop = asyncio.new_event_loop()
+        self._thread: [threading.Thread | None] = None
+        self._serialized_requests = asyncio.Queue()
+        self._serialized_worker: [asyncio.Task | None] = None
+        # Both always emitted on the core's thread
+        self.audio_events: generalutils.Signal = generalutils.Signal('core_audio_events')
+        self.focus_changed: generalutils.Signal = generalutils.Signal('core_focus_changed')
+        self._focus_watcher = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run_loop, name='event-core', daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._serialized_worker = self.loop.create_task(self._run_serialized_requests())
+        self.loop.run_forever()
+        self._serialized_worker.cancel()
+        self.loop.run_until_complete(asyncio.gather(self._serialized_worker, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def is_core_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def post(self, func: Callable, *args):
+        if self.is_core_thread():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def call_later(self, delay: float, func: Callable, *args) -> CoreTimer:
+        timer = CoreTimer(self)
+
+        def fire():
+            if not timer.cancelled:
+                func(*args)
+
+        def schedule():
+            if not timer.cancelled:
+                timer._handle = self.loop.call_later(delay, fire)
+
+        self.post(schedule)
+        return timer
+
+    def add_reader(self, fileobj, callback: Callable):
+        self.post(self.loop.add_reader, fileobj, callback)
+
+    def remove_reader(self, fileobj):
+        self.post(self.loop.remove_reader, fileobj)
+
+    # Server events arrive on the backend's own thread, they're handed over to be handled here
+    def attach_audio_backend(self, backend):
+        backend.changed.connect(lambda event: self.post(self.audio_events.emit, event))
+        backend.start_events()
+
+    def watch_focus(self):
+        import windowutils
+        try:
+            self._focus_watcher = windowutils.FocusWatcher(self.focus_changed.emit)
+        except Exception as e:
+            # Not fatal, the volume path asks X for the active window itself
+            logger.warning(f'Unable to watch window focus: {e}')
+            return
+        self.post(self._focus_watcher.refresh)
+        self.add_reader(self._focus_watcher, self._focus_watcher.handle_pending_events)
+
+    # Queue up func to run on the executor after every request before it has finished
+    def run_serialized(self, func: Callable, *args, task_name: [str | None] = None) -> Future:
+        result_future = Future()
+        self.post(self._serialized_requests.put_nowait, (func, args, task_name, result_future))
+        return result_future
+
+    async def _run_serialized_requests(self):
+        while True:
+            func, args, task_name, result_future = await self._serialized_requests.get()
+            if not result_future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = await asyncio.wrap_future(self.executor.submit(func, *args, task_name=task_name))
+            except Exception as e:
+                result_future.set_exception(e)
+            else:
+                result_future.set_result(result)
+
+
+_core: [EventCore | None] = None
+_core_lock = threading.Lock()
+
+
+def get_core() -> EventCore:
+    global _core
+    with _core_lock:
+        if _core is None:
+            _core = EventCore()
+            _core.start()
+        return _core
+
+
+def run_in_core(func: Callable, *args, timeout: [float | None] = None) -> Any:
+    return get_core().run_serialized(func, *args).result(timeout=timeout)
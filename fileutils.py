@@ -1,4 +1,8 @@
+import ctypes
+import ctypes.util
 import os
+import struct
+import tempfile
 
 from typing import TextIO
 
@@ -29,3 +33,70 @@ def invalidate_resource(file: str):
     updated_filename = f'{resource_path}.invalid'
     logger.info(f'Invalidating resource: [{file.split("/")[-1]}], renaming to [{updated_filename.split("/")[-1]}]')
     os.rename(resource_path, updated_filename)
+
+
+# Write to a temp file next to the real one, then rename it over the top.
+# A crash at any point leaves either the old or the new file, never half of one.
+def write_resource_atomically(file: str, contents: str):
+    resource_path = get_full_resource_path(file)
+    directory, filename = os.path.split(resource_path)
+    temp_fd, temp_path = tempfile.mkstemp(prefix=f'.{filename}.', dir=directory)
+    try:
+        with os.fdopen(temp_fd, 'w') as temp_file:
+            temp_file.write(contents)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, resource_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    # Make sure the rename itself survives a crash
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+    logger.debug(f'Wrote: {resource_path}')
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_inotify_event_header = struct.Struct('iIII')
+
+
+# Bare bones inotify over ctypes, watches a directory and reports the names of files in it that changed
+class InotifyWatch:
+
+    def __init__(self, directory: str, mask: int = IN_CLOSE_WRITE | IN_MOVED_TO):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(directory), ctypes.c_uint32(mask)) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f'inotify_add_watch failed for: {directory}')
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def read_changed_names(self) -> set[str]:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _wd, _mask, _cookie, name_length = _inotify_event_header.unpack_from(data, offset)
+            offset += _inotify_event_header.size
+            names.add(os.fsdecode(data[offset:offset + name_length].rstrip(b'\0')))
+            offset += name_length
+        return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
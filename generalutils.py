@@ -24,3 +24,4 @@ class Signal(Generic[T]):
 class ControlTarget(enum.Enum):
     SYSTEM = 'system'
     CURRENT_APPLICATION = 'current_application'
+    SYSTEM_GROUP = 'system_group'
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+
+import eventcore
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+_clock_ticks = os.sysconf('SC_CLK_TCK')
+
+# Thread name prefixes -> what they're there for
+_thread_categories = [
+    ('keybind', 'listener'),
+    ('event-core', 'timer'),
+    ('worker', 'worker'),
+    ('pulse-events', 'audio-events'),
+    ('control-server', 'control'),
+    ('log-writer', 'logging'),
+    ('ui-channel', 'ui-channel'),
+    ('profiler', 'profiler'),
+    ('level-meter', 'level-meter'),
+    # The VolumeBar's hide timer runs on the Qt (main) thread
+    ('MainThread', 'gui/hide'),
+]
+
+
+def thread_category(thread_name: str) -> str:
+    for prefix, category in _thread_categories:
+        if thread_name.startswith(prefix):
+            return category
+    return 'other'
+
+
+class ThreadSample:
+
+    def __init__(self, tid: int, cpu_seconds: float, context_switches: int):
+        self.tid = tid
+        self.cpu_seconds = cpu_seconds
+        self.context_switches = context_switches
+
+
+def _read_thread_sample(tid: int) -> [ThreadSample | None]:
+    try:
+        with open(f'/proc/self/task/{tid}/stat') as stat_file:
+            # Skip past the (name), which can hold spaces
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        context_switches = 0
+        with open(f'/proc/self/task/{tid}/status') as status_file:
+            for line in status_file:
+                if line.startswith(('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches')):
+                    context_switches += int(line.split()[1])
+    except (OSError, IndexError, ValueError):
+        # Thread went away while we were looking
+        return None
+    # utime and stime, fields 14 and 15 of stat
+    return ThreadSample(tid, (int(fields[11]) + int(fields[12])) / _clock_ticks, context_switches)
+
+
+def sample_threads() -> dict[int, ThreadSample]:
+    samples = {}
+    for tid in os.listdir('/proc/self/task'):
+        sample = _read_thread_sample(int(tid))
+        if sample is not None:
+            samples[sample.tid] = sample
+    return samples
+
+
+# Keeps an eye on how much CPU and how many wakeups each kind of thread costs us,
+# complaining when we're burning through either while nobody is touching the volume.
+class IdleMonitor:
+
+    def __init__(self,
+                 interval: float = 30,
+                 idle_after: float = 10,
+                 cpu_budget: float = .002,
+                 wakeup_budget: float = 5):
+        self.interval = interval
+        self.idle_after = idle_after
+        # Fraction of a core, and wakeups (context switches) per second
+        self.cpu_budget = cpu_budget
+        self.wakeup_budget = wakeup_budget
+        self.last_activity = time.monotonic()
+        self._last_samples: dict[int, ThreadSample] = {}
+        self._last_sample_time = 0.0
+        self._last_report: dict = {}
+        self._timer: [eventcore.CoreTimer | None] = None
+        self.regressions = 0
+
+    # Something was supposed to happen (e.g. a volume key), so this period doesn't count as idle
+    def note_activity(self):
+        self.last_activity = time.monotonic()
+
+    def start(self):
+        self._take_baseline()
+        self._schedule()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule(self):
+        self._timer = eventcore.get_core().call_later(self.interval, self._sample)
+
+    def _take_baseline(self):
+        self._last_samples = sample_threads()
+        self._last_sample_time = time.monotonic()
+
+    def _sample(self):
+        try:
+            self._last_report = self.measure()
+            self._check_budget(self._last_report)
+        finally:
+            self._schedule()
+
+    def measure(self) -> dict:
+        now = time.monotonic()
+        elapsed = max(now - self._last_sample_time, 1e-6)
+        samples = sample_threads()
+        thread_names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        categories: dict[str, dict] = {}
+        for tid, sample in samples.items():
+            previous = self._last_samples.get(tid)
+            cpu = sample.cpu_seconds - (previous.cpu_seconds if previous else 0)
+            switches = sample.context_switches - (previous.context_switches if previous else 0)
+            category = thread_category(thread_names.get(tid, ''))
+            totals = categories.setdefault(category, {'threads': 0, 'cpu_percent': 0.0, 'wakeups_per_second': 0.0})
+            totals['threads'] += 1
+            totals['cpu_percent'] += cpu / elapsed * 100
+            totals['wakeups_per_second'] += switches / elapsed
+        for totals in categories.values():
+            totals['cpu_percent'] = round(totals['cpu_percent'], 3)
+            totals['wakeups_per_second'] = round(totals['wakeups_per_second'], 2)
+        report = {
+            'idle': now - self.last_activity >= self.idle_after + elapsed,
+            'seconds': round(elapsed, 1),
+            'cpu_percent': round(sum(totals['cpu_percent'] for totals in categories.values()), 3),
+            # /proc/self/status only counts the main thread's switches, so it's the sum over every thread
+            'wakeups_per_second': round(sum(totals['wakeups_per_second'] for totals in categories.values()), 2),
+            'threads': categories,
+        }
+        self._last_samples = samples
+        self._last_sample_time = now
+        return report
+
+    def _check_budget(self, report: dict):
+        # Only whole periods with nothing going on count
+        if not report['idle']:
+            return
+        over_cpu = report['cpu_percent'] > self.cpu_budget * 100
+        over_wakeups = report['wakeups_per_second'] > self.wakeup_budget
+        if not (over_cpu or over_wakeups):
+            return
+        self.regressions += 1
+        worst = sorted(report['threads'].items(), key=lambda item: item[1]['wakeups_per_second'], reverse=True)
+        logger.warning('Idle budget exceeded: %s%% CPU, %s wakeups/s, by thread: %s',
+                       report['cpu_percent'], report['wakeups_per_second'],
+                       ', '.join(f'{category}: {totals["cpu_percent"]}% {totals["wakeups_per_second"]}/s'
+                                 for category, totals in worst))
+
+    def report(self) -> dict:
+        return {**self._last_report, 'idle_regressions': self.regressions}
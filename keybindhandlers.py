@@ -1,13 +1,14 @@
-import time
+import threading
 from dataclasses import dataclass
 from enum import Enum
-from typing import Callable
+from typing import Callable, Iterable
 
 import jsonpickle
 from pynput import keyboard, mouse
 from pynput.keyboard import KeyCode, Key
 from pynput.mouse import Button
 
+import eventcore
 import fileutils
 import keybindutils
 from loggingutils import get_logger
@@ -35,6 +36,8 @@ MODIFIER_KEY_CODES = set(keybindutils.get_virtual_key_code(key) for key in Key)
 
 logger = get_logger(__file__)
 
+PYNPUT_INPUT = 'pynput'
+
 
 def _convert_to_serializable_key(key: [Key | KeyCode]):
     code = keybindutils.get_virtual_key_code(key)
@@ -43,14 +46,74 @@ def _convert_to_serializable_key(key: [Key | KeyCode]):
     return SerializableKey(code, name, is_modifier)
 
 
-@dataclass
+# Every key code gets its own bit the first time it's seen, so a set of held keys is a single int
+_key_bits: dict[int, int] = {}
+_key_bits_lock = threading.Lock()
+
+
+def key_bit(code: int) -> int:
+    bit = _key_bits.get(code)
+    if bit is None:
+        with _key_bits_lock:
+            bit = _key_bits.setdefault(code, 1 << len(_key_bits))
+    return bit
+
+
+def key_mask(codes: Iterable[int]) -> int:
+    mask = 0
+    for code in codes:
+        mask |= key_bit(code)
+    return mask
+
+
+# Mouse actions share the terminal code with keys, key codes are all positive
+# and scrolling is X's buttons 4 and 5
+NO_TERMINAL = 0
+SCROLL_UP_CODE = -4
+SCROLL_DOWN_CODE = -5
+
+
+# What a binding boils down to, the held modifiers and the one key or mouse action that finishes it,
+# compared and hashed as plain ints
+class KeyChord:
+    __slots__ = ('modifiers', 'terminal', '_hash')
+
+    def __init__(self, modifiers: int, terminal: int = NO_TERMINAL):
+        object.__setattr__(self, 'modifiers', modifiers)
+        object.__setattr__(self, 'terminal', terminal)
+        object.__setattr__(self, '_hash', hash((modifiers, terminal)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, KeyChord):
+            return NotImplemented
+        return self.modifiers == other.modifiers and self.terminal == other.terminal
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f'KeyChord(modifiers={self.modifiers:#x}, terminal={self.terminal})'
+
+
 class SerializableKey:
+    __slots__ = ('code', 'name', 'is_modifier')
 
     def __init__(self, code: int, name: str, is_modifier: bool):
         self.code = code
         self.name = name
         self.is_modifier = is_modifier
 
+    def __eq__(self, other):
+        if not isinstance(other, SerializableKey):
+            return NotImplemented
+        return self.code == other.code
+
+    def __hash__(self):
+        return hash(self.code)
+
     def __str__(self):
         return f'[{self.name}, {self.code}, Modifier: {self.is_modifier}]'
 
@@ -58,8 +121,8 @@ class SerializableKey:
         return self.__str__()
 
 
-@dataclass
 class SerializableMouseButton(SerializableKey):
+    __slots__ = ()
 
     def __init__(self, code: int, name: str):
         super().__init__(code, name, False)
@@ -71,13 +134,29 @@ class Scroll(Enum):
     UP = 'WheelUp'
 
 
-@dataclass
+def mouse_button_code(button: [Button | SerializableKey]) -> int:
+    if isinstance(button, SerializableKey):
+        return -button.code
+    return -button.value if isinstance(button.value, int) else -hash(button.value)
+
+
+def scroll_code(scroll: Scroll) -> int:
+    return SCROLL_UP_CODE if scroll is Scroll.UP else SCROLL_DOWN_CODE
+
+
 class SerializableMouseAction:
+    __slots__ = ('button', 'scroll')
 
-    def __init__(self, button: [SerializableMouseButton | None] = None, scroll: [Scroll | None] = None):
+    def __init__(self, button: [SerializableMouseButton | Button | None] = None, scroll: [Scroll | None] = None):
         self.button = button
         self.scroll = scroll
 
+    @property
+    def code(self) -> int:
+        if self.button is None:
+            return scroll_code(self.scroll)
+        return mouse_button_code(self.button)
+
     def __str__(self):
         if self.button is None:
             return f'Mouse{self.scroll.value}'
@@ -85,8 +164,8 @@ class SerializableMouseAction:
             return f'Mouse{self.button.name.capitalize()}'
 
 
-@dataclass
 class Binding:
+    __slots__ = ('keys', 'key_codes', 'mouse_action', 'has_mouse_action', '_chord')
 
     def __init__(self, keys: list[SerializableKey], mouse_action: [SerializableMouseAction | None] = None):
         self.keys = keys
@@ -94,32 +173,47 @@ class Binding:
         self.mouse_action: [SerializableMouseAction | None] = mouse_action
         self.has_mouse_action: bool = mouse_action is not None
 
-    def is_active(self,
-                  keys_pressed: set[Key | KeyCode],
-                  mouse_button_pressed: [Button | None] = None,
-                  scroll: [Scroll | None] = None):
-        pressed_key_codes = keybindutils.convert_to_vks(keys_pressed)
-        all_keys_are_pressed = pressed_key_codes == self.key_codes
-
-        # This is just written out like this for my silly human brain :3
-        mouse_is_pressed = mouse_button_pressed is not None
-        mouse_is_scrolled = scroll is not None
-        keys_only = not (mouse_is_pressed or mouse_is_scrolled)
-
-        if keys_only:
-            return all_keys_are_pressed
-        else:
-            if self.has_mouse_action:
-                if mouse_is_pressed:
-                    mouse_action_done = mouse_button_pressed.value == self.mouse_action.button.code
-                else:
-                    mouse_action_done = scroll is self.mouse_action.scroll
-            else:
-                mouse_action_done = False
-            return all_keys_are_pressed and mouse_action_done
+    # The chord is worked out again after loading rather than saved, only what's needed to rebuild it is written
+    def __getstate__(self):
+        return {
+            'keys': self.keys,
+            'key_codes': self.key_codes,
+            'mouse_action': self.mouse_action,
+            'has_mouse_action': self.has_mouse_action
+        }
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def chord(self) -> KeyChord:
+        try:
+            return self._chord
+        except AttributeError:
+            self._chord = self._build_chord()
+            return self._chord
+
+    def _build_chord(self) -> KeyChord:
+        if self.mouse_action is not None:
+            return KeyChord(key_mask(self.key_codes), self.mouse_action.code)
+        terminal_keys = [key for key in self.keys if not key.is_modifier]
+        if len(terminal_keys) == 0:
+            return KeyChord(key_mask(self.key_codes))
+        # The collector always finishes with the terminal key, anything else held goes in with the modifiers
+        terminal = terminal_keys[-1].code
+        return KeyChord(key_mask(code for code in self.key_codes if code != terminal), terminal)
+
+    def is_active(self, chord: KeyChord) -> bool:
+        return chord == self.chord
 
     def __eq__(self, other):
-        return self.__str__() == other.__str__()
+        if not isinstance(other, Binding):
+            return NotImplemented
+        return self.chord == other.chord
+
+    def __hash__(self):
+        return hash(self.chord)
 
     def __str__(self):
         key_names = [key.name for key in self.keys]
@@ -130,20 +224,32 @@ class Binding:
             return f'{keys_pressed_string} + {self.mouse_action}'
 
 
-@dataclass
+# The chord for what pynput reports, the same as the X11 backends work out: a modifier just pressed
+# goes in with the rest of the held keys, anything else finishes the chord off
+def pressed_chord(keys_pressed: set[Key | KeyCode],
+                  last_key: [Key | KeyCode | None] = None,
+                  mouse_button: [Button | None] = None,
+                  scroll: [Scroll | None] = None) -> KeyChord:
+    held_codes = keybindutils.convert_to_vks(keys_pressed)
+    if mouse_button is not None:
+        return KeyChord(key_mask(held_codes), mouse_button_code(mouse_button))
+    if scroll is not None:
+        return KeyChord(key_mask(held_codes), scroll_code(scroll))
+    if last_key is None or keybindutils.is_modifier_key(last_key):
+        return KeyChord(key_mask(held_codes))
+    last_code = keybindutils.get_virtual_key_code(last_key)
+    return KeyChord(key_mask(code for code in held_codes if code != last_code), last_code)
+
+
 class BindingGroup:
+    __slots__ = ('bindings', 'name')
 
     def __init__(self, bindings: list[Binding], name: str):
         self.bindings = bindings
         self.name = name
 
-    def is_active(self,
-                  keys: set[Key | KeyCode],
-                  mouse_button: [Button | None] = None,
-                  scroll: [Scroll | None] = None):
-        for binding in self.bindings:
-            if binding.is_active(keys, mouse_button, scroll):
-                return True
+    def is_active(self, chord: KeyChord) -> bool:
+        return any(binding.is_active(chord) for binding in self.bindings)
 
 
 class BoundAction:
@@ -153,114 +259,202 @@ class BoundAction:
         self.action: Callable = action
 
 
-class KeybindCollector:
+# One request for the next chord, finished at most once by the chord itself, a cancel or the timeout
+class _KeybindCapture:
 
-    def __init__(self):
-        self.key_listener = keyboard.Listener(on_press=self._key_pressed, on_release=self._key_released, suppress=True)
-        self.mouse_listener = mouse.Listener(on_click=self._mouse_clicked, on_scroll=self._mouse_scrolled)
-        self.modifiers_pressed: set[Key | KeyCode] = set()
-        self.terminal_key: [Key | KeyCode] = None
-        self.terminal_mouse_action: [Button | Scroll] = None
-        self.keybind_complete = False
+    def __init__(self, on_captured: Callable[[Binding | None], None]):
+        self.on_captured = on_captured
+        self.timer: [eventcore.CoreTimer | None] = None
 
-    def _key_pressed(self, key: [Key | KeyCode]):
-        if not keybindutils.is_modifier_key(key):
-            self.terminal_key = key
-            self.keybind_complete = True
-        else:
-            self.modifiers_pressed.add(key)
 
-    def _key_released(self, key: [Key | KeyCode]):
-        if self.keybind_complete:
-            return
-        if key in self.modifiers_pressed:
-            self.modifiers_pressed.remove(key)
-        else:
-            logger.warning(f'Unknown key: {key} released, cleared all keys')
-            self.modifiers_pressed.clear()
+# Where a KeybindListener's input comes from. Backends either hand over every key and mouse event
+# (key_pressed, mouse_clicked, ...) or, if they only ever see the bound chords, just those (chord_pressed).
+class InputBackend:
+    # Follows the active window itself, the event core doesn't need to
+    watches_focus = False
 
-    def _mouse_clicked(self, _x, _y, button: Button, pressed):
-        if len(self.modifiers_pressed) == 0:
-            return
-        if pressed and button not in [Button.left, Button.right]:
-            self.terminal_mouse_action = button
-            self.keybind_complete = True
+    def __init__(self, listener: 'KeybindListener'):
+        self.listener = listener
 
-    def _mouse_scrolled(self, _x, _y, _dx, dy):
-        if len(self.modifiers_pressed) == 0:
-            return
-        if dy > 0:
-            self.terminal_mouse_action = Scroll.UP
-        else:
-            self.terminal_mouse_action = Scroll.DOWN
-        self.keybind_complete = True
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def is_running(self) -> bool:
+        raise NotImplementedError
+
+    # The listener's bindings are different now
+    def bindings_changed(self):
+        pass
+
+    # The listener started or stopped waiting on a chord to capture, every event is wanted while it waits
+    def capture_changed(self, capturing: bool):
+        pass
+
+
+# pynput's global hooks, every key and mouse event on the system comes through here
+class PynputInputBackend(InputBackend):
 
-    def collect_keybind(self):
+    def __init__(self, listener: 'KeybindListener'):
+        super().__init__(listener)
+        self.key_listener = keyboard.Listener(
+            on_press=listener.key_pressed,
+            on_release=listener.key_released,
+            suppress=False)
+        self.mouse_listener = mouse.Listener(
+            on_click=listener.mouse_clicked,
+            on_scroll=listener.mouse_scrolled,
+            suppress=False)
+        # Named so their CPU time and wakeups can be told apart from everything else
+        self.key_listener.name = 'keybind-keyboard'
+        self.mouse_listener.name = 'keybind-mouse'
+
+    def start(self):
         self.key_listener.start()
         self.mouse_listener.start()
-        while not self.keybind_complete:
-            time.sleep(.1)
-        self.mouse_listener.stop()
+
+    def stop(self):
         self.key_listener.stop()
-        if self.terminal_mouse_action is not None:
-            if type(self.terminal_mouse_action) is Button:
-                mouse_action = SerializableMouseAction(button=self.terminal_mouse_action)
-            else:
-                mouse_action = SerializableMouseAction(scroll=self.terminal_mouse_action)
-        else:
-            mouse_action = None
-        all_keys = [*self.modifiers_pressed]
-        print(
-            f'Collected\n Modifiers: {self.modifiers_pressed}, Terminator: {self.terminal_key}, Mouse: {self.terminal_mouse_action}')
-        if self.terminal_key is not None:
-            all_keys.append(self.terminal_key)
-        pressed_keys = [_convert_to_serializable_key(key) for key in all_keys]
-        return Binding(pressed_keys, mouse_action)
+        self.mouse_listener.stop()
+
+    def is_running(self) -> bool:
+        return self.key_listener.is_alive() and self.mouse_listener.is_alive()
 
 
 class KeybindListener:
 
-    def __init__(self, bound_actions: list[BoundAction]):
+    def __init__(self,
+                 bound_actions: list[BoundAction],
+                 input_backend: Callable[['KeybindListener'], InputBackend] = PynputInputBackend):
         self.bound_actions = bound_actions
-        self.key_listener = keyboard.Listener(
-            on_press=self._key_pressed,
-            on_release=self._key_released,
-            suppress=False)
-        self.mouse_listener = mouse.Listener(
-            on_click=self._mouse_clicked,
-            on_scroll=self._mouse_scrolled,
-            suppress=False)
+        self._actions_by_chord = self._index_actions(bound_actions)
         self.keys_pressed = set()
         self.prev_keys_pressed = set()
         self.mouse_button_pressed: [Button | None] = None
         self.mouse_scroll: [Scroll | None] = None
+        # While set, the next complete chord goes here instead of firing any bindings
+        self._capture: [_KeybindCapture | None] = None
+        self._capture_lock = threading.Lock()
+        self.input_backend = input_backend(self)
+
+    @staticmethod
+    def _index_actions(bound_actions: list[BoundAction]) -> dict[KeyChord, list[Callable]]:
+        actions_by_chord = {}
+        for bound_action in bound_actions:
+            for binding in bound_action.binding_group.bindings:
+                actions_by_chord.setdefault(binding.chord, []).append(bound_action.action)
+        return actions_by_chord
+
+    # From backends that only see the bound chords, already matched down to ints
+    def chord_pressed(self, chord: KeyChord):
+        if self._capture is not None:
+            return
+        for action in self._actions_by_chord.get(chord, ()):
+            action()
 
-    def _key_pressed(self, key: [Key | KeyCode]):
+    def key_pressed(self, key: [Key | KeyCode]):
         self.keys_pressed.add(key)
+        if self._capture is not None:
+            self._capture_key(key)
+            return
         # Only activate when the number of keys pressed changes (prevent key repetition)
         if self.keys_pressed != self.prev_keys_pressed:
             self.prev_keys_pressed = self.keys_pressed.copy()
-            self._try_binding()
+            self._try_binding(pressed_chord(self.keys_pressed, last_key=key))
 
-    def _mouse_scrolled(self, _x, _y, _dx, dy):
-        self.mouse_scroll = Scroll.DOWN if dy < 0 else Scroll.UP
-        self._try_binding()
+    def mouse_scrolled(self, _x, _y, _dx, dy):
+        scroll = Scroll.DOWN if dy < 0 else Scroll.UP
+        if self._capture is not None:
+            self._capture_mouse_action(SerializableMouseAction(scroll=scroll))
+            return
+        self.mouse_scroll = scroll
+        self._try_binding(pressed_chord(self.keys_pressed, scroll=scroll))
         self.mouse_scroll = None
 
-    def _mouse_clicked(self, _x, _y, button, pressed):
+    def mouse_clicked(self, _x, _y, button, pressed):
         if button not in (Button.left, Button.right):
             if pressed:
+                if self._capture is not None:
+                    self._capture_mouse_action(SerializableMouseAction(button=button))
+                    return
                 self.mouse_button_pressed = button
-                self._try_binding()
+                self._try_binding(pressed_chord(self.keys_pressed, mouse_button=button))
             else:
                 self.mouse_button_pressed = None
 
-    def _try_binding(self):
-        for bound_action in self.bound_actions:
-            if bound_action.binding_group.is_active(self.keys_pressed, self.mouse_button_pressed, self.mouse_scroll):
-                bound_action.action()
+    def _held_modifiers(self, except_key: [Key | KeyCode | None] = None) -> list[Key | KeyCode]:
+        return [key for key in self.keys_pressed if key != except_key and keybindutils.is_modifier_key(key)]
+
+    def _capture_key(self, key: [Key | KeyCode]):
+        if keybindutils.is_modifier_key(key):
+            return
+        modifiers = self._held_modifiers(except_key=key)
+        # Escape on its own backs out rather than becoming the binding
+        if key == Key.esc and len(modifiers) == 0:
+            self._finish_capture(None)
+            return
+        self._finish_capture(Binding([_convert_to_serializable_key(held) for held in [*modifiers, key]]))
+
+    def _capture_mouse_action(self, mouse_action: SerializableMouseAction):
+        # A bare click or scroll is just someone using their mouse
+        modifiers = self._held_modifiers()
+        if len(modifiers) == 0:
+            return
+        self._finish_capture(Binding([_convert_to_serializable_key(held) for held in modifiers], mouse_action))
+
+    # Hands the next complete chord to on_captured (on the listener's thread) instead of firing bindings.
+    # on_captured gets None if the capture is cancelled or times out, call the returned function to cancel.
+    def capture_next(self, on_captured: Callable[[Binding | None], None], timeout: [float | None] = None) -> Callable:
+        capture = _KeybindCapture(on_captured)
+        with self._capture_lock:
+            previous = self._capture
+            self._capture = capture
+        if previous is not None:
+            self._finish_capture(None, previous)
+        else:
+            self.input_backend.capture_changed(True)
+        if timeout is not None:
+            capture.timer = eventcore.get_core().call_later(timeout, self._finish_capture, None, capture)
+        return lambda: self._finish_capture(None, capture)
+
+    def cancel_capture(self):
+        self._finish_capture(None)
+
+    def _finish_capture(self, binding: [Binding | None], capture: [_KeybindCapture | None] = None):
+        with self._capture_lock:
+            if capture is None:
+                capture = self._capture
+            # Already finished one way or another
+            if capture is None or capture.on_captured is None:
+                return
+            still_capturing = capture is not self._capture
+            if not still_capturing:
+                self._capture = None
+            on_captured = capture.on_captured
+            capture.on_captured = None
+        if not still_capturing:
+            self.input_backend.capture_changed(False)
+        if capture.timer is not None:
+            capture.timer.cancel()
+        if binding is not None:
+            logger.info(f'Captured keybind: {binding}')
+        on_captured(binding)
+
+    def update_bound_actions(self, bound_actions: list[BoundAction]):
+        self.bound_actions = bound_actions
+        self._actions_by_chord = self._index_actions(bound_actions)
+        self.input_backend.bindings_changed()
+
+    def is_running(self) -> bool:
+        return self.input_backend.is_running()
 
-    def _key_released(self, key: [Key | KeyCode]):
+    def _try_binding(self, chord: KeyChord):
+        for action in self._actions_by_chord.get(chord, ()):
+            action()
+
+    def key_released(self, key: [Key | KeyCode]):
         if key in self.keys_pressed:
             self.keys_pressed.remove(key)
         else:
@@ -269,12 +463,10 @@ class KeybindListener:
         self.prev_keys_pressed = self.keys_pressed.copy()
 
     def start(self):
-        self.key_listener.start()
-        self.mouse_listener.start()
+        self.input_backend.start()
 
     def stop(self):
-        self.key_listener.stop()
-        self.mouse_listener.stop()
+        self.input_backend.stop()
 
 
 def get_callback(num: int) -> Callable:
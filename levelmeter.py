@@ -0,0 +1,95 @@
+import shutil
+import subprocess
+import threading
+import time
+from typing import Callable
+
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+DEFAULT_MONITOR = '@DEFAULT_MONITOR@'
+
+_sample_size = 4  # float32
+
+
+# Reads a low rate mono capture of whatever is being adjusted and reports its peak and RMS level.
+# Nothing runs until start() and everything is torn down again on stop().
+class LevelMeter:
+
+    def __init__(self,
+                 on_levels: Callable[[float, float], None],
+                 sample_rate: int = 4000,
+                 block_seconds: float = 1 / 60,
+                 max_updates_per_second: float = 30):
+        self.on_levels = on_levels
+        self.sample_rate = sample_rate
+        self.block_samples = max(1, round(sample_rate * block_seconds))
+        self.min_update_interval = 1 / max_updates_per_second
+        self.parec = shutil.which('parec')
+        self._capture: [subprocess.Popen | None] = None
+        self._numpy = None
+        self.available = self._check_available()
+
+    def _check_available(self) -> bool:
+        if self.parec is None:
+            logger.warning('parec not found, the level meter is disabled')
+            return False
+        try:
+            import numpy
+            self._numpy = numpy
+        except ImportError:
+            logger.warning('numpy not installed, the level meter is disabled')
+            return False
+        return True
+
+    # Either a sink input to monitor or a source (e.g. a sink's monitor) to record from
+    def start(self, stream_index: [int | None] = None, device: str = DEFAULT_MONITOR):
+        if not self.available:
+            return
+        self.stop()
+        source_argument = f'--monitor-stream={stream_index}' if stream_index is not None else f'--device={device}'
+        self._capture = subprocess.Popen(
+            [self.parec, '--raw', '--format=float32le', '--channels=1', f'--rate={self.sample_rate}',
+             f'--latency-msec={round(self.block_samples / self.sample_rate * 1000)}', source_argument],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        # Blocked on parec for as long as it runs, so not on one of the shared workers
+        threading.Thread(target=self._read_levels, args=(self._capture,), name='level-meter', daemon=True).start()
+
+    def stop(self):
+        if self._capture is None:
+            return
+        capture = self._capture
+        self._capture = None
+        capture.terminate()
+
+    def _read_levels(self, capture: subprocess.Popen):
+        numpy = self._numpy
+        block_bytes = self.block_samples * _sample_size
+        last_update = 0.0
+        peak = 0.0
+        sum_of_squares = 0.0
+        num_of_samples = 0
+        try:
+            while capture is self._capture:
+                data = capture.stdout.read(block_bytes)
+                if not data:
+                    break
+                samples = numpy.frombuffer(data[:len(data) - len(data) % _sample_size], dtype=numpy.float32)
+                # Whole blocks at a time, never a Python loop over samples
+                peak = max(peak, float(numpy.max(numpy.abs(samples), initial=0)))
+                sum_of_squares += float(numpy.dot(samples, samples))
+                num_of_samples += samples.size
+                now = time.monotonic()
+                # Blocks in between updates still count towards the next one
+                if now - last_update >= self.min_update_interval and num_of_samples > 0:
+                    self.on_levels(min(peak, 1.0), min((sum_of_squares / num_of_samples) ** .5, 1.0))
+                    last_update = now
+                    peak = 0.0
+                    sum_of_squares = 0.0
+                    num_of_samples = 0
+        finally:
+            capture.stdout.close()
+            capture.wait()
@@ -1,7 +1,152 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+from collections import deque
+from typing import Callable
+
+DEFAULT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+DEFAULT_RING_SIZE = 500
+
+_listener: ['LogWriter | None'] = None
+_ring_buffer: ['RingBufferHandler | None'] = None
 
 
 def get_logger(py_file):
     logger = logging.getLogger(os.path.basename(py_file).replace('.py', ''))
     return logger
+
+
+class LazyArgument:
+
+    def __init__(self, func: Callable, *args):
+        self.func = func
+        self.args = args
+
+    # Called on the writer thread, by when whatever it looks at may well be gone (e.g. an exited process)
+    def __str__(self):
+        try:
+            return str(self.func(*self.args))
+        except Exception as e:
+            return f'<{getattr(self.func, "__name__", "lazy")} failed: {e!r}>'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# An argument as it looked when it was logged
+class RenderedArgument:
+    __slots__ = ('text', 'representation')
+
+    def __init__(self, argument):
+        self.text = str(argument)
+        self.representation = repr(argument)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return self.representation
+
+
+# For log arguments that cost something to work out, only called if the record is actually written out, e.g.
+#   logger.debug('Process: [%s]', lazy(proc.name))
+def lazy(func: Callable, *args) -> LazyArgument:
+    return LazyArgument(func, *args)
+
+
+# Arguments that can't change after the call, anything else could look different by the time it's written
+_plain_argument_types = (str, int, float, bool, bytes, type(None), LazyArgument)
+
+
+def _snapshot_argument(argument):
+    return argument if isinstance(argument, _plain_argument_types) else RenderedArgument(argument)
+
+
+# The standard QueueHandler formats the message before queueing it (so it can be pickled),
+# we only ever queue within the process so that's left to the writer thread. Only arguments that could
+# still change (the streams and volumes dicts and lists) are turned into text here, lazy ones are left be.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, dict):
+            record.args = {key: _snapshot_argument(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(_snapshot_argument(argument) for argument in record.args)
+        return record
+
+
+# The last few records, for showing in the Options Window
+class RingBufferHandler(logging.Handler):
+
+    def __init__(self, size: int = DEFAULT_RING_SIZE):
+        super().__init__()
+        self.records: deque[str] = deque(maxlen=size)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.records.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+# Does the job of logging's QueueListener, on a thread of our own so it can go by a name of our choosing
+class LogWriter:
+
+    def __init__(self, record_queue: queue.SimpleQueue, *handlers: logging.Handler):
+        self.record_queue = record_queue
+        self.handlers = handlers
+        self._thread = threading.Thread(target=self._write_records, name='log-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    # Everything queued before this is still written out
+    def stop(self):
+        self.record_queue.put(None)
+        self._thread.join()
+
+    def _write_records(self):
+        while True:
+            record = self.record_queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                handler.handle(record)
+
+
+# Log calls on any thread just drop the record on a queue, a background thread formats and writes them
+def setup_logging(level=logging.INFO, log_format: str = DEFAULT_FORMAT, ring_size: int = DEFAULT_RING_SIZE):
+    global _listener, _ring_buffer
+    if _listener is not None:
+        return
+    formatter = logging.Formatter(log_format)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    _ring_buffer = RingBufferHandler(ring_size)
+    _ring_buffer.setFormatter(formatter)
+    record_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(record_queue))
+    _listener = LogWriter(record_queue, stream_handler, _ring_buffer)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+# Writes out anything still queued
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_recent_records() -> list[str]:
+    if _ring_buffer is None:
+        return []
+    return list(_ring_buffer.records)
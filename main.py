@@ -1,82 +1,170 @@
+import json
 import logging
+import signal
+import subprocess
 import sys
-
-import yaml
-from PyQt6.QtGui import QIcon, QAction
-from PyQt6.QtWidgets import QApplication, QSystemTrayIcon, QMenu
-from pynput import keyboard
-
+import threading
+from typing import Callable
+
+import controlserver
+import startuptimer
+import uiprocess
+
+# The Qt half of ui mode gui_process, started by run_gui_process below
+if len(sys.argv) > 1 and sys.argv[1] == uiprocess.UI_PROCESS_ARGUMENT:
+    sys.exit(uiprocess.main(sys.argv[2:]))
+
+# Hand our arguments to an already running instance (if there is one) before loading anything heavy
+arguments, qt_arguments = controlserver.parse_arguments(sys.argv[1:])
+startup_commands = controlserver.commands_from_arguments(arguments)
+command_results = controlserver.send_commands(startup_commands)
+if command_results is not None:
+    if len(command_results) > 0:
+        print(json.dumps(command_results, indent=2))
+    sys.exit(0 if all(result['ok'] for result in command_results) else 1)
+if arguments.startup_timing:
+    startuptimer.enable()
+
+import attribution
+import audiobackends
+import configstore
+import levelmeter
+import customthreading
+import eventcore
 import fileutils
 import generalutils
+import idlemonitor
 import keybindhandlers as keybinds
-import ui
+import notifyutils
+import profiler
+import streamactivity
+import targetrules
+import volumememory
 import volumeutils
-from loggingutils import get_logger
+import warmup
+from loggingutils import get_logger, setup_logging
 
 config_filename = 'config.yml'
 
-logging.basicConfig(level=logging.INFO)
+setup_logging(logging.INFO)
 
 logger = get_logger(__file__)
 
 
-def load_configs(filename: str):
-    with fileutils.open_resource(filename) as config_file:
-        config = yaml.safe_load(config_file)
-        volume = config['volume']
-        control = config['control']
-        ui = config['ui']
-    return volume, control, ui
-
-
 def update_volume_config(tick_value: float):
-    with fileutils.open_resource(config_filename) as config_file:
-        config = yaml.safe_load(config_file)
-        config['volume']['delta'] = tick_value
-    with fileutils.open_resource(config_filename, "w") as config_file:
-        yaml.safe_dump(config, config_file)
-        logger.debug(f'Update volume tick to: {config["volume"]["delta"]}')
-    refresh_config()
+    config_store.update('volume', 'delta', tick_value)
 
 
 def update_control_target_config(control_target: generalutils.ControlTarget):
-    with fileutils.open_resource(config_filename) as config_file:
-        config = yaml.safe_load(config_file)
-        config['control']['target'] = control_target.value
-    with fileutils.open_resource(config_filename, "w") as config_file:
-        yaml.safe_dump(config, config_file)
-        print(f'Update volume control target to: {config["control"]["target"]}')
-    refresh_config()
+    config_store.update('control', 'target', control_target.value)
+    logger.info(f'Update volume control target to: {control_target.value}')
 
 
 # Constants
 idle_time = 3
+control_timeout = 5
+keybind_capture_timeout = 15
 
 # Configs, flags and trackers
-modifier_key = keyboard.Key.shift
-modifier_key_pressed = False
 terminate_application = False
-(volume_config, control_config, ui_config) = load_configs(config_filename)
+with startuptimer.phase('load config'):
+    config_store = configstore.ConfigStore(config_filename)
+
+
+def get_volume_delta() -> float:
+    return float(config_store.get('volume', 'delta'))
+
+
+def get_control_target() -> str:
+    return config_store.get('control', 'target')
+
+
+def get_control_fallback() -> str:
+    return config_store.get('control', 'fallback', 'none')
+
+
+# e.g. system_group: {name: Speakers + Headset, outputs: [alsa_output.pci-0000_00_1f.3.analog-stereo, USB Headset]}
+def get_system_group() -> tuple[str, list[str]]:
+    system_group = config_store.get('control', 'system_group', {})
+    return system_group.get('name', 'System'), list(system_group.get('outputs', []))
+
+
+def get_input_backend() -> Callable:
+    backend_name = config_store.get('input', 'backend', keybinds.PYNPUT_INPUT)
+    if backend_name == keybinds.PYNPUT_INPUT:
+        return keybinds.PynputInputBackend
+    import x11input
+    return x11input.input_backend_factory(backend_name, config_store.get('input', 'display'))
 
 
-def refresh_config():
-    global volume_config, control_config, ui_config
-    (volume_config, control_config, ui_config) = load_configs(config_filename)
+def get_rule_set() -> targetrules.RuleSet:
+    return targetrules.RuleSet(config_store.section('rules'))
 
 
+# Our own volume writes coming back change nothing the indexes keep, those don't take a turn on the serialized queue
+def on_audio_event(event: audiobackends.AudioEvent):
+    if get_audio_backend().is_own_change(event):
+        return
+    core.run_serialized(volume_state.on_audio_event, event)
+
+
+def reload_rules():
+    if config_store.section('rules') == volume_state.rules.rule_set.config:
+        return
+    try:
+        rule_set = get_rule_set()
+    except ValueError as e:
+        logger.error(f'Keeping the previous target rules: {e}')
+        return
+    volume_state.rules.set_rule_set(rule_set)
+
+
+def get_audio_backend() -> audiobackends.AudioBackend:
+    backend_name = config_store.get('audio', 'backend', audiobackends.PULSE_BACKEND)
+    if backend_name == audiobackends.MEMORY_BACKEND:
+        return audiobackends.get_backend(backend_name, latency=float(config_store.get('audio', 'latency', 0)))
+    return audiobackends.get_backend(backend_name)
+
+
+# Where the volume bar shows up
+primary_monitor_placement = 'primary'
+focused_window_placement = 'focused_window'
+
+# Fallback for when the focused app has no audio
+most_recently_audible_fallback = 'most_recently_audible'
+
 # Bindings
 volume_up_keybind_name = 'volume_up'
 volume_down_keybind_name = 'volume_down'
 
 
+# Only ever used from requests run through the event core, one at a time
+volume_state = volumeutils.VolumeState()
+
+
 # Change the volume of a target. Not sure if more targets might be available in future (e.g. Comms only)
-def volume_change(delta: float):
-    control_target = control_config['target']
-    logger.debug(f'Controlling: [{control_target}]')
-    if control_target == 'current_application':
-        updated_volume, media_name = volumeutils.change_active_window_volume_v2(delta)
+def volume_change(delta: float, control_target: [str | dict | None] = None) -> [float, str]:
+    if control_target is None:
+        control_target = get_control_target()
+    logger.debug('Controlling: [%s]', control_target)
+    backend = get_audio_backend()
+    rule_name = targetrules.rule_name_from_target(control_target)
+    if type(control_target) is dict:
+        updated_volume, media_name = volumeutils.change_process_volume(
+            backend, delta, pid=control_target.get('pid'), binary=control_target.get('binary'))
+    elif rule_name is not None:
+        updated_volume, media_name = volumeutils.change_rule_volume(backend, volume_state, rule_name, delta)
+    elif control_target == 'current_application':
+        updated_volume, media_name = volumeutils.change_active_window_volume_v2(backend, volume_state, delta)
+        if media_name == 'NO_TARGET' and get_control_fallback() == most_recently_audible_fallback:
+            updated_volume, media_name = volumeutils.change_most_recently_audible_volume(backend, volume_state, delta)
     elif control_target == 'system':
-        updated_volume, media_name = volumeutils.change_system_volume(delta)
+        updated_volume, media_name = volumeutils.change_system_volume(backend, delta)
+        volume_state.meter_stream_index = None
+    elif control_target == 'system_group':
+        group_name, output_names = get_system_group()
+        updated_volume, media_name = volumeutils.change_output_group_volume(backend, output_names, group_name, delta)
+        volume_state.meter_stream_index = None
     else:
         # TODO: What should we do?
         #  Call itself again and provide a default config?
@@ -84,41 +172,145 @@ def volume_change(delta: float):
         #  Nothing and break?
         #  Quack?!
         raise ValueError(f'Unknown Control Target Configuration: {control_target}')
+    show_volume(updated_volume, media_name)
+    return updated_volume, media_name
+
+
+def volume_set(volume: float, control_target: [str | dict | None] = None) -> [float, str]:
+    if control_target is None:
+        control_target = get_control_target()
+    backend = get_audio_backend()
+    rule_name = targetrules.rule_name_from_target(control_target)
+    if type(control_target) is dict:
+        updated_volume, media_name = volumeutils.set_process_volume(
+            backend, volume, pid=control_target.get('pid'), binary=control_target.get('binary'))
+    elif rule_name is not None:
+        updated_volume, media_name = volumeutils.set_rule_volume(backend, volume_state, rule_name, volume)
+    elif control_target == 'current_application':
+        updated_volume, media_name = volumeutils.set_active_window_volume(backend, volume_state, volume)
+    elif control_target == 'system':
+        updated_volume, media_name = volumeutils.set_system_volume(backend, volume)
+    elif control_target == 'system_group':
+        group_name, output_names = get_system_group()
+        updated_volume, media_name = volumeutils.set_output_group_volume(backend, output_names, group_name, volume)
+    else:
+        raise ValueError(f'Unknown Control Target Configuration: {control_target}')
+    show_volume(updated_volume, media_name)
+    return updated_volume, media_name
+
+
+# Uses the geometry the focus feed already gave us, no asking X again
+def place_volume_bar_on_focused_monitor():
+    focused_window = volume_state.focused_window
+    if focused_window is None or focused_window.center is None:
+        return
+    if volume_bar is not None:
+        volume_bar.place_on_monitor_at(*focused_window.center)
+    else:
+        ui_channel.publish(uiprocess.PLACEMENT_UPDATE, focused_window.center)
+
+
+def show_volume(updated_volume: float, media_name: str):
     # TODO: Flash some small UI element where the volume bar would be
     #  to indicate that it's working but there's no control here
-    if media_name != 'NO_TARGET':
-        volume_bar.set_percentage(round(updated_volume * 100), media_name)
-        gui_app.processEvents()
+    if media_name == 'NO_TARGET':
+        return
+    if volume_bar is not None or ui_channel is not None:
+        if config_store.get('ui', 'osd_placement', primary_monitor_placement) == focused_window_placement:
+            place_volume_bar_on_focused_monitor()
+        if volume_bar is not None:
+            volume_bar.set_percentage(round(updated_volume * 100), media_name)
+        else:
+            ui_channel.publish(uiprocess.VOLUME_UPDATE, (round(updated_volume * 100), media_name))
+    elif volume_notifier is not None:
+        volume_notifier.notify_volume(round(updated_volume * 100), media_name)
+
+
+# Commands from scripts via the control socket, see controlserver for the format
+def handle_control_command(command: dict) -> dict:
+    action = command['action']
+    target = command.get('target')
+    if action == controlserver.CHANGE_ACTION:
+        delta = command.get('delta')
+        if delta is None:
+            delta = get_volume_delta() * command.get('direction', 1)
+        updated_volume, media_name = volume_change(float(delta), target)
+        return {'volume': updated_volume, 'name': media_name}
+    elif action == controlserver.SET_ACTION:
+        updated_volume, media_name = volume_set(float(command['volume']), target)
+        return {'volume': updated_volume, 'name': media_name}
+    elif action == controlserver.DUCK_ACTION:
+        ratio = float(command.get('ratio', config_store.get('volume', 'duck_ratio', .3)))
+        return {'streams': volumeutils.duck_other_streams(get_audio_backend(), volume_state, ratio)}
+    elif action == controlserver.UNDUCK_ACTION:
+        return {'streams': volumeutils.restore_ducked_streams(get_audio_backend(), volume_state)}
+    elif action == controlserver.WARM_UP_ACTION:
+        # e.g. from a system-sleep hook, reconnect everything before the first keypress after resume
+        return {'seconds': warmup.warm_up(get_audio_backend())}
+    elif action == controlserver.STATS_ACTION:
+        return {'tasks': customthreading.get_executor().stats(), 'idle': idle_monitor.report()}
+    elif action == controlserver.STATE_ACTION:
+        return {
+            'target': get_control_target(),
+            'delta': get_volume_delta(),
+            'backend': config_store.get('audio', 'backend', audiobackends.PULSE_BACKEND),
+            'listening': listener_v2 is not None and listener_v2.is_running()
+        }
+    raise ValueError(f'Unknown action: {action}')
 
 
 def volume_up():
-    delta = float(volume_config['delta'])
+    delta = get_volume_delta()
     volume_change(delta)
 
 
 def volume_down():
-    delta = float(volume_config['delta'])
+    delta = get_volume_delta()
     volume_change(-delta)
 
 
+# Keybinds fire on the listener's thread, hand the work to the event core so the listener is never held up
+def on_volume_up():
+    idle_monitor.note_activity()
+    eventcore.get_core().run_serialized(volume_up)
+
+
+def on_volume_down():
+    idle_monitor.note_activity()
+    eventcore.get_core().run_serialized(volume_down)
+
+
 def volume_bar_alert(text: str):
-    volume_bar.set_error(text)
+    if volume_bar is not None:
+        volume_bar.set_error(text)
+    elif ui_channel is not None:
+        ui_channel.publish(uiprocess.ERROR_UPDATE, text)
+    elif volume_notifier is not None:
+        volume_notifier.notify_error(text)
 
 
-listener_v2: keybinds.KeybindListener
+listener_v2: [keybinds.KeybindListener | None] = None
 
 
 # Setup and start (if possible) Keybind Listener
-def start_keybind_listener():
-    global listener_v2
+def load_bound_actions() -> list[keybinds.BoundAction]:
     up_bindings: keybinds.BindingGroup = keybinds.load_bind(volume_up_keybind_name)
     down_bindings: keybinds.BindingGroup = keybinds.load_bind(volume_down_keybind_name)
-    volume_up_binding = keybinds.BoundAction(up_bindings, volume_up)
-    volume_down_binding = keybinds.BoundAction(down_bindings, volume_down)
-    listener_v2 = keybinds.KeybindListener(bound_actions=[volume_up_binding, volume_down_binding])
     if None in [up_bindings, down_bindings]:
-        logger.warning('Unable to start listener, missing bindings')
-        return
+        logger.warning('Missing bindings, set them in the options')
+    return [keybinds.BoundAction(bindings, action)
+            for bindings, action in [(up_bindings, on_volume_up), (down_bindings, on_volume_down)]
+            if bindings is not None]
+
+
+# Runs even with no bindings saved, it's also what captures new ones
+def start_keybind_listener():
+    global listener_v2
+    try:
+        listener_v2 = keybinds.KeybindListener(bound_actions=load_bound_actions(), input_backend=get_input_backend())
+    except Exception as e:
+        logger.warning(f'Unable to use the configured input backend, falling back to pynput: {e}')
+        listener_v2 = keybinds.KeybindListener(bound_actions=load_bound_actions())
     listener_v2.start()
 
 
@@ -127,47 +319,262 @@ def stop_keybind_listener():
         listener_v2.stop()
 
 
+# Only the bindings are swapped when the hooks are already up
 def restart_keybind_listener():
-    global listener_v2
+    if listener_v2 is not None and listener_v2.is_running():
+        listener_v2.update_bound_actions(load_bound_actions())
+        return
     stop_keybind_listener()
     start_keybind_listener()
 
 
+# For the options window, the next chord pressed comes back through on_captured
+def capture_next_keybind(on_captured: Callable) -> Callable:
+    return listener_v2.capture_next(on_captured, timeout=keybind_capture_timeout)
+
+
+def start_control_server() -> controlserver.ControlServer:
+    server = controlserver.ControlServer(
+        lambda command: eventcore.run_in_core(handle_control_command, command, timeout=control_timeout))
+    server.start()
+    # Nothing was running to take these, so do them ourselves
+    for startup_command in startup_commands:
+        server.run_command(startup_command)
+    return server
+
+
+# Rule targets can only be picked in the config, the options window just shows neither button selected
+def get_options_control_target() -> [generalutils.ControlTarget | None]:
+    control_target = get_control_target()
+    if targetrules.rule_name_from_target(control_target) is not None:
+        return None
+    return generalutils.ControlTarget(control_target)
+
+
+# The Options Window is only built the first time somebody asks for it
+def open_options_menu():
+    global options_menu
+    if options_menu is None:
+        import ui
+        with startuptimer.phase('options window'):
+            options_menu = ui.OptionsWindow(
+                volume_up_keybind_name,
+                volume_down_keybind_name,
+                restart_listeners_callback=restart_keybind_listener,
+                capture_keybind_callback=capture_next_keybind,
+                volume_tick_change_callback=update_volume_config,
+                volume_target_change_callback=update_control_target_config,
+                volume_tick=int(get_volume_delta() * 100),
+                control_target=get_options_control_target()
+            )
+    options_menu.show()
+
+
+def flush_volume_memory():
+    if volume_state.memory is not None:
+        volume_state.memory.flush()
+
+
+# From the tray, stopping writes the profile out to the resource directory
+def set_profiling(enabled: bool):
+    if enabled:
+        sampling_profiler.start()
+    else:
+        sampling_profiler.stop()
+
+
+# Only captures audio while the volume bar is on screen
+def start_level_meter(on_levels: Callable[[float, float], None], visibility_changed) -> [levelmeter.LevelMeter | None]:
+    meter = levelmeter.LevelMeter(on_levels)
+    if not meter.available:
+        return None
+
+    def on_visibility_changed(visible: bool):
+        if visible:
+            meter.start(volume_state.meter_stream_index)
+        else:
+            meter.stop()
+
+    visibility_changed.connect(on_visibility_changed)
+    return meter
+
+
+def run_gui():
+    global gui_app, volume_bar
+    with startuptimer.phase('import qt'):
+        from PyQt6.QtWidgets import QApplication
+        import ui
+
+    with startuptimer.phase('qt application'):
+        gui_app = QApplication([sys.argv[0], *qt_arguments])
+        gui_app.setQuitOnLastWindowClosed(False)
+    with startuptimer.phase('volume bar'):
+        volume_bar = ui.VolumeBar(2, monitor_index=ui.get_primary_monitor())
+        volume_bar.hide()
+        volume_bar.warm_up()
+    if config_store.get('ui', 'level_meter', True):
+        meter = start_level_meter(volume_bar.levels_changed.emit, volume_bar.visibility_changed)
+        if meter is not None:
+            gui_app.aboutToQuit.connect(meter.stop)
+
+    with startuptimer.phase('tray'):
+        tray = ui.Tray(fileutils.get_full_resource_path('volume_white.png'),
+                       open_options_menu,
+                       gui_app.quit,
+                       set_profiling)
+
+    with startuptimer.phase('control server'):
+        control_server = start_control_server()
+    gui_app.aboutToQuit.connect(control_server.stop)
+    gui_app.aboutToQuit.connect(sampling_profiler.stop)
+    gui_app.aboutToQuit.connect(config_store.flush)
+    gui_app.aboutToQuit.connect(flush_volume_memory)
+    gui_app.aboutToQuit.connect(core.stop)
+    gui_app.aboutToQuit.connect(customthreading.get_executor().shutdown)
+
+    startuptimer.report()
+    gui_app.exec()
+
+
+def wait_for_stop_signal(stop_requested: threading.Event):
+    signal.signal(signal.SIGTERM, lambda *_: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_requested.set())
+    stop_requested.wait()
+
+
+def stop_engine(control_server: controlserver.ControlServer):
+    control_server.stop()
+    sampling_profiler.stop()
+    config_store.flush()
+    flush_volume_memory()
+    stop_keybind_listener()
+    core.stop()
+    customthreading.get_executor().shutdown()
+
+
+# Only the listener and the volume path, no Qt at all
+def run_headless():
+    global volume_notifier
+    osd = config_store.get('ui', 'osd', notifyutils.NOTIFY_OSD)
+    if osd == notifyutils.NOTIFY_OSD:
+        volume_notifier = notifyutils.VolumeNotifier()
+    with startuptimer.phase('control server'):
+        control_server = start_control_server()
+    logger.info(f'Running headless, OSD: [{osd}]')
+    startuptimer.report()
+    wait_for_stop_signal(threading.Event())
+    stop_engine(control_server)
+
+
+# Requests from the UI process, on the event core's thread
+def handle_ui_request(kind: str, value):
+    if kind == uiprocess.RESTART_LISTENERS_REQUEST:
+        restart_keybind_listener()
+    elif kind == uiprocess.CAPTURE_REQUEST:
+        capture_for_ui(value)
+    elif kind == uiprocess.CANCEL_CAPTURE_REQUEST:
+        cancel_capture = ui_captures.pop(value, None)
+        if cancel_capture is not None:
+            cancel_capture()
+    elif kind == uiprocess.VOLUME_TICK_REQUEST:
+        update_volume_config(value)
+    elif kind == uiprocess.CONTROL_TARGET_REQUEST:
+        update_control_target_config(value)
+    elif kind == uiprocess.VISIBILITY_REQUEST:
+        ui_visibility_changed.emit(value)
+    elif kind == uiprocess.PROFILING_REQUEST:
+        set_profiling(value)
+    else:
+        logger.warning(f'Unknown UI request: {kind}')
+
+
+def capture_for_ui(capture_id: int):
+    def on_captured(binding: [keybinds.Binding | None]):
+        ui_captures.pop(capture_id, None)
+        ui_channel.publish(uiprocess.CAPTURED_UPDATE, (capture_id, binding))
+
+    ui_captures[capture_id] = capture_next_keybind(on_captured)
+
+
+# Qt runs in a process of its own, so painting and keypresses never wait on each other's GIL
+def run_gui_process():
+    global ui_channel
+    control_target = get_options_control_target()
+    with startuptimer.phase('ui process'):
+        ui_process, connection = uiprocess.start_ui_process(__file__, {
+            'volume_up_keybind_name': volume_up_keybind_name,
+            'volume_down_keybind_name': volume_down_keybind_name,
+            'volume_tick': int(get_volume_delta() * 100),
+            'control_target': None if control_target is None else control_target.value,
+        }, qt_arguments)
+    ui_channel = uiprocess.EngineChannel(connection, handle_ui_request)
+    stop_requested = threading.Event()
+    # Quitting from the tray closes the UI process, which takes us with it
+    ui_channel.closed.connect(lambda _: stop_requested.set())
+    meter = None
+    if config_store.get('ui', 'level_meter', True):
+        meter = start_level_meter(lambda peak, rms: ui_channel.publish(uiprocess.LEVELS_UPDATE, (peak, rms)),
+                                  ui_visibility_changed)
+    ui_channel.start()
+    with startuptimer.phase('control server'):
+        control_server = start_control_server()
+    startuptimer.report()
+    wait_for_stop_signal(stop_requested)
+    if meter is not None:
+        meter.stop()
+    ui_channel.stop()
+    try:
+        ui_process.wait(timeout=control_timeout)
+    except subprocess.TimeoutExpired:
+        ui_process.kill()
+    stop_engine(control_server)
+
+
+# UI, only some of these are around depending on how we're running
+gui_app = None
+volume_bar = None
+options_menu = None
+volume_notifier: [notifyutils.VolumeNotifier | None] = None
+ui_channel: [uiprocess.EngineChannel | None] = None
+sampling_profiler = profiler.SamplingProfiler(label='engine' if config_store.get('ui', 'mode') == uiprocess.GUI_PROCESS_MODE else None)
+ui_visibility_changed: generalutils.Signal = generalutils.Signal('ui_visibility_changed')
+# capture id -> cancels that capture, for captures the UI process asked for
+ui_captures: dict[int, Callable] = {}
+
+# Everything event driven hangs off the event core
+core = eventcore.get_core()
+core.focus_changed.connect(volume_state.on_focus_changed)
+volume_state.attribution = attribution.StreamAttributionIndex(get_audio_backend())
+core.run_serialized(volume_state.attribution.rebuild)
+volume_state.activity = streamactivity.StreamActivityIndex(get_audio_backend())
+core.run_serialized(volume_state.activity.rebuild)
+volume_state.rules = targetrules.RuleTargetIndex(get_audio_backend(), get_rule_set())
+core.run_serialized(volume_state.rules.rebuild)
+if config_store.get('volume', 'remember_app_volumes', True):
+    volume_state.memory = volumememory.VolumeMemory(
+        get_audio_backend(), max_apps=int(config_store.get('volume', 'remembered_apps', 200)))
+core.audio_events.connect(on_audio_event)
+# Rules are only compiled again when someone edits them
+config_store.changed.connect(lambda _: core.run_serialized(reload_rules))
+core.attach_audio_backend(get_audio_backend())
+config_store.start_watching()
+idle_monitor = idlemonitor.IdleMonitor(
+    cpu_budget=float(config_store.get('diagnostics', 'idle_cpu_budget', .002)),
+    wakeup_budget=float(config_store.get('diagnostics', 'idle_wakeup_budget', 5)))
+if config_store.get('diagnostics', 'idle_monitor', True):
+    idle_monitor.start()
+
 # Init listener
-start_keybind_listener()
-
-# GUI Setup
-gui_app = QApplication(sys.argv)
-gui_app.setQuitOnLastWindowClosed(False)
-volume_bar = ui.VolumeBar(2)
-volume_bar.hide()
-options_menu: ui.OptionsWindow = ui.OptionsWindow(
-    volume_up_keybind_name,
-    volume_down_keybind_name,
-    restart_listeners_callback=restart_keybind_listener,
-    volume_tick_change_callback=update_volume_config,
-    volume_target_change_callback=update_control_target_config,
-    volume_tick=int(float(volume_config['delta']) * 100),
-    control_target=generalutils.ControlTarget(control_config['target'])
-)
-
-tray = QSystemTrayIcon()
-tray_icon = QIcon(fileutils.get_full_resource_path('volume_white.png'))
-tray.setIcon(tray_icon)
-tray.setVisible(True)
-
-menu = QMenu()
-open_action = QAction('Open')
-open_action.triggered.connect(options_menu.show)
-open_action.triggered.connect(stop_keybind_listener)
-menu.addAction(open_action)
-
-quit_action = QAction('Quit')
-quit_action.triggered.connect(gui_app.quit)
-menu.addAction(quit_action)
-
-tray.setContextMenu(menu)
-
-options_menu.show()
-
-gui_app.exec()
+with startuptimer.phase('keybind listener'):
+    start_keybind_listener()
+# Unless the input backend already follows focus on its own X connection
+if not listener_v2.input_backend.watches_focus:
+    core.watch_focus()
+warmup.start_warm_up(get_audio_backend)
+
+if arguments.headless or config_store.get('ui', 'mode') == 'headless':
+    run_headless()
+elif config_store.get('ui', 'mode') == uiprocess.GUI_PROCESS_MODE:
+    run_gui_process()
+else:
+    run_gui()
@@ -0,0 +1,50 @@
+import shutil
+import subprocess
+
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+NO_OSD = 'none'
+NOTIFY_OSD = 'notify'
+
+# Notification daemons replace (rather than stack) notifications sharing this hint
+_synchronous_hint = 'string:x-canonical-private-synchronous:volume-control'
+
+
+class VolumeNotifier:
+
+    def __init__(self, timeout_ms: int = 2000):
+        self.timeout_ms = timeout_ms
+        self.notify_send = shutil.which('notify-send')
+        self._last_notification: [subprocess.Popen | None] = None
+        if self.notify_send is None:
+            logger.warning('notify-send not found, volume changes will not be shown')
+
+    def notify_volume(self, percentage: int, name: str):
+        if self.notify_send is None:
+            return
+        # Don't queue up notifications behind a slow notification daemon, just drop this one
+        if self._last_notification is not None and self._last_notification.poll() is None:
+            return
+        self._last_notification = subprocess.Popen(
+            [self.notify_send,
+             '--app-name=Volume Control',
+             f'--expire-time={self.timeout_ms}',
+             f'--hint={_synchronous_hint}',
+             f'--hint=int:value:{percentage}',
+             name.capitalize(),
+             f'{percentage}%'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+    def notify_error(self, text: str):
+        if self.notify_send is None:
+            return
+        subprocess.Popen(
+            [self.notify_send, '--app-name=Volume Control', '--urgency=low', f'--hint={_synchronous_hint}',
+             text.capitalize()],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
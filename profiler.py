@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import fileutils
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+
+# Samples the stack of every thread that used some CPU since the last look, a hundred times a second while it's on.
+# Nothing at all runs while it's off. Stopping writes the counts out as folded stacks
+# ('thread;outer;...;inner count' per line) to the resource directory, for flamegraph.pl, speedscope or inferno.
+class SamplingProfiler:
+
+    def __init__(self, interval: float = .01, label: [str | None] = None):
+        self.interval = interval
+        self.label = label
+        self.samples = 0
+        self._stacks: Counter[str] = Counter()
+        # (code, line) -> how it shows up in the stack
+        self._frame_labels: dict[tuple, str] = {}
+        # thread ident -> its CPU time when last sampled
+        self._cpu_times: dict[int, float] = {}
+        self._thread: [threading.Thread | None] = None
+        self._stop_requested = threading.Event()
+        self._started = 0.0
+
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.samples = 0
+        self._stacks = Counter()
+        self._cpu_times = {}
+        self._stop_requested.clear()
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        logger.info(f'Profiling every {self.interval * 1000:.0f}ms')
+
+    # The path of the profile it wrote, None if it wasn't running
+    def stop(self) -> [str | None]:
+        if self._thread is None:
+            return None
+        self._stop_requested.set()
+        self._thread.join()
+        self._thread = None
+        label = f'{self.label}-' if self.label is not None else ''
+        filename = f'profile-{label}{time.strftime("%Y%m%d-%H%M%S")}.folded'
+        fileutils.write_resource_atomically(
+            filename, ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common()))
+        profile_path = fileutils.get_full_resource_path(filename)
+        logger.info(f'Profiled {self.samples} samples over {time.monotonic() - self._started:.1f}s, '
+                    f'written to: {profile_path}')
+        return profile_path
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_requested.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                # Threads just sat waiting on something don't count
+                if ident == own_ident or not self._used_cpu(ident):
+                    continue
+                self._stacks[self._fold(thread_names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    def _used_cpu(self, ident: int) -> bool:
+        try:
+            cpu_time = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (OSError, ValueError):
+            # Finished in between
+            return False
+        previous = self._cpu_times.get(ident)
+        self._cpu_times[ident] = cpu_time
+        return previous is not None and cpu_time > previous
+
+    def _fold(self, thread_name: str, frame) -> str:
+        frame_labels = []
+        while frame is not None:
+            code = frame.f_code
+            key = (code, frame.f_lineno)
+            frame_label = self._frame_labels.get(key)
+            if frame_label is None:
+                frame_label = f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+                self._frame_labels[key] = frame_label
+            frame_labels.append(frame_label)
+            frame = frame.f_back
+        frame_labels.append(thread_name)
+        return ';'.join(reversed(frame_labels))
@@ -0,0 +1,227 @@
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+# The options window cycles don't need a real screen
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+# pynput needs X just to be imported, without one its dummy backend still has the keys and buttons
+# for synthetic input, only the listener restart cycles are skipped
+if 'DISPLAY' not in os.environ:
+    os.environ.setdefault('PYNPUT_BACKEND', 'dummy')
+
+import audiobackends
+import customthreading
+import eventcore
+import keybindhandlers as keybinds
+import volumeutils
+import windowutils
+from loggingutils import get_logger, setup_logging
+from pynput.keyboard import Key, KeyCode
+from pynput.mouse import Button
+
+# Drives the keybind listener and the volume path with synthetic input against the in memory audio backend
+# and a pretend focused window, failing if memory, threads or file descriptors keep growing.
+# Needs an X server for the listener cycles, e.g. `xvfb-run python soak.py`
+
+logger = get_logger(__file__)
+
+_page_size = os.sysconf('SC_PAGE_SIZE')
+
+
+class ResourceSnapshot:
+
+    def __init__(self):
+        with open('/proc/self/statm') as statm_file:
+            self.rss = int(statm_file.read().split()[1]) * _page_size
+        self.threads = len(os.listdir('/proc/self/task'))
+        fd_targets = []
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                fd_targets.append(os.readlink(f'/proc/self/fd/{fd}'))
+            except OSError:
+                # The directory listing's own fd, gone by now
+                continue
+        self.fds = len(fd_targets)
+        self.sockets = len([target for target in fd_targets if target.startswith('socket:')])
+        self.objects = len(gc.get_objects())
+        self.traced = tracemalloc.get_traced_memory()[0]
+        self.tracemalloc_snapshot = tracemalloc.take_snapshot()
+
+    def __str__(self):
+        return (f'rss={self.rss / 2 ** 20:.1f}MiB threads={self.threads} fds={self.fds} sockets={self.sockets} '
+                f'objects={self.objects} traced={self.traced / 2 ** 20:.2f}MiB')
+
+
+class SoakHarness:
+
+    def __init__(self, arguments: argparse.Namespace):
+        self.arguments = arguments
+        self.backend = audiobackends.MemoryBackend()
+        self.state = volumeutils.VolumeState()
+        self.pid = os.getpid()
+        # Our own process stands in for the focused app, so psutil has something real to look at
+        for _ in range(arguments.streams):
+            self.backend.add_stream(self.pid, 'soak', [.5, .5])
+        self.state.on_focus_changed(windowutils.FocusedWindow(1, self.pid, (0, 0, 800, 600)))
+        self.volume_changes = 0
+        self.pending_change = None
+        self.listener = self._new_listener()
+        self.failures: list[str] = []
+
+    # Both a vk and a char, like the keys pynput reports, a char-less KeyCode counts as a modifier
+    @staticmethod
+    def _key(char: str) -> KeyCode:
+        return KeyCode(vk=ord(char.upper()), char=char)
+
+    def _binding_group(self, name: str, key: KeyCode) -> keybinds.BindingGroup:
+        modifier = keybinds._convert_to_serializable_key(Key.ctrl_l)
+        return keybinds.BindingGroup([keybinds.Binding([modifier, keybinds._convert_to_serializable_key(key)])], name)
+
+    def _new_listener(self) -> keybinds.KeybindListener:
+        return keybinds.KeybindListener([
+            keybinds.BoundAction(self._binding_group('soak_up', self._key('u')), lambda: self._on_volume(.01)),
+            keybinds.BoundAction(self._binding_group('soak_down', self._key('d')), lambda: self._on_volume(-.01)),
+        ])
+
+    # Same as the app, hand the change to the event core and get straight back to listening
+    def _on_volume(self, change: float):
+        self.volume_changes += 1
+        if self.pending_change is not None and not self.pending_change.done():
+            # Don't let the queue run away from us, the app only sees a human's worth of keypresses
+            self.pending_change.result()
+        self.pending_change = eventcore.get_core().run_serialized(
+            volumeutils.change_active_window_volume_v2, self.backend, self.state, change)
+
+    def drive_events(self, num_of_events: int):
+        listener = self.listener
+        keys = [self._key(chr(char)) for char in range(ord('a'), ord('z') + 1)]
+        for i in range(num_of_events):
+            # Mostly typing, every so often one of our chords, a scroll or a mouse button
+            kind = i % 64
+            if kind == 0:
+                listener.key_pressed(Key.ctrl_l)
+                chord_key = self._key('u' if i % 128 == 0 else 'd')
+                listener.key_pressed(chord_key)
+                listener.key_released(chord_key)
+                listener.key_released(Key.ctrl_l)
+            elif kind == 1:
+                listener.mouse_scrolled(0, 0, 0, 1 if i % 3 else -1)
+            elif kind == 2:
+                listener.mouse_clicked(0, 0, Button.middle, True)
+                listener.mouse_clicked(0, 0, Button.middle, False)
+            else:
+                key = keys[i % len(keys)]
+                listener.key_pressed(key)
+                listener.key_released(key)
+        if self.pending_change is not None:
+            self.pending_change.result()
+
+    # Mirrors main.restart_keybind_listener, a real start and stop each time
+    def restart_listener_cycles(self, num_of_cycles: int):
+        if 'DISPLAY' not in os.environ:
+            logger.warning('No DISPLAY, skipping listener restart cycles')
+            return
+        for _ in range(num_of_cycles):
+            self.listener.stop()
+            self.listener = self._new_listener()
+            self.listener.start()
+            self.listener.input_backend.key_listener.wait()
+            self.listener.input_backend.mouse_listener.wait()
+        self.listener.stop()
+        self.listener.input_backend.key_listener.join()
+        self.listener.input_backend.mouse_listener.join()
+
+    def options_window_cycles(self, num_of_cycles: int):
+        from PyQt6.QtWidgets import QApplication
+        import generalutils
+        import ui
+        app = QApplication.instance() or QApplication([sys.argv[0]])
+        for _ in range(num_of_cycles):
+            window = ui.OptionsWindow(
+                'soak_up',
+                'soak_down',
+                restart_listeners_callback=lambda: None,
+                capture_keybind_callback=lambda _on_captured: lambda: None,
+                volume_tick_change_callback=lambda _tick: None,
+                volume_target_change_callback=lambda _target: None,
+                volume_tick=5,
+                control_target=generalutils.ControlTarget.CURRENT_APPLICATION)
+            window.show()
+            app.processEvents()
+            window.close()
+            window.deleteLater()
+            app.processEvents()
+
+    def check(self, baseline: ResourceSnapshot, label: str) -> ResourceSnapshot:
+        gc.collect()
+        current = ResourceSnapshot()
+        logger.info('[%s] %s, volume changes: %s', label, current, self.volume_changes)
+        limits = [
+            ('RSS', current.rss - baseline.rss, self.arguments.max_rss_growth * 2 ** 20),
+            ('threads', current.threads - baseline.threads, self.arguments.max_thread_growth),
+            ('fds', current.fds - baseline.fds, self.arguments.max_fd_growth),
+            ('sockets', current.sockets - baseline.sockets, self.arguments.max_fd_growth),
+            ('objects', current.objects - baseline.objects, self.arguments.max_object_growth),
+            ('traced memory', current.traced - baseline.traced, self.arguments.max_traced_growth * 2 ** 20),
+        ]
+        for name, growth, limit in limits:
+            if growth > limit:
+                self.failures.append(f'[{label}] {name} grew by {growth}, more than {limit}')
+        return current
+
+    def report_growth(self, baseline: ResourceSnapshot, current: ResourceSnapshot):
+        top_growth = current.tracemalloc_snapshot.compare_to(baseline.tracemalloc_snapshot, 'lineno')
+        for stat in top_growth[:self.arguments.top]:
+            logger.info('%s', stat)
+
+
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Soak test the listener and volume path for leaks')
+    parser.add_argument('--events', type=int, default=2_000_000, help='synthetic input events in total')
+    parser.add_argument('--rounds', type=int, default=10, help='resources are checked after every round')
+    parser.add_argument('--streams', type=int, default=4, help='audio streams owned by the focused app')
+    parser.add_argument('--listener-cycles', type=int, default=50, help='listener restarts per round')
+    parser.add_argument('--window-cycles', type=int, default=20, help='options window open/close per round')
+    parser.add_argument('--max-rss-growth', type=float, default=20, help='MiB')
+    parser.add_argument('--max-traced-growth', type=float, default=2, help='MiB')
+    parser.add_argument('--max-thread-growth', type=int, default=0)
+    parser.add_argument('--max-fd-growth', type=int, default=0)
+    parser.add_argument('--max-object-growth', type=int, default=5000)
+    parser.add_argument('--top', type=int, default=10, help='allocation sites to show at the end')
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]) -> int:
+    arguments = parse_arguments(argv)
+    setup_logging()
+    tracemalloc.start()
+    harness = SoakHarness(arguments)
+    events_per_round = max(1, arguments.events // arguments.rounds)
+    # One round first so caches, the event core and the executor are all warmed up before the baseline
+    harness.drive_events(events_per_round)
+    harness.restart_listener_cycles(1)
+    harness.options_window_cycles(1)
+    gc.collect()
+    baseline = ResourceSnapshot()
+    logger.info('[baseline] %s', baseline)
+    started = time.monotonic()
+    current = baseline
+    for soak_round in range(1, arguments.rounds + 1):
+        harness.drive_events(events_per_round)
+        harness.restart_listener_cycles(arguments.listener_cycles)
+        harness.options_window_cycles(arguments.window_cycles)
+        current = harness.check(baseline, f'round {soak_round}')
+    logger.info('Soaked %s events in %.1fs', events_per_round * arguments.rounds, time.monotonic() - started)
+    harness.report_growth(baseline, current)
+    eventcore.get_core().stop()
+    customthreading.get_executor().shutdown()
+    for failure in harness.failures:
+        logger.error('%s', failure)
+    return 1 if len(harness.failures) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+import builtins
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+_original_import = builtins.__import__
+_enabled = False
+_started_at = 0.0
+# Time spent in each import not counting the imports it did itself
+_import_self_times: dict[str, float] = {}
+# Time spent in each import directly done by our own code, including everything it pulled in
+_import_total_times: dict[str, float] = {}
+_import_stack: list[float] = []
+_phase_times: list[tuple[str, float]] = []
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Already loaded (or loaded from another thread), nothing worth timing
+    if level != 0 or name in sys.modules or threading.current_thread() is not threading.main_thread():
+        return _original_import(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    _import_stack.append(0.0)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        child_time = _import_stack.pop()
+        _import_self_times[name] = _import_self_times.get(name, 0) + elapsed - child_time
+        if len(_import_stack) > 0:
+            _import_stack[-1] += elapsed
+        else:
+            _import_total_times[name] = _import_total_times.get(name, 0) + elapsed
+
+
+def enable():
+    global _enabled, _started_at
+    if _enabled:
+        return
+    _enabled = True
+    _started_at = time.perf_counter()
+    builtins.__import__ = _timed_import
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    builtins.__import__ = _original_import
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+# Costs nothing unless timing was enabled
+@contextmanager
+def phase(name: str):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phase_times.append((name, time.perf_counter() - start))
+
+
+def _format_milliseconds(seconds: float) -> str:
+    return f'{seconds * 1000:8.1f}ms'
+
+
+def report(top: int = 15):
+    if not _enabled:
+        return
+    disable()
+    lines = [f'Startup took {_format_milliseconds(time.perf_counter() - _started_at).strip()}', 'Init phases:']
+    lines += [f'  {_format_milliseconds(elapsed)}  {name}' for name, elapsed in _phase_times]
+    lines.append('Imports (including everything they imported):')
+    by_total = sorted(_import_total_times.items(), key=lambda item: item[1], reverse=True)
+    lines += [f'  {_format_milliseconds(elapsed)}  {name}' for name, elapsed in by_total[:top]]
+    lines.append('Imports (by their own time):')
+    by_self = sorted(_import_self_times.items(), key=lambda item: item[1], reverse=True)
+    lines += [f'  {_format_milliseconds(elapsed)}  {name}' for name, elapsed in by_self[:top]]
+    logger.info('\n'.join(lines))
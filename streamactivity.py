@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from audiobackends import AudioBackend, AudioEvent, AudioStream
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+
+def app_key_for_stream(stream: AudioStream) -> str:
+    return stream.binary or stream.name
+
+
+# Keeps track of which apps have been making noise, kept up to date from server events,
+# so finding the most recently audible app at keypress time is a single lookup.
+class StreamActivityIndex:
+
+    def __init__(self, backend: AudioBackend, clock: Callable[[], float] = time.monotonic):
+        self.backend = backend
+        self.clock = clock
+        # stream index -> (app key, corked)
+        self._streams: dict[int, tuple[str, bool]] = {}
+        self._app_streams: dict[str, set[int]] = {}
+        # Least to most recently audible, the value is when it last started playing
+        self._last_active: OrderedDict[str, float] = OrderedDict()
+
+    def rebuild(self):
+        self._streams.clear()
+        self._app_streams.clear()
+        self._last_active.clear()
+        for stream in self.backend.list_streams():
+            self._update_stream(stream)
+
+    def _touch(self, app_key: str):
+        self._last_active[app_key] = self.clock()
+        self._last_active.move_to_end(app_key)
+
+    def _update_stream(self, stream: AudioStream):
+        app_key = app_key_for_stream(stream)
+        previous = self._streams.get(stream.index)
+        self._streams[stream.index] = (app_key, stream.corked)
+        self._app_streams.setdefault(app_key, set()).add(stream.index)
+        # Started playing, either brand new or uncorked
+        was_playing = previous is not None and not previous[1]
+        if not stream.corked and not was_playing:
+            self._touch(app_key)
+
+    def _remove_stream(self, index: int):
+        removed = self._streams.pop(index, None)
+        if removed is None:
+            return
+        app_key = removed[0]
+        app_streams = self._app_streams[app_key]
+        app_streams.discard(index)
+        # Nothing left to control for this app
+        if len(app_streams) == 0:
+            del self._app_streams[app_key]
+            self._last_active.pop(app_key, None)
+
+    def on_audio_event(self, event: AudioEvent):
+        if event.facility != AudioEvent.STREAM:
+            return
+        if event.event_type == AudioEvent.REMOVE:
+            self._remove_stream(event.index)
+            return
+        stream = self.backend.get_stream(event.index)
+        if stream is None:
+            self._remove_stream(event.index)
+        else:
+            self._update_stream(stream)
+
+    def most_recently_audible(self) -> [str | None]:
+        if len(self._last_active) == 0:
+            return None
+        return next(reversed(self._last_active))
+
+    def last_active(self, app_key: str) -> [float | None]:
+        return self._last_active.get(app_key)
+
+    def stream_indexes_for_app(self, app_key: str) -> set[int]:
+        return set(self._app_streams.get(app_key, set()))
@@ -0,0 +1,172 @@
+import re
+
+from audiobackends import AudioBackend, AudioEvent, AudioStream
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+RULE_TARGET_PREFIX = 'rule:'
+
+
+# e.g. 'rule:browsers' -> 'browsers', None for the built in targets
+def rule_name_from_target(control_target) -> [str | None]:
+    if type(control_target) is str and control_target.startswith(RULE_TARGET_PREFIX):
+        return control_target[len(RULE_TARGET_PREFIX):]
+    return None
+
+
+# One set of conditions on a stream's properties, all of which have to hold.
+# A condition is a value, a list of values or {regex: pattern}
+class _Clause:
+
+    def __init__(self, clause_id: int, conditions: dict):
+        self.clause_id = clause_id
+        self.exact: dict[str, frozenset[str]] = {}
+        self.patterns: dict[str, re.Pattern] = {}
+        for field, condition in conditions.items():
+            if type(condition) is dict:
+                try:
+                    self.patterns[field] = re.compile(condition['regex'])
+                except (KeyError, re.error) as e:
+                    raise ValueError(f'Bad condition on [{field}]: {condition}') from e
+            elif type(condition) is list:
+                self.exact[field] = frozenset(str(value) for value in condition)
+            else:
+                self.exact[field] = frozenset([str(condition)])
+
+    def patterns_match(self, properties: dict[str, str]) -> bool:
+        for field, pattern in self.patterns.items():
+            value = properties.get(field)
+            if value is None or pattern.search(value) is None:
+                return False
+        return True
+
+
+class _Rule:
+
+    def __init__(self, name: str, include: list[_Clause], exclude: list[_Clause]):
+        self.name = name
+        self.include = include
+        self.exclude = exclude
+
+
+# Every rule from the config compiled into one lookup. Exact conditions are answered by a single hash lookup per
+# property, a clause's regexes are only tried once all of its exact conditions have already matched.
+#
+#   rules:
+#     browsers:
+#       match:
+#         - {application.process.binary: [firefox, chromium]}
+#     voice_chat:
+#       match:
+#         - {media.role: phone}
+#         - {application.name: {regex: '(?i)discord|mumble'}}
+#     not_music:
+#       exclude:
+#         - {media.role: music}
+class RuleSet:
+
+    def __init__(self, rules_config: [dict | None]):
+        self.config = rules_config or {}
+        self.rules: dict[str, _Rule] = {}
+        self._clauses: list[_Clause] = []
+        # (field, value) -> clauses with that exact condition
+        self._exact_index: dict[tuple[str, str], list[_Clause]] = {}
+        for name, rule_config in self.config.items():
+            include = [self._compile_clause(conditions) for conditions in rule_config.get('match', [])]
+            exclude = [self._compile_clause(conditions) for conditions in rule_config.get('exclude', [])]
+            self.rules[name] = _Rule(name, include, exclude)
+        # Only these properties can change what a stream matches
+        self.fields: tuple[str, ...] = tuple(sorted(
+            {field for clause in self._clauses for field in (*clause.exact, *clause.patterns)}))
+        logger.info(f'Compiled {len(self.rules)} target rules, {len(self._clauses)} clauses over {len(self.fields)} properties')
+
+    def _compile_clause(self, conditions: dict) -> _Clause:
+        clause = _Clause(len(self._clauses), conditions)
+        self._clauses.append(clause)
+        for field, values in clause.exact.items():
+            for value in values:
+                self._exact_index.setdefault((field, value), []).append(clause)
+        return clause
+
+    def _matching_clause_ids(self, properties: dict[str, str]) -> set[int]:
+        exact_hits = [0] * len(self._clauses)
+        for field in self.fields:
+            value = properties.get(field)
+            if value is None:
+                continue
+            for clause in self._exact_index.get((field, value), ()):
+                exact_hits[clause.clause_id] += 1
+        return {clause.clause_id for clause in self._clauses
+                if exact_hits[clause.clause_id] == len(clause.exact) and clause.patterns_match(properties)}
+
+    def match(self, properties: dict[str, str]) -> frozenset[str]:
+        matching_clause_ids = self._matching_clause_ids(properties)
+        matched = []
+        for rule in self.rules.values():
+            # No match clauses means every stream, less the excluded ones
+            included = len(rule.include) == 0 or any(clause.clause_id in matching_clause_ids for clause in rule.include)
+            if included and not any(clause.clause_id in matching_clause_ids for clause in rule.exclude):
+                matched.append(rule.name)
+        return frozenset(matched)
+
+
+# Which streams each rule target currently covers, worked out as streams come and go rather than at keypress time.
+# A stream is only matched again when one of the properties the rules look at changes.
+class RuleTargetIndex:
+
+    def __init__(self, backend: AudioBackend, rule_set: RuleSet):
+        self.backend = backend
+        self.rule_set = rule_set
+        # stream index -> (the properties the rules look at, the rules it matched)
+        self._stream_matches: dict[int, tuple[tuple, frozenset[str]]] = {}
+        self._rule_streams: dict[str, set[int]] = {}
+
+    def set_rule_set(self, rule_set: RuleSet):
+        self.rule_set = rule_set
+        self.rebuild()
+
+    def rebuild(self):
+        self._stream_matches.clear()
+        self._rule_streams.clear()
+        for stream in self.backend.list_streams():
+            self._update_stream(stream)
+
+    def _update_stream(self, stream: AudioStream):
+        properties_key = tuple(stream.proplist.get(field) for field in self.rule_set.fields)
+        previous = self._stream_matches.get(stream.index)
+        if previous is not None and previous[0] == properties_key:
+            return
+        self._remove_stream(stream.index)
+        matched = self.rule_set.match(stream.proplist)
+        self._stream_matches[stream.index] = (properties_key, matched)
+        for rule_name in matched:
+            self._rule_streams.setdefault(rule_name, set()).add(stream.index)
+
+    def _remove_stream(self, index: int):
+        removed = self._stream_matches.pop(index, None)
+        if removed is None:
+            return
+        for rule_name in removed[1]:
+            rule_streams = self._rule_streams[rule_name]
+            rule_streams.discard(index)
+            if len(rule_streams) == 0:
+                del self._rule_streams[rule_name]
+
+    def on_audio_event(self, event: AudioEvent):
+        if event.facility != AudioEvent.STREAM:
+            return
+        if event.event_type == AudioEvent.REMOVE:
+            self._remove_stream(event.index)
+            return
+        stream = self.backend.get_stream(event.index)
+        if stream is None:
+            self._remove_stream(event.index)
+        else:
+            self._update_stream(stream)
+
+    def has_rule(self, rule_name: str) -> bool:
+        return rule_name in self.rule_set.rules
+
+    def stream_indexes_for_rule(self, rule_name: str) -> set[int]:
+        return set(self._rule_streams.get(rule_name, set()))
@@ -1,37 +1,29 @@
-import threading
-import time
 from collections.abc import Callable
 
+import customthreading
+import eventcore
 
+
+# Runs the action (on the executor) once no run() has been asked for in the last min_delay seconds
 class DelayedAction:
     _min_delay: float = -1
-    _start_time: float = 0
     _action: Callable
-    _action_timer_thread: threading.Thread
-    _running: bool = False
-    _killed: bool = False
+    _timer: [eventcore.CoreTimer | None] = None
 
     def __init__(self, min_delay, action: Callable):
         self._min_delay = min_delay
         self._action = action
 
-    def _action_thread(self):
-        while True:
-            if self._killed:
-                return
-            time.sleep(.1)
-            if time.time() - self._start_time >= self._min_delay:
-                self._action()
-                self._running = False
-                return
+    def _fire(self):
+        self._timer = None
+        customthreading.get_executor().submit(
+            self._action, task_name=f'delayed:{getattr(self._action, "__name__", "action")}')
 
     def run(self):
-        if not self._running:
-            self._action_timer_thread = threading.Thread(target=self._action_thread)
-            self._action_timer_thread.start()
-            self._running = True
-        self._start_time = time.time()
+        self.cancel()
+        self._timer = eventcore.get_core().call_later(self._min_delay, self._fire)
 
     def cancel(self):
-        if self._running:
-            self._killed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -1,10 +1,7 @@
 import math
-import threading
-import time
 from functools import cached_property
 from typing import Callable
 
-import screeninfo
 from PyQt6.QtCore import *
 from PyQt6.QtGui import *
 from PyQt6.QtWidgets import *
@@ -14,6 +11,7 @@ from pynput.keyboard import KeyCode, Key
 import generalutils
 import keybindhandlers as kb2
 import keybindutils
+import loggingutils
 from loggingutils import get_logger
 
 PROGRESS_BAR_STYLE_DEFAULT = """
@@ -59,18 +57,63 @@ def get_key_name(key: Key | KeyCode):
     return name.capitalize()
 
 
+# Asking X (xrandr) for the monitors is a round trip every time, so keep the answer
+# and only ask again when Qt says the screens changed
+class MonitorLayout(QObject):
+
+    def __init__(self):
+        super().__init__()
+        self.monitors: list[QRect] = []
+        self.primary_index = 0
+        app = QGuiApplication.instance()
+        app.screenAdded.connect(self._screen_added)
+        app.screenRemoved.connect(lambda _screen: self.refresh())
+        app.primaryScreenChanged.connect(lambda _screen: self.refresh())
+        for screen in app.screens():
+            screen.geometryChanged.connect(lambda _geometry: self.refresh())
+        self.refresh()
+
+    def _screen_added(self, screen: QScreen):
+        screen.geometryChanged.connect(lambda _geometry: self.refresh())
+        self.refresh()
+
+    def refresh(self):
+        screens = QGuiApplication.screens()
+        self.monitors = [screen.geometry() for screen in screens]
+        primary = QGuiApplication.primaryScreen()
+        self.primary_index = screens.index(primary) if primary in screens else 0
+        logger.debug(f'Monitor layout: {[(m.x(), m.y(), m.width(), m.height()) for m in self.monitors]}')
+
+    def monitor(self, monitor_index: int) -> QRect:
+        if monitor_index >= len(self.monitors):
+            return self.monitors[self.primary_index]
+        return self.monitors[monitor_index]
+
+    def monitor_index_at(self, x: int, y: int) -> int:
+        for idx, monitor in enumerate(self.monitors):
+            if monitor.contains(x, y):
+                return idx
+        return self.primary_index
+
+
+_monitor_layout: [MonitorLayout | None] = None
+
+
+def get_monitor_layout() -> MonitorLayout:
+    global _monitor_layout
+    if _monitor_layout is None:
+        _monitor_layout = MonitorLayout()
+    return _monitor_layout
+
+
 def get_monitor_center(monitor_index, window_width, window_height) -> QRect:
-    monitor: screeninfo.Monitor = screeninfo.get_monitors()[monitor_index]
-    return QRect(round(monitor.x + monitor.width / 2 - window_width / 2),
-                 round(monitor.y + monitor.height / 2 - window_height / 2), window_width, window_height)
+    monitor = get_monitor_layout().monitor(monitor_index)
+    return QRect(round(monitor.x() + monitor.width() / 2 - window_width / 2),
+                 round(monitor.y() + monitor.height() / 2 - window_height / 2), window_width, window_height)
 
 
 def get_primary_monitor():
-    for idx, monitor in enumerate(screeninfo.get_monitors()):
-        if monitor.is_primary:
-            return idx
-    logger.critical('How did we get here??')
-    return 0
+    return get_monitor_layout().primary_index
 
 
 # Credit to: https://stackoverflow.com/questions/64290561/qlabel-correct-positioning-for-text-outline
@@ -159,13 +202,50 @@ class OutlinedLabel(QLabel):
         qp.fillPath(path, self.brush)
 
 
+# Thin RMS bar with a peak marker, only repaints when the levels actually change
+class LevelMeterBar(QWidget):
+
+    def __init__(self):
+        super().__init__()
+        self.peak = 0.0
+        self.rms = 0.0
+        self.setFixedHeight(6)
+
+    def set_levels(self, peak: float, rms: float):
+        if (round(peak * self.width()), round(rms * self.width())) == \
+                (round(self.peak * self.width()), round(self.rms * self.width())):
+            return
+        self.peak = peak
+        self.rms = rms
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        rect = self.rect()
+        painter.fillRect(QRect(0, 0, round(rect.width() * self.rms), rect.height()), QColor('limegreen'))
+        peak_x = min(round(rect.width() * self.peak), rect.width() - 2)
+        painter.fillRect(QRect(peak_x, 0, 2, rect.height()), QColor('white'))
+
+
 class VolumeBar(QWidget):
+    # Updates can come from any thread, these get them onto the GUI thread
+    percentage_requested = pyqtSignal(int, str)
+    error_requested = pyqtSignal(str)
+    levels_changed = pyqtSignal(float, float)
+    visibility_changed = pyqtSignal(bool)
+    placement_requested = pyqtSignal(int, int)
 
     def __init__(self, hide_timeout, monitor_index=0, bar_width=400, bar_height=100):
         super().__init__()
         self.hide_timeout = hide_timeout
         self.monitor_index = monitor_index
-        self.last_update_stamp = 0
+        self.bar_width = bar_width
+        self.bar_height = bar_height
+        self.hide_timer = QTimer(self)
+        self.hide_timer.setSingleShot(True)
+        self.hide_timer.timeout.connect(self.hide)
+        self.percentage_requested.connect(self._show_percentage)
+        self.error_requested.connect(self._show_error)
         layout = QVBoxLayout()
         self.label = OutlinedLabel("Volume Bar")
         self.label.set_brush(QBrush(QColor("white")))
@@ -177,6 +257,11 @@ class VolumeBar(QWidget):
         self.progress_bar.setValue(0)
         self.progress_bar.setStyleSheet(PROGRESS_BAR_STYLE_DEFAULT)
         layout.addWidget(self.progress_bar)
+        self.level_meter = LevelMeterBar()
+        self.level_meter.hide()
+        self.levels_changed.connect(self._show_levels)
+        self.placement_requested.connect(self._place_on_monitor_at)
+        layout.addWidget(self.level_meter)
         self.setGeometry(get_monitor_center(monitor_index, bar_width, bar_height))
         self.setWindowFlags(self.windowFlags() | Qt.WindowType.WindowStaysOnTopHint)
         self.setWindowFlags(self.windowFlags() | Qt.WindowType.WindowDoesNotAcceptFocus)
@@ -184,27 +269,66 @@ class VolumeBar(QWidget):
         self.setAttribute(Qt.WidgetAttribute.WA_TranslucentBackground)
         self.setAttribute(Qt.WidgetAttribute.WA_NoSystemBackground)
         self.setLayout(layout)
-        self.hide_thread = threading.Thread(target=self._hide_listener, daemon=True)
-        self.hide_thread.start()
         self.show()
+        self._stamp_update_time()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.visibility_changed.emit(True)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.level_meter.hide()
+        self.visibility_changed.emit(False)
+
+    # Move over to whichever monitor has this point on it (e.g. the middle of the focused window)
+    def place_on_monitor_at(self, x: int, y: int):
+        self.placement_requested.emit(x, y)
+
+    def _place_on_monitor_at(self, x: int, y: int):
+        monitor_index = get_monitor_layout().monitor_index_at(x, y)
+        if monitor_index == self.monitor_index:
+            return
+        self.monitor_index = monitor_index
+        self.setGeometry(get_monitor_center(monitor_index, self.bar_width, self.bar_height))
+
+    def _show_levels(self, peak: float, rms: float):
+        if not self.isVisible():
+            return
+        self.level_meter.show()
+        self.level_meter.set_levels(peak, rms)
 
     # Make the window clear itself in 3/4s of a second when the mouse is over the window
     def enterEvent(self, event):
-        self.last_update_stamp = self.hide_timeout - .75
+        self.hide_timer.start(750)
 
     def set_error(self, text: str):
+        self.error_requested.emit(text)
+
+    def set_percentage(self, value: int, text: str = ''):
+        self.percentage_requested.emit(value, text)
+
+    def _show_error(self, text: str):
         self.label.set_brush(QBrush(QColor("lightcoral")))
         self.label.setText(text.capitalize())
         # self.show() Requires a better keyboard event library
         self._stamp_update_time()
 
-    def set_percentage(self, value: int, text: str = ''):
+    def _show_percentage(self, value: int, text: str):
         self.show()
         self._reset_style()
         self.label.setText(text.capitalize())
         self.progress_bar.setValue(value)
         self._stamp_update_time()
 
+    # Render once off-screen so fonts, styles and layout are all loaded before the first real show
+    def warm_up(self):
+        self.label.setText('Volume Bar')
+        self.progress_bar.setValue(50)
+        self.grab()
+        self._reset_style()
+        self.progress_bar.setValue(0)
+
     def _add_shadow(self, item: QWidget):
         effect = QGraphicsDropShadowEffect()
         effect.setBlurRadius(2)
@@ -216,14 +340,9 @@ class VolumeBar(QWidget):
         self.label.set_brush(QBrush(QColor("white")))
         self.label.clear()
 
+    # (Re)start the countdown to hiding
     def _stamp_update_time(self):
-        self.last_update_stamp = time.time()
-
-    def _hide_listener(self):
-        while True:
-            time.sleep(.5)
-            if time.time() - self.last_update_stamp > self.hide_timeout:
-                self.hide()
+        self.hide_timer.start(round(self.hide_timeout * 1000))
 
 
 class VolumeTickSelector(QWidget):
@@ -261,14 +380,26 @@ class ClickableLineEdit(QLineEdit):
             super().mousePressEvent(event)
 
 
-class UserKeybindInputThread(QThread):
+# Asks the running keybind listener for the next chord, which comes back to the GUI thread via captured
+class UserKeybindInput(QObject):
     keybind_changed = pyqtSignal(str)
+    capture_cancelled = pyqtSignal()
+    captured = pyqtSignal(object)
 
-    def __init__(self, bind_name: str, bind_index: int):
+    def __init__(self, bind_name: str, bind_index: int, capture_keybind_callback: Callable):
+        QObject.__init__(self)
         self.bind_name = bind_name
         self.bind_index = bind_index
+        self.capture_keybind_callback = capture_keybind_callback
+        self.cancel_capture: [Callable | None] = None
         self.saved_bind: kb2.BindingGroup = kb2.load_bind(bind_name)
-        QThread.__init__(self)
+        self.keybind_changed.connect(self._finished_editing)
+        self.capture_cancelled.connect(self._finished_editing)
+        self.captured.connect(self._captured)
+
+    def _finished_editing(self, *_args):
+        self.cancel_capture = None
+        user_editing_signal.emit(False)
 
     def _update_or_add_binding(self, binding: kb2.Binding):
         if self.saved_bind is None:
@@ -283,11 +414,17 @@ class UserKeybindInputThread(QThread):
             saved_bindings[self.bind_index] = binding
         return saved_bindings.copy()
 
-    def run(self):
-        global user_editing_signal
-        collector = kb2.KeybindCollector()
-        binding = collector.collect_keybind()
-        user_editing_signal.emit(False)
+    def start(self):
+        self.cancel_capture = self.capture_keybind_callback(self.captured.emit)
+
+    def cancel(self):
+        if self.cancel_capture is not None:
+            self.cancel_capture()
+
+    def _captured(self, binding: [kb2.Binding | None]):
+        if binding is None:
+            self.capture_cancelled.emit()
+            return
         logger.debug(f'Collected: {binding.keys}, {binding.mouse_action}')
         updated_bindings = self._update_or_add_binding(binding)
         updated_bound_action = kb2.BindingGroup(bindings=updated_bindings, name=self.bind_name)
@@ -297,16 +434,24 @@ class UserKeybindInputThread(QThread):
 
 class KeybindSetter(QWidget):
 
-    def __init__(self, bind_name: str, bind_index: int, after_set_callback: Callable, after_remove_callback: Callable):
+    def __init__(self,
+                 bind_name: str,
+                 bind_index: int,
+                 after_set_callback: Callable,
+                 after_remove_callback: Callable,
+                 capture_keybind_callback: Callable):
         super().__init__()
         self.bind_name = bind_name
         self.bind_index = bind_index
+        self.capture_keybind_callback = capture_keybind_callback
+        self.keybind_collector: [UserKeybindInput | None] = None
         layout = QVBoxLayout()
         self.current_bound_action: kb2.BindingGroup = kb2.load_bind(bind_name)
         if self.current_bound_action is not None and len(self.current_bound_action.bindings) > bind_index:
             display_text = str(self.current_bound_action.bindings[bind_index])
         else:
             display_text = 'Press to set keybind...'
+        self.display_text = display_text
         bottom_row = QHBoxLayout()
         layout.addLayout(bottom_row)
         self.keybind_input = ClickableLineEdit(display_text)
@@ -330,6 +475,7 @@ class KeybindSetter(QWidget):
         self.keybind_input.clicked.emit()
 
     def _remove_bind(self):
+        self.cancel_capture()
         saved_binding: kb2.BindingGroup = kb2.load_bind(self.bind_name)
         if saved_binding is not None and len(saved_binding.bindings) > self.bind_index:
             saved_binding.bindings.pop(self.bind_index)
@@ -339,23 +485,35 @@ class KeybindSetter(QWidget):
         user_editing_signal.emit(False)
 
     def _update_keybind_text(self, text):
+        self.display_text = text
         self.keybind_input.setText(text)
 
+    def _capture_cancelled(self):
+        self.keybind_input.setText(self.display_text)
+
     def _clicked(self):
-        self.keybind_input.setText('Press keybind...')
-        self.keybind_collector = UserKeybindInputThread(self.bind_name, self.bind_index)
+        if self.keybind_collector is not None:
+            self.keybind_collector.cancel()
+        self.keybind_input.setText('Press keybind... (Esc to cancel)')
+        self.keybind_collector = UserKeybindInput(self.bind_name, self.bind_index, self.capture_keybind_callback)
         self.keybind_collector.keybind_changed.connect(self._update_keybind_text)
         self.keybind_collector.keybind_changed.connect(self.after_set_callback)
+        self.keybind_collector.capture_cancelled.connect(self._capture_cancelled)
         self.keybind_collector.start()
 
+    def cancel_capture(self):
+        if self.keybind_collector is not None:
+            self.keybind_collector.cancel()
+
 
 class ExtendableKeybindSetterList(QWidget):
 
-    def __init__(self, label: str, bind_name: str, after_set_callback: Callable):
+    def __init__(self, label: str, bind_name: str, after_set_callback: Callable, capture_keybind_callback: Callable):
         super().__init__()
         self.bind_name = bind_name
         self.inputs = []
         self.after_set_callback = after_set_callback
+        self.capture_keybind_callback = capture_keybind_callback
         bound_action: kb2.BindingGroup = kb2.load_bind(bind_name)
         self.num_of_bindings = 0 if bound_action is None else len(bound_action.bindings)
         layout = QVBoxLayout()
@@ -364,7 +522,7 @@ class ExtendableKeybindSetterList(QWidget):
         layout.addWidget(self.label)
         for i in range(self.num_of_bindings):
             self.inputs.append(
-                KeybindSetter(bind_name, i, self._after_new_row_set, self._after_row_removed)
+                KeybindSetter(bind_name, i, self._after_new_row_set, self._after_row_removed, capture_keybind_callback)
             )
         for widget in self.inputs:
             self._stacked_widget.addWidget(widget)
@@ -405,7 +563,8 @@ class ExtendableKeybindSetterList(QWidget):
         global user_editing_signal
         self.row_added = True
         user_editing_signal.emit(True)
-        new_setter_row = KeybindSetter(self.bind_name, self._stacked_widget.count(), self._after_new_row_set, self._after_row_removed)
+        new_setter_row = KeybindSetter(self.bind_name, self._stacked_widget.count(), self._after_new_row_set,
+                                       self._after_row_removed, self.capture_keybind_callback)
         self._stacked_widget.addWidget(
             new_setter_row
         )
@@ -560,6 +719,45 @@ class Status(QWidget):
         else:
             self.key_listening_status.setText('Inactive')
 
+
+# Recent log records from the in-memory ring buffer, only refreshed while on screen
+class LogView(QWidget):
+
+    def __init__(self, refresh_interval_ms: int = 1000):
+        super().__init__()
+        layout = QVBoxLayout()
+        self.label = QLabel('Recent Log')
+        self.label.setAlignment(Qt.AlignmentFlag.AlignHCenter)
+        layout.addWidget(self.label)
+        self.text_block = QPlainTextEdit()
+        self.text_block.setReadOnly(True)
+        self.text_block.setMaximumHeight(150)
+        self.text_block.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        layout.addWidget(self.text_block)
+        self.setLayout(layout)
+        self.last_records: list[str] = []
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(refresh_interval_ms)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+        self.refresh_timer.start()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.refresh_timer.stop()
+
+    def refresh(self):
+        records = loggingutils.get_recent_records()
+        if records == self.last_records:
+            return
+        self.last_records = records
+        self.text_block.setPlainText('\n'.join(records))
+        self.text_block.verticalScrollBar().setValue(self.text_block.verticalScrollBar().maximum())
+
+
 class Line(QFrame):
 
     def __init__(self, horizontal: bool = True):
@@ -574,6 +772,7 @@ class OptionsWindow(QWidget):
                  volume_up_keybind_name: str,
                  volume_down_keybind_name: str,
                  restart_listeners_callback: Callable,
+                 capture_keybind_callback: Callable,
                  volume_tick_change_callback: Callable,
                  volume_target_change_callback: Callable[[generalutils.ControlTarget], None],
                  volume_tick: int,
@@ -599,16 +798,57 @@ class OptionsWindow(QWidget):
         volume_up_inputs = ExtendableKeybindSetterList(
             'Volume Up',
             volume_up_keybind_name,
-            restart_listeners_callback)
+            restart_listeners_callback,
+            capture_keybind_callback)
         volume_inputs_layout.addWidget(volume_up_inputs)
         volume_inputs_layout.addWidget(Line(horizontal=False))
         volume_down_inputs = ExtendableKeybindSetterList(
             'Volume Down',
             volume_down_keybind_name,
-            restart_listeners_callback)
+            restart_listeners_callback,
+            capture_keybind_callback)
         volume_inputs_layout.addWidget(volume_down_inputs)
         root_layout.addLayout(volume_inputs_layout)
         key_logger = KeyLogger()
         root_layout.addWidget(key_logger)
+        root_layout.addWidget(LogView())
         self.setLayout(root_layout)
         self.setGeometry(get_monitor_center(get_primary_monitor(), 100, 100))
+
+    # Don't leave the listener waiting on a chord for a window nobody can see
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        for keybind_setter in self.findChildren(KeybindSetter):
+            keybind_setter.cancel_capture()
+
+
+# The icon in the system tray, Open brings up the options and Quit closes everything.
+# Profiling is turned on and off from here too, so a profile can come from wherever things are slow.
+class Tray(QSystemTrayIcon):
+
+    def __init__(self,
+                 icon_path: str,
+                 open_callback: Callable,
+                 quit_callback: Callable,
+                 profiling_callback: Callable[[bool], None]):
+        super().__init__()
+        self.setIcon(QIcon(icon_path))
+        self.profiling = False
+        self.profiling_callback = profiling_callback
+        self.menu = QMenu()
+        self.open_action = QAction('Open', self.menu)
+        self.open_action.triggered.connect(open_callback)
+        self.menu.addAction(self.open_action)
+        self.profiling_action = QAction('Start profiling', self.menu)
+        self.profiling_action.triggered.connect(self._toggle_profiling)
+        self.menu.addAction(self.profiling_action)
+        self.quit_action = QAction('Quit', self.menu)
+        self.quit_action.triggered.connect(quit_callback)
+        self.menu.addAction(self.quit_action)
+        self.setContextMenu(self.menu)
+        self.setVisible(True)
+
+    def _toggle_profiling(self):
+        self.profiling = not self.profiling
+        self.profiling_action.setText('Stop profiling' if self.profiling else 'Start profiling')
+        self.profiling_callback(self.profiling)
@@ -0,0 +1,246 @@
+import itertools
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+from multiprocessing.connection import Connection
+from typing import Callable
+
+import eventcore
+import generalutils
+import profiler
+from loggingutils import get_logger, setup_logging
+
+logger = get_logger(__file__)
+
+# ui mode where Qt gets a process (and GIL) of its own, the listener and the volume path stay in the main one
+GUI_PROCESS_MODE = 'gui_process'
+UI_PROCESS_ARGUMENT = '--ui-process'
+
+# Engine -> UI, only ever the latest of each is sent
+VOLUME_UPDATE = 'volume'  # (percentage, name)
+ERROR_UPDATE = 'error'  # text
+LEVELS_UPDATE = 'levels'  # (peak, rms)
+PLACEMENT_UPDATE = 'placement'  # (x, y) of the focused window's center
+CAPTURED_UPDATE = 'captured'  # (capture id, binding or None)
+
+# UI -> engine, every one of these is acted on
+RESTART_LISTENERS_REQUEST = 'restart_listeners'
+CAPTURE_REQUEST = 'capture'  # capture id
+CANCEL_CAPTURE_REQUEST = 'cancel_capture'  # capture id
+VOLUME_TICK_REQUEST = 'volume_tick'  # delta
+CONTROL_TARGET_REQUEST = 'control_target'  # ControlTarget
+VISIBILITY_REQUEST = 'visibility'  # whether the volume bar is on screen
+PROFILING_REQUEST = 'profiling'  # whether the engine should be profiling too
+
+
+# Runs this same program again as the UI, with its end of a socket pair.
+# entry_point is the script to run when we're not a frozen (pyinstaller) executable.
+def start_ui_process(entry_point: str, settings: dict, qt_arguments: list[str]) -> tuple[subprocess.Popen, Connection]:
+    engine_socket, ui_socket = socket.socketpair()
+    program = [sys.executable] if getattr(sys, 'frozen', False) else [sys.executable, os.path.abspath(entry_point)]
+    with ui_socket:
+        process = subprocess.Popen(
+            [*program, UI_PROCESS_ARGUMENT, str(ui_socket.fileno()), json.dumps(settings), *qt_arguments],
+            pass_fds=(ui_socket.fileno(),))
+    logger.info(f'Started UI process: {process.pid}')
+    return process, Connection(engine_socket.detach())
+
+
+# The engine's end. Updates are kept as the latest value of each kind and sent from a thread of their own,
+# so a UI that's busy painting never holds up a keypress, it just skips the values it didn't get to in time.
+# Requests from the UI are read on the event core's loop.
+class EngineChannel:
+
+    def __init__(self, connection: Connection, on_request: Callable[[str, object], None]):
+        self.connection = connection
+        self.on_request = on_request
+        self.closed: generalutils.Signal = generalutils.Signal('ui_channel_closed')
+        self._latest: dict[str, object] = {}
+        self._latest_lock = threading.Lock()
+        self._pending = threading.Event()
+        self._running = False
+        self._sender = threading.Thread(target=self._send_updates, name='ui-channel', daemon=True)
+
+    def start(self):
+        self._running = True
+        self._sender.start()
+        eventcore.get_core().add_reader(self.connection, self._read_requests)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._pending.set()
+        self._sender.join()
+        eventcore.get_core().remove_reader(self.connection)
+        eventcore.get_core().post(self.connection.close)
+
+    def publish(self, kind: str, value):
+        with self._latest_lock:
+            self._latest[kind] = value
+        self._pending.set()
+
+    def _send_updates(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            if not self._running:
+                return
+            with self._latest_lock:
+                updates = self._latest
+                self._latest = {}
+            try:
+                self.connection.send(updates)
+            except OSError as e:
+                logger.warning(f'UI process went away: {e}')
+                return
+
+    def _read_requests(self):
+        try:
+            while self.connection.poll():
+                kind, value = self.connection.recv()
+                try:
+                    self.on_request(kind, value)
+                except Exception:
+                    logger.exception(f'UI request [{kind}] failed')
+        except (EOFError, OSError):
+            eventcore.get_core().remove_reader(self.connection)
+            self.closed.emit()
+
+
+# The UI's end. Updates are read on a thread of their own and drained down to the latest of each kind
+# before any of them are handed over to Qt.
+class UiChannel:
+
+    def __init__(self, connection: Connection, on_updates: Callable[[dict], None], on_closed: Callable):
+        self.connection = connection
+        self.on_updates = on_updates
+        self.on_closed = on_closed
+        self._reader = threading.Thread(target=self._read_updates, name='ui-channel', daemon=True)
+
+    def start(self):
+        self._reader.start()
+
+    def send(self, kind: str, value=None):
+        try:
+            self.connection.send((kind, value))
+        except OSError as e:
+            logger.warning(f'Unable to reach the engine: {e}')
+
+    def _read_updates(self):
+        while True:
+            try:
+                updates = self.connection.recv()
+                while self.connection.poll():
+                    updates.update(self.connection.recv())
+            except (EOFError, OSError):
+                self.on_closed()
+                return
+            self.on_updates(updates)
+
+
+# Everything Qt, the same volume bar, tray and options window as ui mode gui,
+# with whatever they'd have called in the engine sent over the channel instead
+class UiProcess:
+
+    def __init__(self, connection: Connection, settings: dict, qt_arguments: list[str]):
+        from PyQt6.QtWidgets import QApplication
+        import fileutils
+        import ui
+        self.settings = settings
+        self.gui_app = QApplication([sys.argv[0], *qt_arguments])
+        self.gui_app.setQuitOnLastWindowClosed(False)
+        self.channel = UiChannel(connection, self._apply_updates, self._engine_closed)
+        self.volume_bar = ui.VolumeBar(2, monitor_index=ui.get_primary_monitor())
+        self.volume_bar.hide()
+        self.volume_bar.warm_up()
+        self.volume_bar.visibility_changed.connect(lambda visible: self.channel.send(VISIBILITY_REQUEST, visible))
+        self.profiler = profiler.SamplingProfiler(label='ui')
+        self.tray = ui.Tray(fileutils.get_full_resource_path('volume_white.png'),
+                            self.open_options_menu,
+                            self.gui_app.quit,
+                            self.set_profiling)
+        self.options_menu = None
+        # capture id -> who's waiting on it
+        self._captures: dict[int, Callable] = {}
+        self._capture_ids = itertools.count()
+
+    def run(self) -> int:
+        self.channel.start()
+        result = self.gui_app.exec()
+        self.profiler.stop()
+        # Lets the engine know we're done
+        self.channel.connection.close()
+        return result
+
+    def open_options_menu(self):
+        import ui
+        if self.options_menu is None:
+            control_target = self.settings['control_target']
+            self.options_menu = ui.OptionsWindow(
+                self.settings['volume_up_keybind_name'],
+                self.settings['volume_down_keybind_name'],
+                restart_listeners_callback=lambda: self.channel.send(RESTART_LISTENERS_REQUEST),
+                capture_keybind_callback=self.capture_next_keybind,
+                volume_tick_change_callback=lambda delta: self.channel.send(VOLUME_TICK_REQUEST, delta),
+                volume_target_change_callback=lambda target: self.channel.send(CONTROL_TARGET_REQUEST, target),
+                volume_tick=self.settings['volume_tick'],
+                control_target=None if control_target is None else generalutils.ControlTarget(control_target))
+        self.options_menu.show()
+
+    # Both processes are profiled, each into a file of its own
+    def set_profiling(self, enabled: bool):
+        if enabled:
+            self.profiler.start()
+        else:
+            self.profiler.stop()
+        self.channel.send(PROFILING_REQUEST, enabled)
+
+    # Same as KeybindListener.capture_next, on_captured is called once with the binding or None
+    def capture_next_keybind(self, on_captured: Callable) -> Callable:
+        capture_id = next(self._capture_ids)
+        self._captures[capture_id] = on_captured
+        self.channel.send(CAPTURE_REQUEST, capture_id)
+        return lambda: self._cancel_capture(capture_id)
+
+    def _cancel_capture(self, capture_id: int):
+        on_captured = self._captures.pop(capture_id, None)
+        if on_captured is None:
+            return
+        self.channel.send(CANCEL_CAPTURE_REQUEST, capture_id)
+        on_captured(None)
+
+    # On the channel's thread, the volume bar's methods all hop over to the GUI thread themselves
+    def _apply_updates(self, updates: dict):
+        for kind, value in updates.items():
+            if kind == PLACEMENT_UPDATE:
+                self.volume_bar.place_on_monitor_at(*value)
+            elif kind == VOLUME_UPDATE:
+                self.volume_bar.set_percentage(*value)
+            elif kind == ERROR_UPDATE:
+                self.volume_bar.set_error(value)
+            elif kind == LEVELS_UPDATE:
+                self.volume_bar.levels_changed.emit(*value)
+            elif kind == CAPTURED_UPDATE:
+                capture_id, binding = value
+                on_captured = self._captures.pop(capture_id, None)
+                if on_captured is not None:
+                    on_captured(binding)
+
+    def _engine_closed(self):
+        from PyQt6.QtCore import QMetaObject, Qt
+        logger.info('Engine went away, closing the UI')
+        QMetaObject.invokeMethod(self.gui_app, 'quit', Qt.ConnectionType.QueuedConnection)
+
+
+# argv: the socket's fd, the settings as JSON, then anything for Qt
+def main(argv: list[str]) -> int:
+    setup_logging()
+    # Ctrl+C is for the engine, which takes us down with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ui_process = UiProcess(Connection(int(argv[0])), json.loads(argv[1]), argv[2:])
+    return ui_process.run()
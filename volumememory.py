@@ -0,0 +1,105 @@
+import json
+import threading
+from collections import OrderedDict
+
+import fileutils
+import timer
+from audiobackends import AudioBackend, AudioEvent, AudioStream
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+VOLUME_MEMORY_FILENAME = 'volume_memory.json'
+
+
+# The last volume set on each app (by binary), so the streams it opens later start out there instead of at the
+# server's default. Only the most recently used apps are kept. Saved as one compact JSON object, least recently
+# used first, in a single atomic write a little while after the last change.
+class VolumeMemory:
+
+    def __init__(self,
+                 backend: AudioBackend,
+                 max_apps: int = 200,
+                 filename: str = VOLUME_MEMORY_FILENAME,
+                 write_delay: float = 2):
+        self.backend = backend
+        self.max_apps = max_apps
+        self.filename = filename
+        self._volumes: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._delayed_write = timer.DelayedAction(write_delay, self.flush)
+        self.load()
+
+    def load(self):
+        if not fileutils.does_resource_exist(self.filename):
+            return
+        try:
+            with fileutils.open_resource(self.filename) as memory_file:
+                volumes = json.load(memory_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Unable to read [{self.filename}], starting afresh: {e}')
+            return
+        if not isinstance(volumes, dict):
+            logger.warning(f'Unable to read [{self.filename}], starting afresh: not a JSON object')
+            return
+        loaded = OrderedDict()
+        for binary, volume in volumes.items():
+            try:
+                loaded[binary] = float(volume)
+            except (TypeError, ValueError):
+                logger.warning(
+                    f'Unable to read the volume for [{binary}] in [{self.filename}], starting it afresh: {volume!r}')
+        with self._lock:
+            self._volumes = loaded
+            self._evict()
+        logger.info(f'Remembered volumes for {len(self._volumes)} apps')
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            contents = json.dumps(self._volumes, separators=(',', ':'))
+            self._dirty = False
+        fileutils.write_resource_atomically(self.filename, contents)
+
+    def _evict(self):
+        while len(self._volumes) > self.max_apps:
+            self._volumes.popitem(last=False)
+
+    def remember(self, streams: list[AudioStream]):
+        changed = False
+        with self._lock:
+            for stream in streams:
+                if stream.binary is None:
+                    continue
+                volume = round(stream.volume, 3)
+                changed |= self._volumes.get(stream.binary) != volume
+                self._volumes[stream.binary] = volume
+                self._volumes.move_to_end(stream.binary)
+            self._evict()
+            self._dirty |= changed
+        if changed:
+            self._delayed_write.run()
+
+    def volume_for(self, binary: [str | None]) -> [float | None]:
+        if binary is None:
+            return None
+        with self._lock:
+            volume = self._volumes.get(binary)
+            if volume is not None:
+                self._volumes.move_to_end(binary)
+            return volume
+
+    # New streams are put straight to the app's remembered volume
+    def on_audio_event(self, event: AudioEvent):
+        if event.facility != AudioEvent.STREAM or event.event_type != AudioEvent.NEW:
+            return
+        stream = self.backend.get_stream(event.index)
+        if stream is None:
+            return
+        volume = self.volume_for(stream.binary)
+        if volume is None or round(stream.volume, 3) == volume:
+            return
+        logger.debug('Restoring [%s] stream %s to %s', stream.binary, stream.index, volume)
+        self.backend.set_stream_volumes({stream.index: [volume] * max(1, len(stream.channel_volumes))})
@@ -1,18 +1,68 @@
-import psutil
-from pulsectl import pulsectl
+import itertools
+from typing import TYPE_CHECKING
 
 import windowutils
-from loggingutils import get_logger
+from attribution import StreamAttributionIndex
+from audiobackends import AudioBackend, AudioEvent, AudioOutput, AudioStream
+from loggingutils import get_logger, lazy
+from streamactivity import StreamActivityIndex
+from targetrules import RuleTargetIndex
+from volumememory import VolumeMemory
 
-last_updated_proc_id: [int | None] = None
+if TYPE_CHECKING:
+    import numpy
+    import psutil
 
 logger = get_logger(__file__)
 
 
+# What the volume path remembers between keypresses, only changed by requests the event core serializes
+class VolumeState:
+
+    def __init__(self):
+        self.last_updated_proc_id: [int | None] = None
+        # Kept up to date by the focus feed, None when we have to ask X
+        self.focused_pid: [int | None] = None
+        self.focused_window: [windowutils.FocusedWindow | None] = None
+        # For when none of the focused app's processes own a stream themselves
+        self.attribution: [StreamAttributionIndex | None] = None
+        # Which apps have been playing recently, for when the focused app has nothing to control
+        self.activity: [StreamActivityIndex | None] = None
+        # Streams each rule target from the config covers
+        self.rules: [RuleTargetIndex | None] = None
+        # The stream the level meter should follow, None for the default output
+        self.meter_stream_index: [int | None] = None
+        # What to put back once ducking is over
+        self.duck_snapshot: [DuckSnapshot | None] = None
+        # Each app's last volume, for its next streams
+        self.memory: [VolumeMemory | None] = None
+
+    def on_focus_changed(self, focused_window: windowutils.FocusedWindow):
+        self.focused_window = focused_window
+        self.focused_pid = focused_window.pid
+
+    # One serialized call per server event for every index, rather than one each
+    def on_audio_event(self, event: AudioEvent):
+        for index in (self.attribution, self.activity, self.rules, self.memory):
+            if index is not None:
+                index.on_audio_event(event)
+
+
+# The streams ducking lowered, their volumes before and after, one row per stream padded out to the most channels
+class DuckSnapshot:
+
+    def __init__(self, indexes: 'numpy.ndarray', channel_mask: 'numpy.ndarray',
+                 original: 'numpy.ndarray', ducked: 'numpy.ndarray'):
+        self.indexes = indexes
+        self.channel_mask = channel_mask
+        self.original = original
+        self.ducked = ducked
+
+
 class ProcessAudioReference:
 
-    def __init__(self, audio_sink_input: pulsectl.PulseSinkInputInfo, process: psutil.Process):
-        self.audio_sink_input = audio_sink_input
+    def __init__(self, audio_stream: AudioStream, process: 'psutil.Process'):
+        self.audio_stream = audio_stream
         self.process = process
 
 
@@ -24,72 +74,283 @@ def adjusted_volume_change(requested_change, current_volume) -> float:
     # Safety first!
     if current_volume + requested_change > 1:
         actual_change = 1 - current_volume
-        logger.info('Volume change: ' + str(requested_change) + ' is too high, restricted to ' + str(actual_change))
+        logger.info('Volume change: %s is too high, restricted to %s', requested_change, actual_change)
     else:
         actual_change = requested_change
     return actual_change
 
 
-def change_sink_input_volume(pulse: pulsectl.Pulse,
-                             sink_input: pulsectl.PulseSinkInputInfo,
-                             requested_change: float) -> float:
-    current_volume = pulse.volume_get_all_chans(sink_input)
-    # Check for adjustments over max volume
-    actual_change = adjusted_volume_change(requested_change, current_volume)
-    # Make the change and report
-    pulse.volume_change_all_chans(sink_input, actual_change)
-    updated_volume = pulse.volume_get_all_chans(sink_input)
-    logger.debug(
-        f'Changed [{sink_input.proplist["application.process.binary"]}] by [{actual_change}] to [{updated_volume}]')
+# Same as pulsectl's volume_change_all_chans, every channel moves by the same amount
+def changed_channel_volumes(channel_volumes: list[float], change: float) -> list[float]:
+    return [max(0.0, volume + change) for volume in channel_volumes]
+
+
+def change_streams_volume(backend: AudioBackend, streams: list[AudioStream], requested_change: float) -> float:
+    updated_volumes = {}
+    updated_volume = 0
+    for stream in streams:
+        # Check for adjustments over max volume
+        actual_change = adjusted_volume_change(requested_change, stream.volume)
+        stream.channel_volumes = changed_channel_volumes(stream.channel_volumes, actual_change)
+        updated_volumes[stream.index] = stream.channel_volumes
+        logger.debug('Changing [%s] by [%s] to [%s]', stream.binary, actual_change, stream.volume)
+        updated_volume = max(updated_volume, stream.volume)
+    # Make all the changes in one go and report
+    backend.set_stream_volumes(updated_volumes)
     return updated_volume
 
 
-def change_active_window_volume_v2(change: float) -> [float, str]:
-    global last_updated_proc_id
+def change_active_window_volume_v2(backend: AudioBackend, state: VolumeState, change: float) -> [float, str]:
     process_audio_refs = []
-    parent_proc, child_procs = windowutils.find_focused_app_process_ids()
-    if last_updated_proc_id is None:
-        last_updated_proc_id = parent_proc.pid
+    parent_proc, child_procs = windowutils.find_focused_app_process_ids(state.focused_pid)
+    if state.last_updated_proc_id is None:
+        state.last_updated_proc_id = parent_proc.pid
         is_new_process = True
     else:
-        is_new_process = last_updated_proc_id != parent_proc.pid
+        is_new_process = state.last_updated_proc_id != parent_proc.pid
+    if is_new_process:
+        state.last_updated_proc_id = parent_proc.pid
+    all_active_window_procs = {proc.pid: proc for proc in [parent_proc, *child_procs]}
+    # Gather Audio Streams and Processes together
+    for stream in backend.streams_for_pids(set(all_active_window_procs.keys())):
+        process_audio_refs.append(ProcessAudioReference(stream, all_active_window_procs[stream.pid]))
+    if len(process_audio_refs) == 0 and state.attribution is not None:
+        process_audio_refs = find_attributed_streams(backend, state.attribution, parent_proc, all_active_window_procs)
+    num_of_streams = len(process_audio_refs)
+    if is_new_process:
+        logger.info('Found %s processes that have audio sinks for: [%s:%s]',
+                    num_of_streams, parent_proc.pid, lazy(parent_proc.name))
+    if num_of_streams == 0:
+        logger.debug('No Sink Inputs found for process')
+        return 0, 'NO_TARGET'
+    # Iterate over Audio Streams with a ref to a Process related to our focussed Window
     if is_new_process:
-        last_updated_proc_id = parent_proc.pid
-    all_active_window_procs = [parent_proc, *child_procs]
-    with pulsectl.Pulse('focused_app_volume') as pulse:
-        # Gather Sink Inputs and Processes together
-        for sink_input in pulse.sink_input_list():
-            for proc in all_active_window_procs:
-                app_id = sink_input.proplist['application.process.id']
-                if app_id == str(proc.pid):
-                    proc_audio = ProcessAudioReference(sink_input, proc)
-                    process_audio_refs.append(proc_audio)
-        num_of_sink_inputs = len(process_audio_refs)
-        if is_new_process:
-            logger.info(f'Found {num_of_sink_inputs} processes that have audio sinks '
-                        f'for: [{parent_proc.pid}:{parent_proc.name()}]')
-        if num_of_sink_inputs == 0:
-            logger.debug('No Sink Inputs found for process')
-            return 0, 'NO_TARGET'
-        updated_volume = 0
-        # Iterate over Sink Inputs with a ref to a Process related to our focussed Window
         for ref in process_audio_refs:
-            if is_new_process:
-                logger.info(f'Changing volume for: [{ref.process.pid}:{ref.process.name()}] ')
-            proc_new_volume = change_sink_input_volume(pulse, ref.audio_sink_input, change)
-            if proc_new_volume > updated_volume:
-                updated_volume = proc_new_volume
+            logger.info('Changing volume for: [%s:%s] ', ref.process.pid, lazy(ref.process.name))
+    updated_volume = change_streams_volume(backend, [ref.audio_stream for ref in process_audio_refs], change)
+    if state.memory is not None:
+        state.memory.remember([ref.audio_stream for ref in process_audio_refs])
+    state.meter_stream_index = process_audio_refs[0].audio_stream.index
     # Return the updated volume and the PARENT we found,
     # not necessarily the process we asked about (not 100% on this decision)
     return updated_volume, parent_proc.name()
 
 
-def change_system_volume(change: float) -> [float]:
-    with pulsectl.Pulse('system-volume-editor') as pulse:
-        # Get Current Output Device (System volume sink)
-        default_sink = pulse.sink_default_get()
-        current_volume = pulse.volume_get_all_chans(default_sink)
-        actual_change = adjusted_volume_change(change, current_volume)
-        pulse.volume_change_all_chans(default_sink, actual_change)
-        # Return the volume change and the name of the Device we're editing
-        return pulse.volume_get_all_chans(default_sink), default_sink.description
+# Streams from the same app (cgroup / systemd scope) as the focused window, but not from its process tree
+def find_attributed_streams(backend: AudioBackend,
+                            attribution: StreamAttributionIndex,
+                            parent_proc: 'psutil.Process',
+                            all_active_window_procs: dict[int, 'psutil.Process']) -> list[ProcessAudioReference]:
+    stream_indexes = attribution.stream_indexes_for_pids(set(all_active_window_procs.keys()))
+    process_audio_refs = []
+    for index in stream_indexes:
+        stream = backend.get_stream(index)
+        if stream is not None:
+            process_audio_refs.append(ProcessAudioReference(stream, all_active_window_procs.get(stream.pid, parent_proc)))
+    if len(process_audio_refs) > 0:
+        logger.debug('Found %s streams through the app\'s cgroup', len(process_audio_refs))
+    return process_audio_refs
+
+
+def change_most_recently_audible_volume(backend: AudioBackend, state: VolumeState, change: float) -> [float, str]:
+    app_key = None if state.activity is None else state.activity.most_recently_audible()
+    if app_key is None:
+        logger.debug('Nothing has been audible recently')
+        return 0, 'NO_TARGET'
+    streams = [backend.get_stream(index) for index in state.activity.stream_indexes_for_app(app_key)]
+    streams = [stream for stream in streams if stream is not None]
+    if len(streams) == 0:
+        return 0, 'NO_TARGET'
+    state.meter_stream_index = streams[0].index
+    return change_streams_volume(backend, streams, change), app_key
+
+
+def find_rule_streams(backend: AudioBackend, state: VolumeState, rule_name: str) -> list[AudioStream]:
+    if state.rules is None or not state.rules.has_rule(rule_name):
+        raise ValueError(f'Unknown target rule: {rule_name}')
+    streams = [backend.get_stream(index) for index in state.rules.stream_indexes_for_rule(rule_name)]
+    return [stream for stream in streams if stream is not None]
+
+
+def change_rule_volume(backend: AudioBackend, state: VolumeState, rule_name: str, change: float) -> [float, str]:
+    streams = find_rule_streams(backend, state, rule_name)
+    if len(streams) == 0:
+        logger.debug('No Sink Inputs match rule: [%s]', rule_name)
+        return 0, 'NO_TARGET'
+    state.meter_stream_index = streams[0].index
+    return change_streams_volume(backend, streams, change), rule_name
+
+
+# Streams can have any number of channels, so pad every row out to the widest and keep a mask of the real ones
+def _volume_matrix(channel_volume_lists: list[list[float]], width: [int | None] = None) \
+        -> tuple['numpy.ndarray', 'numpy.ndarray']:
+    import numpy
+    channel_counts = numpy.fromiter((len(volumes) for volumes in channel_volume_lists), dtype=numpy.intp,
+                                    count=len(channel_volume_lists))
+    if width is None:
+        width = int(channel_counts.max(initial=0))
+    channel_mask = numpy.arange(width) < channel_counts[:, None]
+    matrix = numpy.zeros(channel_mask.shape)
+    matrix[channel_mask] = numpy.fromiter(itertools.chain.from_iterable(channel_volume_lists), dtype=float,
+                                          count=int(channel_counts.sum()))
+    return matrix, channel_mask
+
+
+def _volumes_by_index(indexes: 'numpy.ndarray', matrix: 'numpy.ndarray',
+                      channel_mask: 'numpy.ndarray') -> dict[int, list[float]]:
+    return {int(index): row[mask].tolist() for index, row, mask in zip(indexes, matrix, channel_mask)}
+
+
+def find_focused_stream_indexes(streams: list[AudioStream], state: VolumeState) -> set[int]:
+    parent_proc, child_procs = windowutils.find_focused_app_process_ids(state.focused_pid)
+    pids = {proc.pid for proc in [parent_proc, *child_procs]}
+    indexes = {stream.index for stream in streams if stream.pid in pids}
+    if state.attribution is not None:
+        indexes |= state.attribution.stream_indexes_for_pids(pids)
+    return indexes
+
+
+# Lowers everything but the focused app to ratio of where it was, each channel scaled alike so the balance holds
+def duck_other_streams(backend: AudioBackend, state: VolumeState, ratio: float) -> int:
+    import numpy
+    # Ducking again on top of ducking would lose the original volumes
+    if state.duck_snapshot is not None:
+        restore_ducked_streams(backend, state)
+    streams = backend.list_streams()
+    focused_indexes = find_focused_stream_indexes(streams, state)
+    streams = [stream for stream in streams if stream.index not in focused_indexes]
+    if len(streams) == 0:
+        logger.debug('Nothing to duck')
+        return 0
+    indexes = numpy.fromiter((stream.index for stream in streams), dtype=numpy.int64, count=len(streams))
+    original, channel_mask = _volume_matrix([stream.channel_volumes for stream in streams])
+    ducked = original * min(max(ratio, 0.0), 1.0)
+    # Kept before writing, so whatever did get ducked can still be restored if the write fails part way
+    state.duck_snapshot = DuckSnapshot(indexes, channel_mask, original, ducked)
+    backend.set_stream_volumes(_volumes_by_index(indexes, ducked, channel_mask))
+    logger.info('Ducked %s streams to %s', len(streams), ratio)
+    return len(streams)
+
+
+# Puts ducked streams back, leaving any that have gone away or that were changed while ducked
+def restore_ducked_streams(backend: AudioBackend, state: VolumeState) -> int:
+    import numpy
+    snapshot = state.duck_snapshot
+    state.duck_snapshot = None
+    if snapshot is None:
+        return 0
+    current_volumes = backend.get_stream_volumes(snapshot.indexes.tolist())
+    still_there = numpy.fromiter((int(index) in current_volumes for index in snapshot.indexes), dtype=bool,
+                                 count=len(snapshot.indexes))
+    if not still_there.any():
+        return 0
+    indexes = snapshot.indexes[still_there]
+    current, channel_mask = _volume_matrix([current_volumes[int(index)] for index in indexes],
+                                           width=snapshot.original.shape[1])
+    untouched = numpy.all(channel_mask == snapshot.channel_mask[still_there], axis=1) & numpy.all(
+        numpy.isclose(current, snapshot.ducked[still_there], atol=1e-4) | ~channel_mask, axis=1)
+    if not untouched.any():
+        return 0
+    backend.set_stream_volumes(
+        _volumes_by_index(indexes[untouched], snapshot.original[still_there][untouched], channel_mask[untouched]))
+    logger.info('Restored %s ducked streams', int(untouched.sum()))
+    return int(untouched.sum())
+
+
+def change_system_volume(backend: AudioBackend, change: float) -> [float, str]:
+    # Get Current Output Device (System volume sink)
+    default_output = backend.default_output()
+    actual_change = adjusted_volume_change(change, default_output.volume)
+    default_output.channel_volumes = changed_channel_volumes(default_output.channel_volumes, actual_change)
+    backend.set_output_volumes({default_output.index: default_output.channel_volumes})
+    # Return the volume change and the name of the Device we're editing
+    return default_output.volume, default_output.description
+
+
+# Outputs can be picked by either their server name or the description people actually see
+def find_outputs(backend: AudioBackend, output_names: list[str]) -> list[AudioOutput]:
+    wanted = set(output_names)
+    return [output for output in backend.list_outputs() if output.name in wanted or output.description in wanted]
+
+
+# Moves a group of outputs together, each one clamped on its own so a quieter one still goes up when another is maxed
+def change_output_group_volume(backend: AudioBackend, output_names: list[str], group_name: str,
+                               change: float) -> [float, str]:
+    outputs = find_outputs(backend, output_names)
+    if len(outputs) == 0:
+        logger.debug('None of the outputs in [%s] are around: %s', group_name, output_names)
+        return 0, 'NO_TARGET'
+    updated_volumes = {}
+    updated_volume = 0
+    for output in outputs:
+        actual_change = adjusted_volume_change(change, output.volume)
+        output.channel_volumes = changed_channel_volumes(output.channel_volumes, actual_change)
+        updated_volumes[output.index] = output.channel_volumes
+        updated_volume = max(updated_volume, output.volume)
+    backend.set_output_volumes(updated_volumes)
+    return updated_volume, group_name
+
+
+def set_output_group_volume(backend: AudioBackend, output_names: list[str], group_name: str,
+                            volume: float) -> [float, str]:
+    outputs = find_outputs(backend, output_names)
+    if len(outputs) == 0:
+        logger.debug('None of the outputs in [%s] are around: %s', group_name, output_names)
+        return 0, 'NO_TARGET'
+    volume = min(max(volume, 0.0), 1.0)
+    backend.set_output_volumes({output.index: [volume] * len(output.channel_volumes) for output in outputs})
+    return volume, group_name
+
+
+def find_streams(backend: AudioBackend, pid: [int | None] = None, binary: [str | None] = None) -> list[AudioStream]:
+    if pid is not None:
+        return backend.streams_for_pids({pid})
+    return [stream for stream in backend.list_streams() if stream.binary == binary]
+
+
+def change_process_volume(backend: AudioBackend, change: float,
+                          pid: [int | None] = None, binary: [str | None] = None) -> [float, str]:
+    streams = find_streams(backend, pid, binary)
+    if len(streams) == 0:
+        logger.debug('No Sink Inputs found for pid: [%s], binary: [%s]', pid, binary)
+        return 0, 'NO_TARGET'
+    return change_streams_volume(backend, streams, change), streams[0].binary or streams[0].name
+
+
+def set_process_volume(backend: AudioBackend, volume: float,
+                       pid: [int | None] = None, binary: [str | None] = None) -> [float, str]:
+    streams = find_streams(backend, pid, binary)
+    if len(streams) == 0:
+        logger.debug('No Sink Inputs found for pid: [%s], binary: [%s]', pid, binary)
+        return 0, 'NO_TARGET'
+    volume = min(max(volume, 0.0), 1.0)
+    backend.set_stream_volumes({stream.index: [volume] * len(stream.channel_volumes) for stream in streams})
+    return volume, streams[0].binary or streams[0].name
+
+
+def set_active_window_volume(backend: AudioBackend, state: VolumeState, volume: float) -> [float, str]:
+    parent_proc, child_procs = windowutils.find_focused_app_process_ids(state.focused_pid)
+    streams = backend.streams_for_pids({proc.pid for proc in [parent_proc, *child_procs]})
+    if len(streams) == 0:
+        logger.debug('No Sink Inputs found for process')
+        return 0, 'NO_TARGET'
+    volume = min(max(volume, 0.0), 1.0)
+    backend.set_stream_volumes({stream.index: [volume] * len(stream.channel_volumes) for stream in streams})
+    return volume, parent_proc.name()
+
+
+def set_rule_volume(backend: AudioBackend, state: VolumeState, rule_name: str, volume: float) -> [float, str]:
+    streams = find_rule_streams(backend, state, rule_name)
+    if len(streams) == 0:
+        logger.debug('No Sink Inputs match rule: [%s]', rule_name)
+        return 0, 'NO_TARGET'
+    volume = min(max(volume, 0.0), 1.0)
+    backend.set_stream_volumes({stream.index: [volume] * len(stream.channel_volumes) for stream in streams})
+    return volume, rule_name
+
+
+def set_system_volume(backend: AudioBackend, volume: float) -> [float, str]:
+    default_output = backend.default_output()
+    volume = min(max(volume, 0.0), 1.0)
+    backend.set_output_volumes({default_output.index: [volume] * len(default_output.channel_volumes)})
+    return volume, default_output.description
@@ -0,0 +1,47 @@
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+import customthreading
+import windowutils
+from audiobackends import AudioBackend
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+
+def _warm_up_audio(backend: AudioBackend):
+    backend.default_output()
+    backend.list_streams()
+
+
+def _warm_up_x():
+    windowutils.get_active_window_info()
+
+
+def _warm_up_processes():
+    import psutil
+    # psutil keeps the Process objects it makes here around for the next process_iter
+    for _proc in psutil.process_iter():
+        pass
+
+
+# Pay for all the first-time setup of the volume path before anybody presses a key
+def warm_up(backend: AudioBackend) -> float:
+    start = time.perf_counter()
+    step_times = []
+    for name, step in [('audio', lambda: _warm_up_audio(backend)), ('x', _warm_up_x), ('processes', _warm_up_processes)]:
+        step_start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            # Nothing lost, the first keypress will just have to do it
+            logger.warning(f'Warm-up of [{name}] failed: {e}')
+        step_times.append(f'{name}: {(time.perf_counter() - step_start) * 1000:.1f}ms')
+    elapsed = time.perf_counter() - start
+    logger.info(f'Warm-up finished in {elapsed * 1000:.1f}ms ({", ".join(step_times)})')
+    return elapsed
+
+
+def start_warm_up(get_backend: Callable[[], AudioBackend]) -> Future:
+    return customthreading.get_executor().submit(lambda: warm_up(get_backend()), task_name='warm_up')
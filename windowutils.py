@@ -1,34 +1,50 @@
-import time
+import threading
+from typing import TYPE_CHECKING, Callable
 
-import psutil
-from xdo import Xdo
+from loggingutils import get_logger, lazy
 
-from loggingutils import get_logger
+# psutil and xdo are only loaded when the first volume key is pressed
+if TYPE_CHECKING:
+    import psutil
 
 logger = get_logger(__file__)
 
+_xdo = None
+_xdo_lock = threading.RLock()
+
+
+# Opening the X connection is the slow part, so there's just the one
+def get_xdo():
+    global _xdo
+    with _xdo_lock:
+        if _xdo is None:
+            from xdo import Xdo
+            _xdo = Xdo()
+        return _xdo
+
 
 def get_active_window_info() -> tuple[int, str]:
-    xdo = Xdo()
-    # Get the Process ID of the current focused window
-    active_window = xdo.get_active_window()
-    active_pid = xdo.get_pid_window(active_window)
-    focused = xdo.get_focused_window()
-    window_name = xdo.get_window_name(active_window)
-    sane_window = xdo.get_focused_window_sane()
+    xdo = get_xdo()
+    # The connection is shared between threads, libxdo isn't happy about that
+    with _xdo_lock:
+        # Get the Process ID of the current focused window
+        active_window = xdo.get_active_window()
+        active_pid = xdo.get_pid_window(active_window)
+        window_name = xdo.get_window_name(active_window)
     # print('Focused Window: ' + str(active_pid))
     # TODO: Use psutil (or similar) to get child processes of active window
     #  Possibly might have to get parent first and then children
     return active_pid, window_name
 
 
-def find_process_info(active_pid: int) -> psutil.Process:
+def find_process_info(active_pid: int) -> 'psutil.Process':
+    import psutil
     for proc in psutil.process_iter():
         if proc.pid == active_pid:
             return proc
 
 
-def get_all_related_processes(proc: psutil.Process) -> tuple[psutil.Process, list[psutil.Process]]:
+def get_all_related_processes(proc: 'psutil.Process') -> tuple['psutil.Process', list['psutil.Process']]:
     parent = proc.parent()
     # Get the parent only if it's there and is from the same program
     if parent is None or parent.exe() != proc.exe():
@@ -36,9 +52,94 @@ def get_all_related_processes(proc: psutil.Process) -> tuple[psutil.Process, lis
     return parent, proc.children(recursive=True)
 
 
-def find_focused_app_process_ids() -> tuple[psutil.Process, list[psutil.Process]]:
-    active_pid, _name = get_active_window_info()
+# Pass in the focused pid when it's already known (see FocusWatcher) to skip asking X for it
+def find_focused_app_process_ids(active_pid: [int | None] = None) -> tuple['psutil.Process', list['psutil.Process']]:
+    if active_pid is None:
+        active_pid, _name = get_active_window_info()
     focussed_proc = find_process_info(active_pid)
     parent, children = get_all_related_processes(focussed_proc)
-    logger.debug(f'Process: [{focussed_proc.pid}:{focussed_proc.name()}] has {len(children)} children: {children}')
+    logger.debug('Process: [%s:%s] has %s children: %s', focussed_proc.pid, lazy(focussed_proc.name), len(children), children)
     return parent, children
+
+
+class FocusedWindow:
+
+    def __init__(self, window_id: [int | None], pid: [int | None], geometry: [tuple[int, int, int, int] | None]):
+        self.window_id = window_id
+        self.pid = pid
+        # x, y, width, height in root window (screen) coordinates
+        self.geometry = geometry
+
+    @property
+    def center(self) -> [tuple[int, int] | None]:
+        if self.geometry is None:
+            return None
+        x, y, width, height = self.geometry
+        return x + width // 2, y + height // 2
+
+    def __str__(self):
+        return f'[Window: {self.window_id}, pid: {self.pid}, geometry: {self.geometry}]'
+
+
+# Tells us when the active window changes instead of asking X on every keypress.
+# Has its own X connection, whose fileno goes on the event core's loop, unless it's handed one to share
+# (see x11input.XInput2InputBackend), in which case whoever owns that connection passes its events on.
+class FocusWatcher:
+
+    def __init__(self, on_focus_changed: Callable[[FocusedWindow], None], shared_display=None):
+        from Xlib import X, display
+        self.on_focus_changed = on_focus_changed
+        self._owns_display = shared_display is None
+        self.display = display.Display() if shared_display is None else shared_display
+        self.root = self.display.screen().root
+        self._active_window_atom = self.display.intern_atom('_NET_ACTIVE_WINDOW')
+        self._pid_atom = self.display.intern_atom('_NET_WM_PID')
+        self.root.change_attributes(event_mask=X.PropertyChangeMask)
+        self.display.flush()
+        self.active_window_id: [int | None] = None
+        self.active_pid: [int | None] = None
+
+    def fileno(self) -> int:
+        return self.display.fileno()
+
+    def handle_pending_events(self):
+        active_window_changed = False
+        while self.display.pending_events() > 0:
+            active_window_changed |= self.is_focus_event(self.display.next_event())
+        if active_window_changed:
+            self.refresh()
+
+    def is_focus_event(self, event) -> bool:
+        from Xlib import X
+        return event.type == X.PropertyNotify and event.atom == self._active_window_atom
+
+    def refresh(self):
+        from Xlib import X
+        from Xlib.error import XError
+        active_window = self.root.get_full_property(self._active_window_atom, X.AnyPropertyType)
+        window_id = active_window.value[0] if active_window is not None and len(active_window.value) > 0 else None
+        if window_id == self.active_window_id:
+            return
+        self.active_window_id = window_id
+        pid = None
+        geometry = None
+        if window_id:
+            try:
+                window = self.display.create_resource_object('window', window_id)
+                pid_property = window.get_full_property(self._pid_atom, X.AnyPropertyType)
+                pid = pid_property.value[0] if pid_property is not None else None
+                window_geometry = window.get_geometry()
+                # Geometry is relative to the (window manager's) parent, we want it on the screen
+                position = window.translate_coords(self.root, 0, 0)
+                geometry = (-position.x, -position.y, window_geometry.width, window_geometry.height)
+            except XError:
+                # Closed before we got to it
+                pass
+        self.active_pid = pid
+        focused_window = FocusedWindow(window_id, pid, geometry)
+        logger.debug('Focus changed to: %s', focused_window)
+        self.on_focus_changed(focused_window)
+
+    def close(self):
+        if self._owns_display:
+            self.display.close()
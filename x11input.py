@@ -0,0 +1,401 @@
+from typing import Callable
+
+from pynput.keyboard import Key, KeyCode
+from pynput.mouse import Button
+
+import eventcore
+import keybindutils
+from keybindhandlers import Binding, InputBackend, KeybindListener, KeyChord, key_mask
+from loggingutils import get_logger
+
+logger = get_logger(__file__)
+
+XGRAB_INPUT = 'xgrab'
+XINPUT2_INPUT = 'xinput2'
+
+_KEY_GRAB = 'key'
+_BUTTON_GRAB = 'button'
+_SCROLL_BUTTONS = {4: 1, 5: -1}
+
+_pynput_keys_by_keysym = {key.value.vk: key for key in Key if getattr(key.value, 'vk', None) is not None}
+
+
+# The same key object pynput would have given us for this keysym, so captured bindings save as they always have
+def pynput_key_from_keysym(keysym: int) -> [Key | KeyCode]:
+    from Xlib import XK
+    key = _pynput_keys_by_keysym.get(keysym)
+    if key is not None:
+        return key
+    return KeyCode.from_vk(keysym, char=XK.keysym_to_string(keysym) or f'<{keysym}>')
+
+
+# One X connection read on the event core's loop, pass a display (e.g. ':99' for Xvfb) to pick which
+class _X11InputBackend(InputBackend):
+
+    def __init__(self, listener: KeybindListener, display_name: [str | None] = None):
+        from Xlib import display
+        super().__init__(listener)
+        self.display = display.Display(display_name)
+        self.root = self.display.screen().root
+        self._running = False
+        self._capturing = False
+        self._load_modifier_masks()
+
+    def _load_modifier_masks(self):
+        from Xlib import X, XK
+        # keycode -> the modifier mask X reports while it's held
+        self._modifier_masks: dict[int, int] = {}
+        for modifier_index, keycodes in enumerate(self.display.get_modifier_mapping()):
+            for keycode in keycodes:
+                if keycode != 0:
+                    self._modifier_masks[keycode] = 1 << modifier_index
+        num_lock_mask = self._modifier_masks.get(self.display.keysym_to_keycode(XK.XK_Num_Lock), X.Mod2Mask)
+        lock_masks = [X.LockMask, num_lock_mask]
+        self._lock_variants = sorted({lock_masks[0] * caps + lock_masks[1] * num
+                                      for caps in (0, 1) for num in (0, 1)})
+        modifier_bits = X.ShiftMask | X.ControlMask | X.Mod1Mask | X.Mod2Mask | X.Mod3Mask | X.Mod4Mask | X.Mod5Mask
+        self._modifier_state_mask = modifier_bits & ~X.LockMask & ~num_lock_mask
+
+    def fileno(self) -> int:
+        return self.display.fileno()
+
+    def start(self):
+        self._running = True
+        core = eventcore.get_core()
+        core.post(self._started)
+        core.add_reader(self, self.handle_pending_events)
+
+    def stop(self):
+        self._running = False
+        core = eventcore.get_core()
+        core.remove_reader(self)
+        core.post(self._close)
+
+    def _started(self):
+        pass
+
+    def _close(self):
+        self.display.close()
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def capture_changed(self, capturing: bool):
+        eventcore.get_core().post(self._set_capturing, capturing)
+
+    def _set_capturing(self, capturing: bool):
+        raise NotImplementedError
+
+    def handle_pending_events(self):
+        raise NotImplementedError
+
+    def _keysym(self, keycode: int, state: int) -> int:
+        from Xlib import X
+        # Same as pynput, the shifted symbol when shift is held
+        index = (1 if state & X.ShiftMask else 0) + (2 if state & X.Mod5Mask else 0)
+        return self.display.keycode_to_keysym(keycode, index) or self.display.keycode_to_keysym(keycode, 0)
+
+
+# Passive grabs on the root window for just the bound chords, so X only ever wakes us up for something that matches.
+# Each chord is grabbed once per combination of the lock modifiers (Caps Lock, Num Lock) so they don't get in the way.
+# While the listener is capturing a new chord the whole keyboard is grabbed instead, and events are passed on as keys.
+class XGrabInputBackend(_X11InputBackend):
+
+    def __init__(self, listener: KeybindListener, display_name: [str | None] = None):
+        super().__init__(listener, display_name)
+        # (grab kind, keycode or button, modifier mask) -> the chords it stands for
+        self._grabs: dict[tuple[str, int, int], list[KeyChord]] = {}
+        self._held_keycodes: set[int] = set()
+
+    def _started(self):
+        self._apply_grabs()
+
+    def _close(self):
+        self._ungrab_all()
+        super()._close()
+
+    def bindings_changed(self):
+        eventcore.get_core().post(self._apply_grabs)
+
+    def _grab_for_binding(self, binding: Binding) -> [tuple[str, int, int] | None]:
+        held_keys = list(binding.keys)
+        if binding.mouse_action is None:
+            terminal_keys = [key for key in held_keys if not key.is_modifier] or held_keys[-1:]
+            if len(terminal_keys) == 0:
+                return None
+            held_keys.remove(terminal_keys[-1])
+            detail = self.display.keysym_to_keycode(terminal_keys[-1].code)
+            kind = _KEY_GRAB
+        else:
+            # See keybindhandlers.mouse_button_code, mouse codes are minus the X button
+            detail = -binding.mouse_action.code
+            kind = _BUTTON_GRAB
+        if detail <= 0:
+            logger.warning(f'No key on this keyboard for [{binding}], it can\'t be grabbed')
+            return None
+        modifier_mask = 0
+        for key in held_keys:
+            mask = self._modifier_masks.get(self.display.keysym_to_keycode(key.code))
+            if mask is None:
+                logger.warning(f'[{key.name}] in [{binding}] isn\'t a modifier, it can\'t be grabbed')
+                return None
+            modifier_mask |= mask
+        return kind, detail, modifier_mask
+
+    def _wanted_grabs(self) -> dict[tuple[str, int, int], list[KeyChord]]:
+        grabs = {}
+        for bound_action in self.listener.bound_actions:
+            for binding in bound_action.binding_group.bindings:
+                grab = self._grab_for_binding(binding)
+                if grab is not None:
+                    grabs.setdefault(grab, []).append(binding.chord)
+        return grabs
+
+    def _grab(self, kind: str, detail: int, modifier_mask: int, onerror=None):
+        from Xlib import X
+        for lock_variant in self._lock_variants:
+            if kind == _KEY_GRAB:
+                self.root.grab_key(detail, modifier_mask | lock_variant, True,
+                                   X.GrabModeAsync, X.GrabModeAsync, onerror=onerror)
+            else:
+                self.root.grab_button(detail, modifier_mask | lock_variant, True,
+                                      X.ButtonPressMask | X.ButtonReleaseMask,
+                                      X.GrabModeAsync, X.GrabModeAsync, X.NONE, X.NONE, onerror=onerror)
+
+    def _ungrab(self, kind: str, detail: int, modifier_mask: int):
+        for lock_variant in self._lock_variants:
+            if kind == _KEY_GRAB:
+                self.root.ungrab_key(detail, modifier_mask | lock_variant)
+            else:
+                self.root.ungrab_button(detail, modifier_mask | lock_variant)
+
+    def _ungrab_all(self):
+        for kind, detail, modifier_mask in self._grabs:
+            self._ungrab(kind, detail, modifier_mask)
+        self._grabs = {}
+        self.display.flush()
+
+    # Only what changed is grabbed or let go
+    def _apply_grabs(self):
+        from Xlib import error
+        if not self._running:
+            return
+        wanted = self._wanted_grabs()
+        for grab in self._grabs.keys() - wanted.keys():
+            self._ungrab(*grab)
+        failed = []
+        for grab in wanted.keys() - self._grabs.keys():
+            catcher = error.CatchError(error.BadAccess)
+            self._grab(*grab, onerror=catcher)
+            self.display.sync()
+            if catcher.get_error() is not None:
+                failed.append(grab)
+        for grab in failed:
+            logger.warning(f'Another application already grabbed {grab}, chords: {wanted.pop(grab)}')
+        self._grabs = wanted
+        self.display.flush()
+        logger.info(f'Grabbed {len(self._grabs)} chords')
+
+    def _set_capturing(self, capturing: bool):
+        from Xlib import X
+        if capturing == self._capturing or not self._running:
+            return
+        self._capturing = capturing
+        if capturing:
+            if self.root.grab_keyboard(True, X.GrabModeAsync, X.GrabModeAsync, X.CurrentTime) != X.GrabSuccess:
+                logger.warning('Unable to grab the keyboard, only bound chords can be captured')
+            # Clicking about in the window stays possible, only the buttons a binding could use are taken
+            for button in (2, 4, 5, 8, 9):
+                self.root.grab_button(button, X.AnyModifier, True, X.ButtonPressMask | X.ButtonReleaseMask,
+                                      X.GrabModeAsync, X.GrabModeAsync, X.NONE, X.NONE)
+        else:
+            self.display.ungrab_keyboard(X.CurrentTime)
+            for button in (2, 4, 5, 8, 9):
+                self.root.ungrab_button(button, X.AnyModifier)
+            # Letting go of AnyModifier took the bound buttons with it
+            self._grabs = {grab: chords for grab, chords in self._grabs.items() if grab[0] == _KEY_GRAB}
+            self._apply_grabs()
+        self.display.flush()
+
+    def handle_pending_events(self):
+        from Xlib import X
+        pending = []
+        while self.display.pending_events() > 0:
+            pending.append(self.display.next_event())
+        for i, event in enumerate(pending):
+            if event.type == X.KeyPress:
+                # Auto repeat, still held from last time
+                if event.detail in self._held_keycodes:
+                    continue
+                self._held_keycodes.add(event.detail)
+                self._key_event(event, True)
+            elif event.type == X.KeyRelease:
+                following = pending[i + 1] if i + 1 < len(pending) else None
+                # Auto repeat sends a release and press at the same time, the key never went up
+                if following is not None and following.type == X.KeyPress \
+                        and following.detail == event.detail and following.time == event.time:
+                    continue
+                self._held_keycodes.discard(event.detail)
+                self._key_event(event, False)
+            elif event.type == X.ButtonPress:
+                self._button_event(event)
+
+    def _key_event(self, event, pressed: bool):
+        if self._capturing:
+            key = pynput_key_from_keysym(self._keysym(event.detail, event.state))
+            if pressed:
+                self.listener.key_pressed(key)
+            else:
+                self.listener.key_released(key)
+        elif pressed:
+            self._deliver(_KEY_GRAB, event.detail, event.state)
+
+    def _button_event(self, event):
+        if self._capturing:
+            if event.detail in _SCROLL_BUTTONS:
+                self.listener.mouse_scrolled(event.root_x, event.root_y, 0, _SCROLL_BUTTONS[event.detail])
+                return
+            try:
+                button = Button(event.detail)
+            except ValueError:
+                return
+            self.listener.mouse_clicked(event.root_x, event.root_y, button, True)
+        else:
+            self._deliver(_BUTTON_GRAB, event.detail, event.state)
+
+    def _deliver(self, kind: str, detail: int, state: int):
+        for chord in self._grabs.get((kind, detail, state & self._modifier_state_mask), ()):
+            self.listener.chord_pressed(chord)
+
+
+# What's at the front of every XI2 raw event, the valuators after it aren't needed
+def _raw_event_data():
+    from Xlib.protocol import rq
+    return rq.Struct(
+        rq.Card16('deviceid'),
+        rq.Card32('time'),
+        rq.Card32('detail'),
+        rq.Card16('sourceid'),
+        rq.Card16('valuators_len'),
+        rq.Card32('flags'))
+
+
+# XInput2 raw key and button events from every device on one X connection. Motion is never selected, so moving
+# the mouse doesn't wake us up. Raw events come without any modifier state, the held keys are tracked here instead
+# and each press goes to the listener as the same KeyChord a binding builds, unless a chord is being captured.
+# The active window is followed off the same connection, in place of the event core's own FocusWatcher.
+class XInput2InputBackend(_X11InputBackend):
+    watches_focus = True
+
+    def __init__(self, listener: KeybindListener, display_name: [str | None] = None):
+        from Xlib.ext import xinput
+        import windowutils
+        super().__init__(listener, display_name)
+        if not self.display.has_extension(xinput.extname):
+            self.display.close()
+            raise RuntimeError(f'No XInput extension on display [{self.display.get_display_name()}]')
+        self._xinput_opcode = self.display.get_extension_major(xinput.extname)
+        # Raw events only keep coming while another client has a grab from 2.1 on
+        version = xinput.XIQueryVersion(display=self.display.display, opcode=self._xinput_opcode,
+                                        major_version=2, minor_version=2)
+        if (version.major_version, version.minor_version) < (2, 1):
+            logger.warning(f'XInput {version.major_version}.{version.minor_version}, '
+                           f'keys are missed while another application has a grab')
+        for raw_event_type in (xinput.RawKeyPress, xinput.RawKeyRelease, xinput.RawButtonPress):
+            self.display.ge_add_event_data(self._xinput_opcode, raw_event_type, _raw_event_data())
+        # keycode -> the keysym it went down as, so it's let go as the same one
+        self._held_codes: dict[int, int] = {}
+        self._modifier_keysyms: dict[int, bool] = {}
+        self.focus_watcher = windowutils.FocusWatcher(eventcore.get_core().focus_changed.emit, self.display)
+
+    def _started(self):
+        from Xlib.ext import xinput
+        self.root.xinput_select_events([
+            (xinput.AllMasterDevices, xinput.RawKeyPressMask | xinput.RawKeyReleaseMask | xinput.RawButtonPressMask)])
+        self.display.flush()
+        self.focus_watcher.refresh()
+
+    def _set_capturing(self, capturing: bool):
+        if capturing == self._capturing:
+            return
+        self._capturing = capturing
+        # The listener only sees keys while capturing, so it's told about the modifiers already held (and let go of)
+        for keysym in self._held_codes.values():
+            if self._is_modifier(keysym):
+                if capturing:
+                    self.listener.key_pressed(pynput_key_from_keysym(keysym))
+                else:
+                    self.listener.key_released(pynput_key_from_keysym(keysym))
+
+    def handle_pending_events(self):
+        from Xlib.ext import ge, xinput
+        active_window_changed = False
+        while self.display.pending_events() > 0:
+            event = self.display.next_event()
+            if event.type == ge.GenericEventCode and event.extension == self._xinput_opcode:
+                if event.evtype == xinput.RawKeyPress:
+                    self._key_pressed(event.data.detail)
+                elif event.evtype == xinput.RawKeyRelease:
+                    self._key_released(event.data.detail)
+                elif event.evtype == xinput.RawButtonPress:
+                    self._button_pressed(event.data.detail)
+            elif self.focus_watcher.is_focus_event(event):
+                active_window_changed = True
+        if active_window_changed:
+            self.focus_watcher.refresh()
+
+    def _is_modifier(self, keysym: int) -> bool:
+        is_modifier = self._modifier_keysyms.get(keysym)
+        if is_modifier is None:
+            is_modifier = self._modifier_keysyms[keysym] = keybindutils.is_modifier_key(pynput_key_from_keysym(keysym))
+        return is_modifier
+
+    def _held_state(self) -> int:
+        state = 0
+        for keycode in self._held_codes:
+            state |= self._modifier_masks.get(keycode, 0)
+        return state
+
+    def _key_pressed(self, keycode: int):
+        # Auto repeat, still held from last time
+        if keycode in self._held_codes:
+            return
+        keysym = self._keysym(keycode, self._held_state())
+        if keysym == 0:
+            return
+        self._held_codes[keycode] = keysym
+        if self._capturing:
+            self.listener.key_pressed(pynput_key_from_keysym(keysym))
+        elif self._is_modifier(keysym):
+            self.listener.chord_pressed(KeyChord(key_mask(self._held_codes.values())))
+        else:
+            self.listener.chord_pressed(KeyChord(
+                key_mask(held for held_keycode, held in self._held_codes.items() if held_keycode != keycode), keysym))
+
+    def _key_released(self, keycode: int):
+        keysym = self._held_codes.pop(keycode, None)
+        if keysym is not None and self._capturing:
+            self.listener.key_released(pynput_key_from_keysym(keysym))
+
+    def _button_pressed(self, button: int):
+        if self._capturing:
+            if button in _SCROLL_BUTTONS:
+                self.listener.mouse_scrolled(0, 0, 0, _SCROLL_BUTTONS[button])
+                return
+            try:
+                pynput_button = Button(button)
+            except ValueError:
+                return
+            self.listener.mouse_clicked(0, 0, pynput_button, True)
+        # Left and right clicks never make a binding, same as KeybindListener.mouse_clicked
+        elif button not in (Button.left.value, Button.right.value):
+            # See keybindhandlers.mouse_button_code, mouse codes are minus the X button
+            self.listener.chord_pressed(KeyChord(key_mask(self._held_codes.values()), -button))
+
+
+def input_backend_factory(name: str, display_name: [str | None] = None) -> Callable[[KeybindListener], InputBackend]:
+    if name == XGRAB_INPUT:
+        return lambda listener: XGrabInputBackend(listener, display_name)
+    if name == XINPUT2_INPUT:
+        return lambda listener: XInput2InputBackend(listener, display_name)
+    raise ValueError(f'Unknown X11 Input Backend: {name}')